@@ -1,112 +1,142 @@
+import multiprocessing
 import uproot
 import awkward as ak
 import numpy as np
 import matplotlib.pyplot as plt
 
-def analyze_root(root_file):
+import metrics
+import columnar_cache
+
+def min_flu_geometry(cluster_energy, cluster_n_cells, cluster_weighted_x, cluster_weighted_y, cluster_avg_t):
+    # 与阈值无关的部分（多组阈值可共用）：每个事件能量最小的cluster，及其他cluster相对它的 |dx|,|dy|,|dt|
+    min_idx = ak.argmin(cluster_energy, axis=1, keepdims=True)
+    return {
+        "n_clusters": ak.num(cluster_energy),
+        "local_idx": ak.local_index(cluster_energy),
+        "is_min": ak.fill_none(ak.local_index(cluster_energy) == ak.firsts(min_idx), False),
+        "min_energy": ak.firsts(cluster_energy[min_idx]),
+        "min_n_cells": ak.firsts(cluster_n_cells[min_idx]),
+        "dx": np.abs(cluster_weighted_x - ak.firsts(cluster_weighted_x[min_idx])),
+        "dy": np.abs(cluster_weighted_y - ak.firsts(cluster_weighted_y[min_idx])),
+        "dt": np.abs(cluster_avg_t - ak.firsts(cluster_avg_t[min_idx])),
+    }
+
+
+def remove_min_flu(cluster_energy, cluster_n_cells, cluster_weighted_x, cluster_weighted_y, cluster_avg_t,
+                   energy_max=30, n_cells_max=2, window=10, geometry=None):
+    # 向量化的荧光去除（无逐事件循环），规则与原逐事件实现相同：
+    # 每个事件取能量最小的cluster，若 energy<energy_max 且 n_cells<=n_cells_max 视为荧光cluster：
+    #   - 单cluster事件：抛弃整个事件
+    #   - 多cluster事件：在 |dx|<=window 且 |dy|<=window 的其他cluster中选 |dt| 最小的（并列取索引最小），
+    #     把能量加到它上面并删除荧光cluster；没有候选则保持不变
+    # geometry：min_flu_geometry 的结果（多组阈值共用时传入，避免重复计算）
+    # 返回 (新的cluster_energy, 保留事件掩码, 合并掩码)
+    if geometry is None:
+        geometry = min_flu_geometry(cluster_energy, cluster_n_cells, cluster_weighted_x, cluster_weighted_y,
+                                    cluster_avg_t)
+    n_clusters = geometry["n_clusters"]
+    is_min = geometry["is_min"]
+    min_energy = geometry["min_energy"]
+
+    # 最小能量cluster是否为荧光（空事件为 None -> False）
+    is_flu = ak.fill_none((min_energy < energy_max) & (geometry["min_n_cells"] <= n_cells_max), False)
+
+    # 候选掩码：其他cluster中 |dx|<=window 且 |dy|<=window
+    candidate_mask = ak.fill_none(~is_min & (geometry["dx"] <= window) & (geometry["dy"] <= window), False)
+
+    # 在候选中选dt最小的（非候选置为inf，argmin取第一个最小值，与原实现的并列处理一致）
+    best_idx = ak.argmin(ak.where(candidate_mask, geometry["dt"], np.inf), axis=1)
+    merge = is_flu & (n_clusters >= 2) & ak.any(candidate_mask, axis=1)
+
+    # 合并能量到best_idx，删除最小能量cluster
+    is_best = ak.fill_none(geometry["local_idx"] == best_idx, False) & merge
+    new_energy = ak.where(is_best, cluster_energy + min_energy, cluster_energy)
+    new_energy = new_energy[~(is_min & merge)]
+
+    keep = ~(is_flu & (n_clusters == 1))
+    return new_energy, keep, merge
+
+
+CLUSTER_BRANCHES = ["cluster_energy", "cluster_n_cells", "cluster_weighted_x", "cluster_weighted_y", "cluster_avg_t"]
+HIST_EDGES = np.linspace(0, 500, 101)
+
+
+def _analyze_chunk(data):
+    # 处理一块事件，返回可直接相加的结果：(能谱直方图, 抛弃事件数, 合并次数, 新cluster数, 新cluster能量和)
+    with metrics.stage("remove_flu", events=len(data)) as s:
+        new_energy, keep, merge = remove_min_flu(data["cluster_energy"], data["cluster_n_cells"],
+                                                 data["cluster_weighted_x"], data["cluster_weighted_y"],
+                                                 data["cluster_avg_t"])
+        new_energies = ak.to_numpy(ak.flatten(new_energy[keep]))  # 新的cluster_energy
+        s.add(clusters=int(ak.sum(ak.num(data["cluster_energy"]))))
+    return (np.histogram(new_energies, bins=HIST_EDGES)[0], int(ak.sum(~keep)), int(ak.sum(merge)),
+            len(new_energies), float(np.sum(new_energies)))
+
+
+def _analyze_range(args):
+    # 进程池任务：读取并处理 [entry_start, entry_stop) 范围的事件
+    root_file, entry_start, entry_stop = args
+    with metrics.stage("read", events=entry_stop - entry_start):
+        data = columnar_cache.arrays(root_file, CLUSTER_BRANCHES, entry_start, entry_stop)
+    return _analyze_chunk(data)
+
+
+def analyze_root(root_file, n_workers=1, step_size=None):
+    # step_size：每块事件数（None 时串行一次读入全部，并行时默认每个进程约 4 块）
+    # n_workers > 1：按事件范围切块，用进程池并行处理，结果按事件顺序相加（与串行结果一致）
+    hist_counts = np.zeros(len(HIST_EDGES) - 1)
+    discarded_events = 0  # 抛弃事件计数
+    merged_clusters = 0   # 合并次数
+    n_new_clusters = 0    # 新cluster总数
+    sum_new_energy = 0.0
+
     # 读取ROOT树
     with uproot.open(root_file) as file:
         tree = file["Tree"]
         
-        # 提取cluster级数据（jagged arrays）
-        cluster_energy = tree["cluster_energy"].array()
-        cluster_n_cells = tree["cluster_n_cells"].array()
-        cluster_weighted_x = tree["cluster_weighted_x"].array()
-        cluster_weighted_y = tree["cluster_weighted_y"].array()
-        cluster_avg_t = tree["cluster_avg_t"].array()
-        
         # 事件总数
-        n_events = len(cluster_energy)
+        n_events = tree.num_entries
         print(f"总事件数: {n_events}")
         
-        discarded_events = 0  # 抛弃事件计数
-        merged_clusters = 0   # 合并次数
-        new_energies = []     # 收集新的cluster_energy
+        if n_workers > 1:
+            step = (columnar_cache.step_entries(root_file, CLUSTER_BRANCHES, step_size, tree=tree) if step_size
+                    else max(-(-n_events // (n_workers * 4)), 1))
+            ranges = [(root_file, start, min(start + step, n_events)) for start in range(0, n_events, step)]
+            with multiprocessing.Pool(n_workers) as pool:
+                results = list(metrics.imap(pool, _analyze_range, ranges))
+        else:
+            chunks = columnar_cache.iterate(root_file, CLUSTER_BRANCHES, step_size or max(n_events, 1), tree=tree)
+            results = map(_analyze_chunk, metrics.timed_iter("read", chunks, events=len))
         
-        for i in range(n_events):
-            n_clusters = len(cluster_energy[i])
-            if n_clusters == 1:
-                # 单cluster事件：检查抛弃条件
-                if cluster_n_cells[i][0] <= 2 and cluster_energy[i][0] < 30:
-                    discarded_events += 1
-                    continue
-                else:
-                    # 保留该cluster
-                    new_energies.extend(ak.to_numpy(cluster_energy[i]))
-            elif n_clusters >= 2:
-                # 多cluster事件：提取为NumPy进行修改
-                energies_np = ak.to_numpy(cluster_energy[i])
-                n_cells_np = ak.to_numpy(cluster_n_cells[i])
-                x_np = ak.to_numpy(cluster_weighted_x[i])
-                y_np = ak.to_numpy(cluster_weighted_y[i])
-                t_np = ak.to_numpy(cluster_avg_t[i])
-                
-                # 找最小能量cluster
-                min_energy_idx = np.argmin(energies_np)
-                min_energy = energies_np[min_energy_idx]
-                min_n_cells = n_cells_np[min_energy_idx]
-                
-                if min_energy < 30 and min_n_cells <= 2:
-                    # 尝试合并
-                    min_x = x_np[min_energy_idx]
-                    min_y = y_np[min_energy_idx]
-                    min_t = t_np[min_energy_idx]
-                    
-                    # 其他cluster的索引和差异
-                    other_idxs = np.delete(np.arange(n_clusters), min_energy_idx)
-                    other_t = t_np[other_idxs]
-                    other_x = x_np[other_idxs]
-                    other_y = y_np[other_idxs]
-                    
-                    dt_diffs = np.abs(other_t - min_t)
-                    dx_diffs = np.abs(other_x - min_x)
-                    dy_diffs = np.abs(other_y - min_y)
-                    
-                    # 候选掩码：|dx|<=10 且 |dy|<=10
-                    candidate_mask = (dx_diffs <= 10) & (dy_diffs <= 10)
-                    candidates = other_idxs[candidate_mask]
-                    
-                    if len(candidates) > 0:
-                        # 在候选中选dt最小的
-                        filtered_dt = dt_diffs[candidate_mask]
-                        best_rel_idx = np.argmin(filtered_dt)
-                        best_idx = candidates[best_rel_idx]
-                        
-                        # 合并能量到best_idx
-                        energies_np[best_idx] += min_energy
-                        merged_clusters += 1
-                        
-                        # 删除min_energy_idx（注意：删除后索引会变，但best_idx已在前面）
-                        if best_idx > min_energy_idx:
-                            best_idx -= 1  # 调整best_idx（因为删除min后，后续索引前移）
-                        energies_np = np.delete(energies_np, min_energy_idx)
-                        # 无需调整其他np，因为我们只用energies_np追加
-                        
-                        # 如果剩余为空，跳过
-                        if len(energies_np) == 0:
-                            discarded_events += 1  # 可选：视为空事件
-                            continue
-                
-                # 追加修改后的energies（或原版如果无合并）
-                new_energies.extend(energies_np)
+        for counts, discarded, merged, n_new, sum_energy in results:
+            hist_counts += counts
+            discarded_events += discarded
+            merged_clusters += merged
+            n_new_clusters += n_new
+            sum_new_energy += sum_energy
         
-        print(f"抛弃事件数: {discarded_events}")
-        print(f"合并cluster次数: {merged_clusters}")
-        new_energies = np.array(new_energies)
-        
-        #plot
+    print(f"抛弃事件数: {discarded_events}")
+    print(f"合并cluster次数: {merged_clusters}")
+    
+    #plot（由累加的直方图绘制，与直接对全部能量作图相同）
+    with metrics.stage("plot"):
         plt.figure(figsize=(8, 6))
-        plt.hist(new_energies, bins=100, range=(0, 500), alpha=0.7, color='blue', edgecolor='black')
+        plt.hist(HIST_EDGES[:-1], bins=HIST_EDGES, weights=hist_counts, alpha=0.7, color='blue', edgecolor='black')
         plt.xlabel('New Cluster Energy (keV)')
         plt.ylabel('Counts')
         plt.title('Distribution of New Cluster Energies After Filtering and Merging')
         plt.grid(True, alpha=0.3)
         plt.savefig('new_cluster_energy_distribution.png', dpi=300, bbox_inches='tight')
-        plt.show()
-        
-        print(f"分布图已保存为: new_cluster_energy_distribution.png")
-        print(f"新cluster总数: {len(new_energies)}, 平均能量: {np.mean(new_energies):.2f} keV")
+        plt.close()
+    
+    print(f"分布图已保存为: new_cluster_energy_distribution.png")
+    mean_energy = sum_new_energy / n_new_clusters if n_new_clusters else float("nan")
+    print(f"新cluster总数: {n_new_clusters}, 平均能量: {mean_energy:.2f} keV")
+    metrics.count("discarded_events", discarded_events)
+    metrics.count("merged_clusters", merged_clusters)
+    metrics.count("new_clusters", n_new_clusters)
+    metrics.flush("analyze_root")
 
 if __name__ == "__main__":
     root_file = "./TEST-14000-ENERGY.root"  # 替换为您的ROOT文件路径
-    analyze_root(root_file)
\ No newline at end of file
+    analyze_root(root_file)
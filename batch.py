@@ -0,0 +1,273 @@
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import traceback
+import contextlib
+import multiprocessing
+
+import metrics
+
+# 批处理命令行：对一个目录 / glob / 文件列表中的全部 run 依次做 convert（.clog -> .root）→ clean（去荧光）→
+# hist（直方图 .npz + 出图）→ fit（40-70 keV 峰拟合，结果 .json），按 run 用进程池并行。
+# 每个 run 的输出放在 <out_dir>/<run>/ 下；每个阶段的缓存键 = 阶段名 + 影响结果的参数 + 上游键
+# （第一个阶段用输入文件内容的 SHA-256），记录在 <out_dir>/batch_cache.json 中，
+# 键未变且输出存在时跳过该阶段，所以重跑时只处理新增或有变化的 run。
+#
+#   python batch.py /data/campaign -o ./processed -j 8
+#   python batch.py "/data/*.clog" -o ./processed --stages convert,clean --cell-mode remap
+STAGES = ("convert", "clean", "hist", "fit")
+STAGE_VERSION = {"convert": 1, "clean": 1, "hist": 1, "fit": 1}  # 改动某阶段的处理后加一，使其缓存失效
+CACHE_FILE = "batch_cache.json"
+
+
+def file_sha256(path, known=None):
+    # 文件内容的 SHA-256；known 为以前的记录（大小、修改时间未变时直接复用，不重新读取大文件）
+    stat = os.stat(path)
+    if known and known.get("size") == stat.st_size and known.get("mtime_ns") == stat.st_mtime_ns:
+        return known
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            h.update(block)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": h.hexdigest()}
+
+
+def _stage_key(stage, params, upstream):
+    text = json.dumps({"stage": stage, "version": STAGE_VERSION[stage], "params": params, "upstream": upstream},
+                      sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def find_runs(inputs):
+    # 输入可以是目录（其中的 .clog / .root，不递归）、glob 或文件；按文件名（去扩展名）归为 run，
+    # 同名的 .clog 和 .root 都在时从 .clog 开始
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += glob.glob(os.path.join(item, "*.clog")) + glob.glob(os.path.join(item, "*.root"))
+        else:
+            paths += glob.glob(item) if glob.has_magic(item) else [item]
+    runs = {}
+    for path in sorted(paths):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        if ext not in (".clog", ".root"):
+            continue
+        if ext == ".clog" or stem not in runs:
+            runs[stem] = os.path.abspath(path)
+    return runs
+
+
+def _stage_params(stage, options):
+    # 只有影响输出内容的参数进入缓存键（chunk_frames / step_size 只影响内存和速度）
+    if stage == "clean":
+        return {"cell_mode": options["cell_mode"]}
+    if stage == "fit":
+        return {"fit_range": list(options["fit_range"]), "binned": options["binned"], "n_bins": options["n_bins"]}
+    return {}
+
+
+def _run_convert(paths, options):
+    from convert_clog_to_root import convert_clog_to_root
+    convert_clog_to_root(paths["input"], paths["root"], chunk_frames=options["chunk_frames"])
+
+
+def _run_clean(paths, options):
+    from new_remove_flu__and_save_root import analyze_and_save_root
+    analyze_and_save_root(paths["root"], paths["clean"], step_size=options["step_size"],
+                          cell_mode=options["cell_mode"])
+
+
+def _run_hist(paths, options):
+    import columnar_cache
+    from draw_under40_plot import new_histograms, fill_histograms
+    from histograms import save_histograms
+    from render import render_run
+    hists = new_histograms()
+    chunks = columnar_cache.iterate(paths["clean"], ["cluster_energy", "cell_x", "cell_y", "cell_E", "cluster_n_cells",
+                                                     "cell_cluster_id"], options["step_size"])
+    for data in metrics.timed_iter("read", chunks, events=len):
+        fill_histograms(hists, data)
+    save_histograms(paths["hist"], hists)
+    render_run(paths["hist"], out_dir=paths["dir"])
+
+
+def _run_fit(paths, options):
+    from spectrum_fit import fit_root_file, PARAM_NAMES
+    result = fit_root_file(paths["clean"], fit_range=options["fit_range"], binned=options["binned"],
+                           n_bins=options["n_bins"], plot_file=os.path.join(paths["dir"], "fit_result.png"),
+                           step_size=options["step_size"])
+    summary = {name: list(result[name]) for name in PARAM_NAMES}
+    summary.update({key: result[key] for key in ("nll", "converged", "n_data", "binned")})
+    summary["fit_range"] = list(result["fit_range"])
+    summary["covariance"] = result["covariance"].tolist()
+    with open(paths["fit"], "w") as f:
+        json.dump(summary, f, indent=1, default=float)
+
+
+# 阶段 -> (处理函数, 该阶段的输出)
+STAGE_RUNNERS = {
+    "convert": (_run_convert, ("root",)),
+    "clean": (_run_clean, ("clean",)),
+    "hist": (_run_hist, ("hist",)),
+    "fit": (_run_fit, ("fit",)),
+}
+
+
+def _run_paths(run, input_path, out_dir):
+    run_dir = os.path.join(out_dir, run)
+    from_clog = input_path.endswith(".clog")
+    return {
+        "input": input_path,
+        "dir": run_dir,
+        "root": os.path.join(run_dir, run + ".root") if from_clog else input_path,
+        "clean": os.path.join(run_dir, run + "_updated.root"),
+        "hist": os.path.join(run_dir, run + "_plots.npz"),
+        "fit": os.path.join(run_dir, run + "_fit.json"),
+        "log": os.path.join(run_dir, "batch.log"),
+    }
+
+
+def process_run(args):
+    # 处理一个 run 的各阶段（在进程池中运行）；返回 (run, 各阶段状态, 更新的缓存记录, 输入文件的哈希记录)
+    run, input_path, out_dir, stages, options, cache, known_file, force, dry_run = args
+    paths = _run_paths(run, input_path, out_dir)
+    status, updates = {}, {}
+    file_entry = file_sha256(input_path, known_file)
+    # 键链包含全部阶段（没有选中的阶段也参与），只选部分阶段时下游的键不变
+    keys = {}
+    upstream = file_entry["sha256"]
+    for stage in STAGES:
+        if stage == "convert" and not input_path.endswith(".clog"):
+            continue
+        upstream = keys[stage] = _stage_key(stage, _stage_params(stage, options), upstream)
+    os.makedirs(paths["dir"], exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        # 各脚本的 print 和附带的图片写到 run 目录（多个 run 并行时不互相覆盖）
+        os.chdir(paths["dir"])
+        with open(paths["log"], "a") as log, contextlib.redirect_stdout(log):
+            for stage in (s for s in stages if s in keys):
+                runner, outputs = STAGE_RUNNERS[stage]
+                key = keys[stage]
+                cache_id = f"{run}/{stage}"
+                outputs_exist = all(os.path.exists(paths[name]) for name in outputs)
+                if not force and cache.get(cache_id, {}).get("key") == key and outputs_exist:
+                    status[stage] = "跳过"
+                    continue
+                if dry_run:
+                    status[stage] = "待运行"
+                    continue
+                print(f"=== {run}: {stage} ===")
+                try:
+                    with metrics.stage(f"batch_{stage}"):
+                        runner(paths, options)
+                except Exception:
+                    traceback.print_exc(file=log)
+                    status[stage] = "失败"
+                    break
+                updates[cache_id] = {"key": key, "outputs": [paths[name] for name in outputs]}
+                status[stage] = "完成"
+    finally:
+        os.chdir(cwd)
+    return run, status, updates, file_entry
+
+
+def _load_cache(out_dir):
+    path = os.path.join(out_dir, CACHE_FILE)
+    if not os.path.exists(path):
+        return {"files": {}, "stages": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_cache(out_dir, cache):
+    path = os.path.join(out_dir, CACHE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def run_batch(inputs, out_dir="./batch_output", stages=STAGES, n_workers=1, chunk_frames=100000, step_size="200 MB",
+              cell_mode="full", fit_range=(40.0, 70.0), binned=False, n_bins=30, force=False, dry_run=False):
+    if cell_mode == "skip" and "hist" in stages:
+        raise ValueError("cell_mode='skip' 的输出没有cell分支，不能做 hist 阶段")
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    runs = find_runs(inputs)
+    if not runs:
+        print("没有找到 .clog / .root 输入")
+        return {}
+    cache = _load_cache(out_dir)
+    options = {"chunk_frames": chunk_frames, "step_size": step_size, "cell_mode": cell_mode,
+               "fit_range": tuple(fit_range), "binned": binned, "n_bins": n_bins}
+    tasks = [(run, path, out_dir, list(stages), options, cache["stages"], cache["files"].get(path), force, dry_run)
+             for run, path in runs.items()]
+    print(f"共 {len(tasks)} 个 run，阶段: {', '.join(stages)}，输出目录: {out_dir}")
+
+    results = {}
+    if n_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            completed = metrics.imap(pool, process_run, tasks)
+            for run, status, updates, file_entry in completed:
+                results[run] = _record(cache, out_dir, run, runs[run], status, updates, file_entry, dry_run)
+    else:
+        for task in tasks:
+            run, status, updates, file_entry = process_run(task)
+            results[run] = _record(cache, out_dir, run, runs[run], status, updates, file_entry, dry_run)
+
+    n_failed = sum("失败" in status.values() for status in results.values())
+    print(f"完成: {len(results) - n_failed} 个 run，失败: {n_failed} 个（详见各 run 目录下的 batch.log）")
+    metrics.flush("batch")
+    return results
+
+
+def _record(cache, out_dir, run, path, status, updates, file_entry, dry_run):
+    # 每个 run 完成后立即更新缓存文件（中途中断时已完成的 run 不会重算）
+    if not dry_run:
+        cache["files"][path] = file_entry
+        cache["stages"].update(updates)
+        _save_cache(out_dir, cache)
+    print(f"{run:<30}" + "  ".join(f"{stage}: {state}" for stage, state in status.items()))
+    return status
+
+
+def _parse_step_size(value):
+    return int(value) if value.isdigit() else value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量处理 .clog / .root：convert → clean → hist → fit，按内容哈希缓存")
+    parser.add_argument("inputs", nargs="+", help="目录、glob 或 .clog / .root 文件")
+    parser.add_argument("-o", "--out-dir", default="./batch_output")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="并行处理的 run 数")
+    parser.add_argument("--stages", default=",".join(STAGES), help="逗号分隔，可选 " + ",".join(STAGES))
+    parser.add_argument("--chunk-frames", type=int, default=100000)
+    parser.add_argument("--step-size", type=_parse_step_size, default="200 MB", help="事件数或如 '200 MB'")
+    parser.add_argument("--cell-mode", choices=("full", "remap", "skip"), default="full")
+    parser.add_argument("--fit-range", type=float, nargs=2, default=(40.0, 70.0))
+    parser.add_argument("--binned", action="store_true")
+    parser.add_argument("--n-bins", type=int, default=30)
+    parser.add_argument("--force", action="store_true", help="忽略缓存，全部重算")
+    parser.add_argument("--dry-run", action="store_true", help="只列出需要运行的阶段")
+    parser.add_argument("--metrics", help="写出各阶段计时（.jsonl 或 .prom），见 metrics.py")
+    args = parser.parse_args(argv)
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"未知的阶段: {unknown}")
+    stages = [s for s in STAGES if s in stages]  # 按固定顺序
+    # 批处理不需要交互窗口：各阶段（含进程池中的子进程）用非交互的 Agg 后端画图，已设置 MPLBACKEND 时不覆盖
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    if args.metrics:
+        metrics.enable(args.metrics)
+    results = run_batch(args.inputs, args.out_dir, stages, args.workers, args.chunk_frames, args.step_size,
+                        args.cell_mode, args.fit_range, args.binned, args.n_bins, args.force, args.dry_run)
+    return 1 if any("失败" in status.values() for status in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
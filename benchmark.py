@@ -0,0 +1,202 @@
+import os
+import io
+import sys
+import json
+import time
+import socket
+import resource
+import platform
+import subprocess
+import contextlib
+import multiprocessing
+from queue import Empty
+
+from synth_clog import generate_clog
+from metrics import peak_rss_mb
+
+# 整条分析链的规模基准：用 synth_clog 生成 10^4 - 10^7 个 Frame 的合成 .clog（按参数缓存，不重复生成），
+# 依次计时 convert → 两个去荧光脚本 → 融合 pipeline → 画图 → 出图，每个阶段在单独的进程中运行以记录该阶段的峰值内存。
+# 每个阶段一条记录，以 JSON lines 追加到 history_file，check_regressions 与同一机器上以前的记录比较
+DEFAULT_SIZES = (10**4, 10**5, 10**6, 10**7)
+DEFAULT_GENERATOR = {"clusters_per_frame": 1.5, "cells_per_cluster": 3.0, "flu_fraction": 0.3}
+
+
+def _stage_convert(ctx):
+    from convert_clog_to_root import convert_clog_to_root
+    convert_clog_to_root(ctx["clog"], ctx["root"], chunk_frames=ctx["chunk_frames"], n_workers=ctx["n_workers"])
+
+
+def _stage_remove_min(ctx):
+    from analyze_remove_flu import analyze_root
+    analyze_root(ctx["root"], n_workers=ctx["n_workers"], step_size=ctx["step_size"])
+
+
+def _stage_remove_all(ctx):
+    from new_remove_flu__and_save_root import analyze_and_save_root
+    analyze_and_save_root(ctx["root"], ctx["prefix"] + "_updated.root", step_size=ctx["step_size"],
+                          n_workers=ctx["n_workers"])
+
+
+def _stage_pipeline(ctx):
+    from clog_pipeline import run_pipeline
+    run_pipeline(ctx["clog"], ctx["prefix"] + "_pipeline.root", chunk_frames=ctx["chunk_frames"],
+                 n_workers=ctx["n_workers"])
+
+
+def _stage_plots(ctx):
+    from draw_under40_plot import analyze_and_save_plots
+    analyze_and_save_plots(ctx["root"], step_size=ctx["step_size"], hist_file=ctx["prefix"] + "_plots.npz",
+                           all_plots=True)
+
+
+def _stage_render(ctx):
+    from render import render_run
+    render_run(ctx["prefix"] + "_plots.npz", force=True)
+
+
+# 阶段名 -> 函数，按顺序运行（后面的阶段使用前面阶段的输出）
+STAGES = {
+    "convert": _stage_convert,
+    "remove_min": _stage_remove_min,
+    "remove_all": _stage_remove_all,
+    "pipeline": _stage_pipeline,
+    "plots": _stage_plots,
+    "render": _stage_render,
+}
+
+
+def _run_stage(name, ctx, queue):
+    # 子进程：在工作目录中运行一个阶段（各脚本的输出图片写到当前目录），返回耗时和本进程的峰值内存
+    os.chdir(ctx["work_dir"])
+    import matplotlib
+    matplotlib.use("Agg")
+    out = io.StringIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        STAGES[name](ctx)
+    seconds = time.perf_counter() - t0
+    scale = 1 if sys.platform == "darwin" else 1024
+    children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1024**2
+    queue.put({"seconds": seconds, "peak_rss_mb": peak_rss_mb(), "worker_peak_rss_mb": children_mb})
+
+
+def _wait_result(process, queue):
+    # 等待阶段子进程的结果；子进程异常退出（如内存不足被杀）时返回 None，不会一直阻塞
+    while True:
+        try:
+            result = queue.get(timeout=1.0)
+            break
+        except Empty:
+            if not process.is_alive():
+                result = None
+                break
+    process.join()
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def synthetic_clog(work_dir, n_frames, seed=0, **generator):
+    # 生成（或复用已生成的）合成 .clog，文件名包含全部生成参数
+    params = {**DEFAULT_GENERATOR, **generator}
+    tag = "_".join(f"{params[k]:g}" for k in sorted(params))
+    path = os.path.join(work_dir, f"synth_{n_frames}_s{seed}_{tag}.clog")
+    summary_path = path + ".json"
+    if os.path.exists(path) and os.path.exists(summary_path):
+        with open(summary_path) as f:
+            return path, json.load(f)
+    summary = generate_clog(path, n_frames, seed=seed, **params)
+    with open(summary_path, "w") as f:
+        json.dump(summary, f)
+    return path, summary
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, stages=None, work_dir="./bench", history_file="./bench_history.jsonl",
+                  n_workers=1, chunk_frames=100000, step_size="200 MB", seed=0, keep_outputs=False, **generator):
+    # 对每个规模运行全部（或 stages 指定的）阶段，打印并追加记录到 history_file，返回本次的记录
+    os.makedirs(work_dir, exist_ok=True)
+    work_dir = os.path.abspath(work_dir)
+    stages = list(stages or STAGES)
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    common = {"run_id": run_id, "commit": _git_commit(), "host": socket.gethostname(), "python": platform.python_version(),
+              "n_workers": n_workers, "chunk_frames": chunk_frames, "step_size": step_size, "seed": seed,
+              "generator": {**DEFAULT_GENERATOR, **generator}}
+    ctx_spawn = multiprocessing.get_context("spawn")  # 新进程，峰值内存只含该阶段
+    records = []
+    print(f"{'Frame数':>10}{'阶段':>12}{'耗时(s)':>10}{'Frame/s':>12}{'MB/s':>9}{'峰值内存(MB)':>14}")
+    for n_frames in sizes:
+        clog, summary = synthetic_clog(work_dir, n_frames, seed, **generator)
+        prefix = os.path.splitext(clog)[0]
+        ctx = {"work_dir": work_dir, "clog": clog, "root": prefix + ".root", "prefix": prefix,
+               "n_workers": n_workers, "chunk_frames": chunk_frames, "step_size": step_size}
+        for name in stages:
+            queue = ctx_spawn.Queue()
+            process = ctx_spawn.Process(target=_run_stage, args=(name, ctx, queue))
+            process.start()
+            result = _wait_result(process, queue)
+            if result is None or process.exitcode != 0:
+                raise RuntimeError(f"基准阶段 {name} 失败（{n_frames} 个 Frame，exitcode={process.exitcode}）")
+            record = {**common, "stage": name, "n_frames": n_frames, "n_clusters": summary["n_clusters"],
+                      "n_cells": summary["n_cells"], "clog_mb": summary["bytes"] / 1024**2, **result,
+                      "frames_per_s": n_frames / result["seconds"],
+                      "clog_mb_per_s": summary["bytes"] / 1024**2 / result["seconds"]}
+            records.append(record)
+            print(f"{n_frames:>10}{name:>12}{record['seconds']:>10.2f}{record['frames_per_s']:>12.0f}"
+                  f"{record['clog_mb_per_s']:>9.1f}{max(record['peak_rss_mb'], record['worker_peak_rss_mb']):>14.0f}")
+        if not keep_outputs:
+            for path in os.listdir(work_dir):
+                full = os.path.join(work_dir, path)
+                if full.startswith(prefix) and not full.startswith(clog):
+                    os.remove(full)
+
+    with open(history_file, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"基准结果已追加到: {history_file}")
+    return records
+
+
+def load_history(history_file="./bench_history.jsonl"):
+    with open(history_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_regressions(history_file="./bench_history.jsonl", threshold=0.2, run_id=None):
+    # 把某次运行（默认最近一次）与同一机器、同一参数下以前的最好结果比较，
+    # 耗时或峰值内存超过 (1 + threshold) 倍的记为回归，返回回归列表
+    history = load_history(history_file) if os.path.exists(history_file) else []
+    if not history:
+        print(f"没有基准历史记录: {history_file}")
+        return []
+    run_id = run_id or history[-1]["run_id"]
+    current = [r for r in history if r["run_id"] == run_id]
+
+    def config(r):
+        return (r["host"], r["stage"], r["n_frames"], r["n_workers"], r["chunk_frames"], r["step_size"],
+                json.dumps(r["generator"], sort_keys=True))
+
+    regressions = []
+    for r in current:
+        previous = [p for p in history if p["run_id"] < run_id and config(p) == config(r)]
+        if not previous:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            best = min(p[metric] for p in previous)
+            if r[metric] > best * (1 + threshold):
+                regressions.append({"stage": r["stage"], "n_frames": r["n_frames"], "metric": metric,
+                                    "value": r[metric], "best": best})
+                print(f"回归: {r['stage']} ({r['n_frames']} 个 Frame) {metric} = {r[metric]:.2f}，以前最好 {best:.2f}")
+    if not regressions:
+        print(f"运行 {run_id} 没有超过 {threshold:.0%} 的回归")
+    return regressions
+
+
+if __name__ == "__main__":
+    run_benchmark()
+    check_regressions()
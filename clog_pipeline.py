@@ -0,0 +1,146 @@
+import os
+import multiprocessing
+import numpy as np
+import matplotlib.pyplot as plt
+
+import metrics
+from tree_writer import build_tree_branches, write_branches, open_output
+from convert_clog_to_root import parse_buffers, iter_chunks, find_frame_offsets
+from flu_merge import merge_flu
+from histograms import Hist1D, PixelMap, SizeSpectra, N_PIXELS, cell_cluster_mask, save_histograms
+
+
+def new_histograms():
+    # 流水线填充的直方图：清理后的 cluster 能谱、按 cluster 大小分开的能谱、cell 像素图
+    return {
+        "spectrum": Hist1D(100, 0, 500),
+        "size_spectra": SizeSpectra(10, 100, 0, 500),
+        "pixel_map": PixelMap(N_PIXELS),
+    }
+
+
+def _process_buffer(buf, write_raw, branch_dtypes, energy_max, n_cells_max, window, map_energy_max):
+    # 一块 Frame：解析 -> （可选）原始分支 -> 去荧光 -> 清理后的分支 + 能谱 + 2D 图，全程为扁平 NumPy 缓冲
+    with metrics.stage("parse", events=len(buf["event_id"]), clusters=len(buf["lines"])):
+        events, clusters, cells, n_clusters, n_cells = parse_buffers(buf)
+    raw_branches = None
+    if write_raw:
+        raw_branches = build_tree_branches(events, clusters, cells, n_clusters, n_cells, dtypes=branch_dtypes)
+    (new_events, new_clusters, new_cells, new_n_clusters, new_n_cells,
+     discarded, merged) = merge_flu(events, clusters, cells, n_clusters, n_cells,
+                                    energy_max=energy_max, n_cells_max=n_cells_max, window=window)
+    branches = build_tree_branches(new_events, new_clusters, new_cells, new_n_clusters, new_n_cells,
+                                   dtypes=branch_dtypes)
+
+    hists = new_histograms()
+    with metrics.stage("fill", events=len(new_n_clusters), clusters=len(new_clusters["cluster_energy"])):
+        hists["spectrum"].fill(new_clusters["cluster_energy"])
+        hists["size_spectra"].fill(new_clusters["cluster_energy"], new_clusters["cluster_n_cells"])
+        # 2D 图只统计能量 < map_energy_max 的 cluster 的 cell（None 时统计全部）
+        mask = slice(None)
+        if map_energy_max is not None:
+            mask = cell_cluster_mask(new_clusters["cluster_energy"] < map_energy_max, new_n_clusters, new_n_cells,
+                                     new_cells["cell_cluster_id"])
+        hists["pixel_map"].fill(new_cells["cell_x"][mask], new_cells["cell_y"][mask], new_cells["cell_E"][mask])
+    return (raw_branches, branches, hists, discarded, merged,
+            len(new_clusters["cluster_energy"]), float(np.sum(new_clusters["cluster_energy"])))
+
+
+def _process_range(args):
+    # 进程池任务：解析并清理 [start, end) 字节区间内的全部 Frame
+    input_file, start, end, options = args
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        bufs = list(iter_chunks(f, end))
+    return _process_buffer(bufs[0], *options) if bufs else None
+
+
+def run_pipeline(input_file, output_file, raw_output_file=None, hist_file=None, plot_file=None,
+                 chunk_frames=None, chunk_mb=None, n_workers=1, shard_mb=64,
+                 energy_max=30, n_cells_max=2, window=10, map_energy_max=None,
+                 compression=None, branch_dtypes=None, basket_entries=None):
+    # 单遍流水线：.clog -> 解析 -> 去荧光（与 analyze_and_save_root 相同的规则）-> 写出清理后的 Tree，
+    # 中间不经过磁盘上的 ROOT 文件，也不再读回 awkward 数组。
+    # raw_output_file：同时写出未清理的 Tree（与 convert_clog_to_root 的输出相同）
+    # hist_file：能谱、按大小分开的能谱和像素图（见 new_histograms）用 histograms.save_histograms 保存，
+    # 默认 <output_file 去扩展名>_hists.npz，多个 run 的结果可用 histograms.load_merged 合并
+    # plot_file：能谱 + 总能量图 + 平均能量图，默认 <output_file 去扩展名>_hists.png
+    # chunk_frames / chunk_mb / n_workers / shard_mb / compression / branch_dtypes / basket_entries 同 convert_clog_to_root
+    base = os.path.splitext(output_file)[0]
+    hist_file = hist_file or base + "_hists.npz"
+    plot_file = plot_file or base + "_hists.png"
+    options = (raw_output_file is not None, branch_dtypes, energy_max, n_cells_max, window, map_energy_max)
+    chunk_bytes = chunk_mb * 1024 * 1024 if chunk_mb else None
+
+    def results():
+        if n_workers > 1:
+            n_shards = max(n_workers, os.path.getsize(input_file) // (shard_mb * 1024 * 1024) + 1)
+            offsets = find_frame_offsets(input_file, n_shards)
+            ranges = [(input_file, a, b, options) for a, b in zip(offsets[:-1], offsets[1:])]
+            with multiprocessing.Pool(n_workers) as pool:
+                for result in metrics.imap(pool, _process_range, ranges):
+                    if result is not None:
+                        yield result
+        else:
+            with open(input_file, 'rb') as f:
+                chunks = iter_chunks(f, chunk_frames=chunk_frames, chunk_bytes=chunk_bytes)
+                for buf in metrics.timed_iter("scan", chunks, events=lambda buf: len(buf["event_id"])):
+                    yield _process_buffer(buf, *options)
+
+    hists = new_histograms()
+    discarded_events = 0  # 抛弃事件计数
+    merged_clusters = 0   # 合并次数
+    n_new_clusters = 0    # 新cluster总数
+    sum_new_energy = 0.0
+
+    raw_file = open_output(raw_output_file, compression) if raw_output_file is not None else None
+    try:
+        with open_output(output_file, compression) as file:
+            for raw_branches, branches, chunk_hists, discarded, merged, n_new, energy in results():
+                if raw_file is not None:
+                    write_branches(raw_file, raw_branches, basket_entries=basket_entries)
+                write_branches(file, branches, basket_entries=basket_entries)
+                for name, hist in chunk_hists.items():
+                    hists[name] += hist
+                discarded_events += discarded
+                merged_clusters += merged
+                n_new_clusters += n_new
+                sum_new_energy += energy
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+
+    save_histograms(hist_file, hists)
+    print(f"抛弃事件数: {discarded_events}")
+    print(f"合并cluster次数: {merged_clusters}")
+    print(f"清理后的ROOT文件已保存: {output_file}" + (f"，原始ROOT文件: {raw_output_file}" if raw_file else ""))
+    print(f"能谱和2D图已保存: {hist_file}")
+
+    with metrics.stage("plot"):
+        fig, axes = plt.subplots(1, 3, figsize=(20, 6))
+        axes[0].stairs(hists["spectrum"].counts, hists["spectrum"].edges, fill=True, alpha=0.7, color='blue')
+        axes[0].set_xlabel('New Cluster Energy (keV)')
+        axes[0].set_ylabel('Counts')
+        axes[0].set_title('New Cluster Energies After Filtering and Merging')
+        axes[0].grid(True, alpha=0.3)
+        for ax, image, cmap, label, title in (
+                (axes[1], hists["pixel_map"].sum, 'hot', 'Total Accumulated Energy (keV)', '2D Total Energy Map'),
+                (axes[2], hists["pixel_map"].mean(), 'viridis', 'Mean Energy per Hit (keV)', '2D Average Energy Map')):
+            im = ax.imshow(image.T, origin='lower', extent=[0, N_PIXELS, 0, N_PIXELS], cmap=cmap, aspect='auto')
+            fig.colorbar(im, ax=ax, label=label)
+            ax.set_title(title)
+            ax.set_xlabel("X-pixel")
+            ax.set_ylabel("Y-pixel")
+        fig.savefig(plot_file, dpi=150, bbox_inches='tight')
+        plt.close(fig)
+    print(f"分布图已保存为: {plot_file}")
+    mean_energy = sum_new_energy / n_new_clusters if n_new_clusters else float("nan")
+    print(f"新cluster总数: {n_new_clusters}, 平均能量: {mean_energy:.2f} keV")
+    metrics.count("discarded_events", discarded_events)
+    metrics.count("merged_clusters", merged_clusters)
+    metrics.count("new_clusters", n_new_clusters)
+    metrics.flush("run_pipeline")
+
+
+if __name__ == "__main__":
+    run_pipeline("./Am_600s.clog", "./Am_600s_updated.root", raw_output_file="./Am_600s.root")
@@ -0,0 +1,282 @@
+import os
+import re
+import sys
+import json
+import shutil
+import uproot
+import awkward as ak
+import numpy as np
+
+import metrics
+from tree_writer import EVENT_BRANCHES, CLUSTER_BRANCHES, CELL_BRANCHES, flatten_tree_arrays
+
+# Tree 的列式缓存：每个分支一个不压缩的扁平 .npy（Event 级长度为事件数，Cluster / Cell 级为全部 cluster / cell
+# 首尾相接），外加 cluster_offsets.npy / cell_offsets.npy（int64，长度为事件数 + 1，第 i 个事件的 cluster 为
+# [offsets[i], offsets[i + 1])），放在 <root 文件去扩展名>_cols/ 下，manifest.json 记录源文件的大小和修改时间。
+# 读取时用 np.load(mmap_mode="r") 映射，不解压、不复制：按块切片只是视图，jagged 分支直接由 offsets + 扁平缓冲
+# 组装成 awkward 数组，与 uproot 的 tree.iterate / tree.arrays 结果相同，分析脚本无需改动处理代码。
+# 源文件改动过（大小或修改时间不同）或缺少所需分支时视为没有缓存，自动回到 uproot 读取
+#
+#   build_cache("./run.root")                              # 一次性建立（或 python columnar_cache.py run.root ...）
+#   for data in iterate("./run.root", ["cluster_energy"], step_size="200 MB"):
+#       ...
+CACHE_VERSION = 1
+MANIFEST = "manifest.json"
+# 分支级别 -> 各级的分支名 / 计数所用的 offsets 文件
+LEVELS = {
+    "event": (tuple(EVENT_BRANCHES), None),
+    "cluster": (tuple(CLUSTER_BRANCHES), "cluster_offsets"),
+    "cell": (tuple(CELL_BRANCHES), "cell_offsets"),
+}
+_UNITS = {"": 1, "b": 1, "kb": 1000, "mb": 1000**2, "gb": 1000**3, "kib": 1024, "mib": 1024**2, "gib": 1024**3}
+
+
+def cache_dir(root_file):
+    return os.path.splitext(root_file)[0] + "_cols"
+
+
+def _source_stamp(root_file):
+    st = os.stat(root_file)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+class _NpyWriter:
+    # 逐块追加写一个一维 .npy：先写占位文件头，关闭时按最终长度重写（numpy 为长度预留了位数，文件头长度不变）
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.dtype = None
+        self.length = 0
+        self.header_size = None
+
+    def _header(self):
+        f = self.f
+        f.seek(0)
+        np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(self.dtype),
+                                                 "fortran_order": False, "shape": (self.length,)})
+        return f.tell()
+
+    def append(self, array):
+        array = np.ascontiguousarray(array)
+        if self.dtype is None:
+            self.dtype = array.dtype
+            self.header_size = self._header()
+        elif array.dtype != self.dtype:
+            array = array.astype(self.dtype)
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(array.tobytes())
+        self.length += len(array)
+
+    def close(self, dtype=np.float64):
+        if self.dtype is None:  # 空 Tree
+            self.dtype = np.dtype(dtype)
+            self.header_size = self._header()
+        if self._header() != self.header_size:
+            raise RuntimeError(f"{self.path} 的文件头长度变化，无法原地重写")
+        self.f.close()
+
+
+def _tree_levels(tree):
+    # Tree 中实际存在的分支（按级别），如 cell_mode="skip" 的输出没有 cell 分支
+    keys = set(tree.keys())
+    return {level: [name for name in names if name in keys] for level, (names, _) in LEVELS.items()}
+
+
+def build_cache(root_file, out_dir=None, step_size="200 MB"):
+    # 逐块读入 Tree 的全部分支写成列式缓存（内存不随数据量增长），先写到临时目录，完成后替换旧缓存；返回缓存目录
+    out_dir = out_dir or cache_dir(root_file)
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    stamp = _source_stamp(root_file)
+    with uproot.open(root_file) as f:
+        tree = f["Tree"]
+        levels = {level: names for level, names in _tree_levels(tree).items() if names}
+        branches = [name for names in levels.values() for name in names]
+        writers = {name: _NpyWriter(os.path.join(tmp_dir, name + ".npy")) for name in branches}
+        offsets = {LEVELS[level][1]: _NpyWriter(os.path.join(tmp_dir, LEVELS[level][1] + ".npy"))
+                   for level in levels if level != "event"}
+        totals = dict.fromkeys(offsets, 0)
+        for writer in offsets.values():
+            writer.append(np.zeros(1, dtype=np.int64))
+        n_events = 0
+        chunks = tree.iterate(branches, step_size=step_size)
+        for data in metrics.timed_iter("read", chunks, events=len):
+            with metrics.stage("cache_write", events=len(data)):
+                for level, names in levels.items():
+                    if level != "event":
+                        counts = ak.to_numpy(ak.num(data[names[0]])).astype(np.int64)
+                        key = LEVELS[level][1]
+                        offsets[key].append(totals[key] + np.cumsum(counts))
+                        totals[key] += int(counts.sum())
+                    for name in names:
+                        column = data[name] if level == "event" else ak.flatten(data[name])
+                        writers[name].append(ak.to_numpy(column))
+                n_events += len(data)
+        for name, writer in writers.items():
+            writer.close({**EVENT_BRANCHES, **CLUSTER_BRANCHES, **CELL_BRANCHES}[name])
+        for writer in offsets.values():
+            writer.close(np.int64)
+
+    manifest = {"version": CACHE_VERSION, "source": os.path.basename(root_file), **stamp, "n_events": n_events,
+                "levels": levels, **{key: total for key, total in totals.items()}}
+    with open(os.path.join(tmp_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+class ColumnarCache:
+    # 映射后的缓存：columns 为分支名 -> 扁平 memmap，offsets 为 "cluster" / "cell" -> int64 offsets（长度 n_events + 1）
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.num_entries = manifest["n_events"]
+        self.level = {name: level for level, names in manifest["levels"].items() for name in names}
+        self.columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in self.level}
+        self.offsets = {level: np.load(os.path.join(path, LEVELS[level][1] + ".npy"), mmap_mode="r")
+                        for level in manifest["levels"] if level != "event"}
+
+    def keys(self):
+        return list(self.level)
+
+    def arrays(self, branches, entry_start=None, entry_stop=None):
+        # 与 tree.arrays(branches, entry_start, entry_stop) 相同的 awkward record array；
+        # jagged 分支的 offsets 是全局 offsets 的切片（不必从 0 开始），content 为整个扁平缓冲，均不复制
+        start = 0 if entry_start is None else max(entry_start, 0)
+        stop = self.num_entries if entry_stop is None else min(entry_stop, self.num_entries)
+        stop = max(stop, start)
+        fields = {}
+        for name in branches:
+            column = np.asarray(self.columns[name])
+            level = self.level[name]
+            if level == "event":
+                fields[name] = ak.contents.NumpyArray(column[start:stop])
+            else:
+                offsets = ak.index.Index64(np.asarray(self.offsets[level][start:stop + 1]))
+                fields[name] = ak.contents.ListOffsetArray(offsets, ak.contents.NumpyArray(column))
+        return ak.Array(ak.contents.RecordArray(list(fields.values()), list(fields), length=stop - start))
+
+    def flat(self, branches, entry_start=None, entry_stop=None):
+        # 与 flatten_tree_arrays(self.arrays(branches, ...)) 相同的扁平缓冲 (events, clusters, cells, n_clusters, n_cells)，
+        # 但直接切 memmap（不经 awkward 组装再拆开，不复制）；branches 中没有 cell 分支时 cells / n_cells 为 None
+        start = 0 if entry_start is None else max(entry_start, 0)
+        stop = self.num_entries if entry_stop is None else min(entry_stop, self.num_entries)
+        stop = max(stop, start)
+        out = {}
+        for level in ("event", "cluster", "cell"):
+            names = [name for name in branches if self.level[name] == level]
+            if level == "event":
+                lo, hi = start, stop
+            elif names:
+                lo, hi = int(self.offsets[level][start]), int(self.offsets[level][stop])
+            out[level] = {name: np.asarray(self.columns[name][lo:hi]) for name in names} if names else None
+        counts = {level: np.diff(np.asarray(self.offsets[level][start:stop + 1])) if out[level] is not None else None
+                  for level in ("cluster", "cell")}
+        return out["event"], out["cluster"], out["cell"], counts["cluster"], counts["cell"]
+
+    def step_entries(self, branches, step_size):
+        # step_size 为事件数或 "200 MB" 这样的数据量（按所选分支的平均每事件字节数换算）
+        if step_size is None:
+            return max(self.num_entries, 1)
+        if not isinstance(step_size, str):
+            return max(int(step_size), 1)
+        match = re.fullmatch(r"\s*([0-9.]+)\s*([a-zA-Z]*)\s*", step_size)
+        if match is None or match.group(2).lower() not in _UNITS:
+            raise ValueError(f"无法解析的 step_size: {step_size!r}")
+        size = float(match.group(1)) * _UNITS[match.group(2).lower()]
+        nbytes = sum(self.columns[name].nbytes for name in branches)
+        nbytes += sum(offsets.nbytes for level, offsets in self.offsets.items()
+                      if any(self.level[name] == level for name in branches))
+        per_event = nbytes / max(self.num_entries, 1)
+        return max(int(size / per_event) if per_event else self.num_entries, 1)
+
+    def iterate(self, branches, step_size="200 MB"):
+        step = self.step_entries(branches, step_size)
+        for start in range(0, self.num_entries, step):
+            yield self.arrays(branches, start, start + step)
+
+
+def open_cache(root_file, path=None):
+    # 打开 root_file 的缓存；没有缓存、版本不同或源文件已改动时返回 None
+    path = path or cache_dir(root_file)
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        stamp = _source_stamp(root_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != CACHE_VERSION or any(manifest.get(key) != value for key, value in stamp.items()):
+        return None
+    return ColumnarCache(path, manifest)
+
+
+def _usable(root_file, branches, use_cache):
+    cache = open_cache(root_file) if use_cache else None
+    if cache is not None and all(name in cache.level for name in branches):
+        return cache
+    return None
+
+
+def step_entries(root_file, branches, step_size, tree=None, use_cache=True):
+    # 按事件范围切块（进程池任务）时每块的事件数：step_size 为事件数时直接使用，为 "200 MB" 这样的数据量时
+    # 按所选分支的每事件字节数换算（有可用的缓存时按缓存的扁平缓冲，否则用 uproot 对 Tree 的估计）
+    if not isinstance(step_size, str):
+        return max(int(step_size), 1)
+    cache = _usable(root_file, branches, use_cache)
+    if cache is not None:
+        return cache.step_entries(branches, step_size)
+    if tree is not None:
+        return max(tree.num_entries_for(step_size, branches), 1)
+    with uproot.open(root_file) as f:
+        return max(f["Tree"].num_entries_for(step_size, branches), 1)
+
+
+def iterate(root_file, branches, step_size="200 MB", tree=None, use_cache=True):
+    # 代替 tree.iterate(branches, step_size)：有可用的缓存时从缓存逐块产出，否则用 uproot 读取
+    # （tree 为已打开的 Tree 时直接使用，否则打开 root_file）
+    cache = _usable(root_file, branches, use_cache)
+    if cache is not None:
+        yield from cache.iterate(branches, step_size)
+    elif tree is not None:
+        yield from tree.iterate(branches, step_size=step_size)
+    else:
+        with uproot.open(root_file) as f:
+            yield from f["Tree"].iterate(branches, step_size=step_size)
+
+
+def arrays(root_file, branches, entry_start=None, entry_stop=None, use_cache=True):
+    # 代替 tree.arrays(branches, entry_start=..., entry_stop=...)（进程池任务按事件范围读取）
+    cache = _usable(root_file, branches, use_cache)
+    if cache is not None:
+        return cache.arrays(branches, entry_start, entry_stop)
+    with uproot.open(root_file) as f:
+        return f["Tree"].arrays(branches, entry_start=entry_start, entry_stop=entry_stop)
+
+
+
+def iterate_flat(root_file, branches, step_size="200 MB", tree=None, use_cache=True):
+    # 代替 flatten_tree_arrays 逐块处理 iterate 的结果：有可用的缓存时直接产出扁平缓冲（ColumnarCache.flat）
+    cache = _usable(root_file, branches, use_cache)
+    if cache is not None:
+        step = cache.step_entries(branches, step_size)
+        for start in range(0, cache.num_entries, step):
+            yield cache.flat(branches, start, start + step)
+    else:
+        for data in iterate(root_file, branches, step_size, tree=tree, use_cache=False):
+            yield flatten_tree_arrays(data)
+
+
+def flat(root_file, branches, entry_start=None, entry_stop=None, use_cache=True):
+    # 代替 flatten_tree_arrays(arrays(...))（进程池任务按事件范围读取）
+    cache = _usable(root_file, branches, use_cache)
+    if cache is not None:
+        return cache.flat(branches, entry_start, entry_stop)
+    return flatten_tree_arrays(arrays(root_file, branches, entry_start, entry_stop, use_cache=False))
+
+if __name__ == "__main__":
+    for root_file in sys.argv[1:] or ["./TEST-14000-ENERGY.root"]:
+        print(f"列式缓存已写出: {build_cache(root_file)}")
@@ -0,0 +1,67 @@
+import os
+import time
+import uproot
+import numpy as np
+
+from tree_writer import (EVENT_BRANCHES, CLUSTER_BRANCHES, CELL_BRANCHES, COMPACT_DTYPES,
+                         build_tree_branches, flatten_tree_arrays, write_branches, open_output)
+
+# 待比较的输出选项：压缩算法/级别、分支类型、每个 basket 的 Event 数
+DEFAULT_CONFIGS = [
+    {"name": "zlib-1 (uproot默认)"},
+    {"name": "zlib-6", "compression": ("zlib", 6)},
+    {"name": "lzma-6", "compression": ("lzma", 6)},
+    {"name": "lz4-1", "compression": ("lz4", 1)},
+    {"name": "zstd-5", "compression": ("zstd", 5)},
+    {"name": "compact + zlib-1", "compression": ("zlib", 1), "branch_dtypes": COMPACT_DTYPES},
+    {"name": "compact + lz4-1", "compression": ("lz4", 1), "branch_dtypes": COMPACT_DTYPES},
+    {"name": "compact + zstd-5", "compression": ("zstd", 5), "branch_dtypes": COMPACT_DTYPES},
+    {"name": "compact + zstd-5, 100k/basket", "compression": ("zstd", 5), "branch_dtypes": COMPACT_DTYPES,
+     "basket_entries": 100000},
+]
+
+
+def compare_output_options(input_root, configs=DEFAULT_CONFIGS, out_dir="./output_options"):
+    # 读入一次输入 Tree，按每种选项分别写出，统计文件大小和读/写吞吐（以未压缩的内存数据量计）
+    with uproot.open(input_root) as file:
+        data = file["Tree"].arrays([*EVENT_BRANCHES, *CLUSTER_BRANCHES, *CELL_BRANCHES])
+
+    events, clusters, cells, n_clusters, n_cells = flatten_tree_arrays(data)
+    raw_mb = sum(a.nbytes for part in (events, clusters, cells) for a in part.values()) / 1024**2
+    print(f"输入: {input_root}，事件数: {len(n_clusters)}，未压缩数据量: {raw_mb:.1f} MB")
+
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+    for i, config in enumerate(configs):
+        path = os.path.join(out_dir, f"option_{i}.root")
+        t0 = time.perf_counter()
+        branches = build_tree_branches(events, clusters, cells, n_clusters, n_cells,
+                                       dtypes=config.get("branch_dtypes"))
+        with open_output(path, config.get("compression")) as out:
+            write_branches(out, branches, basket_entries=config.get("basket_entries"))
+        write_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with uproot.open(path) as file:
+            file["Tree"].arrays([*EVENT_BRANCHES, *CLUSTER_BRANCHES, *CELL_BRANCHES])
+        read_s = time.perf_counter() - t0
+
+        results.append({
+            "name": config["name"],
+            "file": path,
+            "size_mb": os.path.getsize(path) / 1024**2,
+            "write_s": write_s,
+            "read_s": read_s,
+            "write_mb_s": raw_mb / write_s,
+            "read_mb_s": raw_mb / read_s,
+        })
+
+    print(f"{'选项':<32}{'大小(MB)':>10}{'写(s)':>9}{'写(MB/s)':>10}{'读(s)':>9}{'读(MB/s)':>10}")
+    for r in results:
+        print(f"{r['name']:<32}{r['size_mb']:>10.2f}{r['write_s']:>9.2f}{r['write_mb_s']:>10.1f}"
+              f"{r['read_s']:>9.2f}{r['read_mb_s']:>10.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    compare_output_options("./TEST-14000-ENERGY.root")
@@ -1,146 +1,371 @@
 import uproot
 import numpy as np
 import re
-import awkward as ak
-
-def convert_clog_to_root(input_file, output_file):
-    # Event 级
-    event_ids, event_times = [], []
-    
-    # Cluster 级 (每个 Event 一个列表)
-    all_cluster_indices = []
-    all_cluster_n_cells = []
-    all_cluster_sum_E = []  # 新增：Cluster 总能量
-    
-    # 新增：Cluster 加权位置和平均T
-    all_cluster_weighted_x = []
-    all_cluster_weighted_y = []
-    all_cluster_avg_t = []
-    
-    # Cell 级 (Event -> 所有 Cells 的扁平化列表)
-    # 这样可以避开 var * var * float 的报错，同时保持数据完整
-    all_cell_x, all_cell_y, all_cell_E, all_cell_T = [], [], [], []
-    all_cell_cluster = []  # 新增：每个 Cell 所属的 Cluster ID
-
-    frame_re = re.compile(r"Frame\s+(\d+)\s+\(([\d.]+),")
-    cell_re = re.compile(r"\[([\d.-]+),\s*([\d.-]+),\s*([\d.-]+),\s*([\d.-]+)\]")
-
-    curr_event_id, curr_event_time = None, None
-    
-    # 暂存当前 Event 的数据
-    c_idx, c_n, c_sum_e = [], [], []
-    cw_x, cw_y, avg_t_list = [], [], []  # 新增：暂存当前 Event 的 weighted_x/y 和 avg_t
-    cx, cy, ce, ct = [], [], [], []
-    cc = []  # 新增：当前 Event 的 cell_cluster 暂存
-    
-    cluster_counter = 0
-
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line: continue
-            
-            frame_match = frame_re.match(line)
-            if frame_match:
-                if curr_event_id is not None:
-                    event_ids.append(curr_event_id)
-                    event_times.append(curr_event_time)
-                    all_cluster_indices.append(c_idx)
-                    all_cluster_n_cells.append(c_n)
-                    all_cluster_sum_E.append(c_sum_e)
-                    all_cluster_weighted_x.append(cw_x)  # 新增：保存当前 Event 的 weighted_x
-                    all_cluster_weighted_y.append(cw_y)  # 新增：保存当前 Event 的 weighted_y
-                    all_cluster_avg_t.append(avg_t_list)  # 新增：保存当前 Event 的 avg_t
-                    all_cell_x.append(cx)
-                    all_cell_y.append(cy)
-                    all_cell_E.append(ce)
-                    all_cell_T.append(ct)
-                    all_cell_cluster.append(cc)  # 新增：保存当前 Event 的 cell_cluster
-
-                curr_event_id = int(frame_match.group(1))
-                curr_event_time = float(frame_match.group(2))
-                c_idx, c_n, c_sum_e = [], [], []
-                cw_x, cw_y, avg_t_list = [], [], []  # 新增：重置当前 Event 的 weighted_x/y 和 avg_t
-                cx, cy, ce, ct = [], [], [], []
-                cc = []  # 新增：重置当前 Event 的 cell_cluster
-                cluster_counter = 0
-            else:
-                cells = cell_re.findall(line)
-                if cells:
-                    row_energy_sum = 0
-                    count = 0
-                    weighted_x_num, weighted_y_num = 0.0, 0.0
-                    t_sum = 0.0
-                    for c in cells:
-                        val_x, val_y, val_e, val_t = float(c[0]), float(c[1]), float(c[2]), float(c[3])
-                        cx.append(val_x)
-                        cy.append(val_y)
-                        ce.append(val_e)
-                        ct.append(val_t)
-                        cc.append(cluster_counter)  # 新增：记录该 cell 所属 cluster ID
-                        row_energy_sum += val_e
-                        weighted_x_num += val_x * val_e
-                        weighted_y_num += val_y * val_e
-                        t_sum += val_t
-                        count += 1
-                    
-                    # 新增：计算 weighted_x/y 和 avg_t
-                    if count > 0:
-                        weighted_x = weighted_x_num / row_energy_sum if row_energy_sum > 0 else 0.0
-                        weighted_y = weighted_y_num / row_energy_sum if row_energy_sum > 0 else 0.0
-                        avg_t = t_sum / count
-                    else:
-                        weighted_x, weighted_y, avg_t = 0.0, 0.0, 0.0
-                    
-                    c_idx.append(cluster_counter)
-                    c_n.append(count)
-                    c_sum_e.append(row_energy_sum)
-                    cw_x.append(weighted_x)  # 新增：暂存 weighted_x
-                    cw_y.append(weighted_y)  # 新增：暂存 weighted_y
-                    avg_t_list.append(avg_t)  # 新增：暂存 avg_t
-                    cluster_counter += 1
-
-        # 保存最后一个
-        if curr_event_id is not None:
-            event_ids.append(curr_event_id)
-            event_times.append(curr_event_time)
-            all_cluster_indices.append(c_idx)
-            all_cluster_n_cells.append(c_n)
-            all_cluster_sum_E.append(c_sum_e)
-            all_cluster_weighted_x.append(cw_x)  # 新增：保存最后一个 Event 的 weighted_x
-            all_cluster_weighted_y.append(cw_y)  # 新增：保存最后一个 Event 的 weighted_y
-            all_cluster_avg_t.append(avg_t_list)  # 新增：保存最后一个 Event 的 avg_t
-            all_cell_x.append(cx)
-            all_cell_y.append(cy)
-            all_cell_E.append(ce)
-            all_cell_T.append(ct)
-            all_cell_cluster.append(cc)  # 新增：保存最后一个 Event 的 cell_cluster
-
-    # 写入 ROOT
-    # 使用 ak.Array 包装，uproot 会将其转为 vector<float> 和 vector<int>
-    with uproot.recreate(output_file) as file:
-        file["Tree"] = {
-            "event_id": np.array(event_ids, dtype=np.int32),
-            "event_time": np.array(event_times, dtype=np.float64),
-            
-            # Cluster 信息 (vector<int> / vector<float>)
-            "cluster_index": ak.Array(all_cluster_indices),
-            "cluster_n_cells": ak.Array(all_cluster_n_cells),
-            "cluster_energy": ak.Array(all_cluster_sum_E),
-            "cluster_weighted_x": ak.Array(all_cluster_weighted_x),  # 新增：加权X
-            "cluster_weighted_y": ak.Array(all_cluster_weighted_y),  # 新增：加权Y
-            "cluster_avg_t": ak.Array(all_cluster_avg_t),  # 新增：平均T
-            
-            # Cell 信息 (vector<float>)
-            # 这里存的是当前 Event 所有的 Cell，通过 cluster_n_cells 和 cell_cluster_id 来区分属于哪个 cluster
-            "cell_x": ak.Array(all_cell_x),
-            "cell_y": ak.Array(all_cell_y),
-            "cell_E": ak.Array(all_cell_E),
-            "cell_T": ak.Array(all_cell_T),
-            "cell_cluster_id": ak.Array(all_cell_cluster),  # 新增：每个 Cell 所属的 Cluster ID
-        }
+import os
+import multiprocessing
+
+import metrics
+from tree_writer import (EVENT_BRANCHES, CLUSTER_BRANCHES, CELL_BRANCHES, build_tree_branches,
+                         flatten_tree_arrays, write_branches, open_output)
+
+# 以二进制方式读取 .clog，便于记录每行的字节偏移
+frame_re = re.compile(rb"Frame\s+(\d+)\s+\(([\d.]+),")
+cell_re = re.compile(rb"\[([\d.-]+),\s*([\d.-]+),\s*([\d.-]+),\s*([\d.-]+)\]")
+
+def _new_buffers():
+    # Event 级数据 + 每个 Event 的 cluster 行数，cluster 行本身原样（bytes）暂存，
+    # 在 build_branches 中整块向量化解析
+    return {"event_id": [], "event_time": [], "n_clusters": [], "lines": []}
+
+
+def parse_cell_lines(lines):
+    # 把一组 cluster 行（每行若干个 "[x, y, E, T]"）一次性解析为 (N, 4) 的 float64 数组，
+    # 同时返回每行的 cell 数。去掉括号和逗号后整块交给 NumPy 做数值转换，不再逐个 float()
+    n_cells = np.fromiter((line.count(b"[") for line in lines), dtype=np.int64, count=len(lines))
+    tokens = b" ".join(lines).translate(None, b"[],").split()
+    if len(tokens) == 4 * n_cells.sum():
+        cells = np.array(tokens, dtype=np.float64).reshape(-1, 4)
+    else:
+        # 格式不规整（括号内不是 4 个数）时退回逐行正则，结果与旧解析一致
+        groups = [cell_re.findall(line) for line in lines]
+        n_cells = np.array([len(g) for g in groups], dtype=np.int64)
+        cells = np.array([c for g in groups for c in g], dtype=np.float64).reshape(-1, 4)
+    return cells, n_cells
+
+
+def cluster_branches(cell_x, cell_y, cell_E, cell_T, n_cells, n_clusters):
+    # 由按 cluster 依次排列的 cells（第 i 个 cluster 有 n_cells[i] 个）和每个 Event 的 cluster 数
+    # 计算 Cluster 级分支，返回 (clusters, cell_cluster_id)；recluster 重建 cluster 后也用它
+    # cell -> cluster 映射，按 cluster 做向量化归约（bincount 按顺序累加，与逐个累加结果一致）
+    n_total = len(n_cells)
+    cell_cluster = np.repeat(np.arange(n_total), n_cells)
+    sum_E = np.bincount(cell_cluster, weights=cell_E, minlength=n_total)
+    weighted_x_num = np.bincount(cell_cluster, weights=cell_x * cell_E, minlength=n_total)
+    weighted_y_num = np.bincount(cell_cluster, weights=cell_y * cell_E, minlength=n_total)
+    t_sum = np.bincount(cell_cluster, weights=cell_T, minlength=n_total)
+
+    # 能量和 <= 0 时加权位置记为 0，空 cluster 的 avg_t 记为 0
+    weighted_x = np.zeros(n_total)
+    weighted_y = np.zeros(n_total)
+    avg_t = np.zeros(n_total)
+    positive = sum_E > 0
+    np.divide(weighted_x_num, sum_E, out=weighted_x, where=positive)
+    np.divide(weighted_y_num, sum_E, out=weighted_y, where=positive)
+    np.divide(t_sum, n_cells, out=avg_t, where=n_cells > 0)
+
+    # 每个 Event 内 cluster 从 0 开始编号
+    event_start = np.cumsum(n_clusters) - n_clusters
+    cluster_index = np.arange(n_total) - np.repeat(event_start, n_clusters)
+    clusters = {
+        "cluster_index": cluster_index,
+        "cluster_n_cells": n_cells,
+        "cluster_energy": sum_E,
+        "cluster_weighted_x": weighted_x,
+        "cluster_weighted_y": weighted_y,
+        "cluster_avg_t": avg_t,
+    }
+    return clusters, cluster_index[cell_cluster]
+
+
+def parse_buffers(buf):
+    # 把一块缓存解析为扁平 NumPy 缓冲 + 每个 Event 的 cluster 数 / cell 数（tree_writer 的约定），
+    # 既可直接建 Tree 分支，也可先交给 flu_merge 等做处理（见 clog_pipeline）
+    n_clusters = np.array(buf["n_clusters"], dtype=np.int64)
+    cells, n_cells = parse_cell_lines(buf["lines"])
+    cell_x, cell_y, cell_E, cell_T = cells.T
+    if not n_cells.all():
+        # 解析不出任何 cell 的行不算 cluster（与旧的逐行正则一致）
+        event_of_line = np.repeat(np.arange(len(n_clusters)), n_clusters)
+        n_clusters = np.bincount(event_of_line[n_cells > 0], minlength=len(n_clusters))
+        n_cells = n_cells[n_cells > 0]
+
+    clusters, cell_cluster_id = cluster_branches(cell_x, cell_y, cell_E, cell_T, n_cells, n_clusters)
+    event_start = np.cumsum(n_clusters) - n_clusters
+    cell_offsets = np.concatenate([[0], np.cumsum(n_cells)])
+    cells_per_event = cell_offsets[event_start + n_clusters] - cell_offsets[event_start]
+
+    events = {"event_id": buf["event_id"], "event_time": buf["event_time"]}
+    # Cell 信息：当前 Event 所有的 Cell，通过 cluster_n_cells 和 cell_cluster_id 来区分属于哪个 cluster
+    cells = {
+        "cell_x": cell_x,
+        "cell_y": cell_y,
+        "cell_E": cell_E,
+        "cell_T": cell_T,
+        "cell_cluster_id": cell_cluster_id,
+    }
+    return events, clusters, cells, n_clusters, cells_per_event
+
+
+def build_branches(buf, dtypes=None):
+    with metrics.stage("parse", events=len(buf["event_id"]), clusters=len(buf["lines"])):
+        parsed = parse_buffers(buf)
+    return build_tree_branches(*parsed, dtypes=dtypes)
+
+
+def iter_chunks(f, end=None, chunk_frames=None, chunk_bytes=None):
+    # 从二进制文件对象 f 的当前位置开始逐行扫描，读到字节位置 end（不含）为止；
+    # 每累计 chunk_frames 个 Frame 或 chunk_bytes 字节就产出一块缓存。
+    # 这里只切分 Frame 和收集 cluster 行，数值解析留给 build_branches 整块完成
+    pos = f.tell()
+    buf = _new_buffers()
+    n_buffered_bytes = 0
+    in_frame = False
+
+    for line in f:
+        if end is not None and pos >= end:
+            break
+        pos += len(line)
+        n_buffered_bytes += len(line)
+        line = line.strip()
+        if not line: continue
+
+        frame_match = frame_re.match(line)
+        if frame_match:
+            # 达到块大小：产出已完成的 Frame 并清空缓存
+            n_buffered_frames = len(buf["event_id"])
+            if (chunk_frames and n_buffered_frames >= chunk_frames) or \
+                    (chunk_bytes and n_buffered_bytes >= chunk_bytes and n_buffered_frames):
+                yield buf
+                buf = _new_buffers()
+                n_buffered_bytes = len(line)
+
+            buf["event_id"].append(int(frame_match.group(1)))
+            buf["event_time"].append(float(frame_match.group(2)))
+            buf["n_clusters"].append(0)
+            in_frame = True
+        elif in_frame and b"[" in line:
+            buf["lines"].append(line)
+            buf["n_clusters"][-1] += 1
+
+    if buf["event_id"]:
+        yield buf
+
+
+def find_frame_offsets(input_file, n_shards):
+    # 把文件按字节大致等分为 n_shards 段，每个切分点向后对齐到下一个 "Frame N (t, ..." 行首，
+    # 返回升序的字节偏移列表（首尾为 0 和文件大小）
+    with open(input_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        offsets = [0]
+        for i in range(1, n_shards):
+            f.seek(size * i // n_shards)
+            f.readline()  # 跳过可能不完整的一行
+            pos = f.tell()
+            for line in iter(f.readline, b''):
+                if frame_re.match(line.strip()):
+                    break
+                pos += len(line)
+            if offsets[-1] < pos < size:
+                offsets.append(pos)
+        offsets.append(size)
+    return offsets
+
+
+# Frame 偏移索引（sidecar）：每个 Frame 的 id、时间、字节偏移和行数，
+# 用于按 Frame / 时间范围随机访问、切分并行分片，以及只转换新追加的 Frame
+INDEX_DTYPE = np.dtype([
+    ("frame_id", np.int64),
+    ("event_time", np.float64),
+    ("offset", np.int64),
+    ("n_lines", np.int64),
+])
+
+
+def frame_index_path(input_file):
+    return input_file + ".idx.npz"
+
+
+def scan_frames(f, pos):
+    # 从字节位置 pos 开始扫描 Frame 头，返回 (frame_id, event_time, offset, n_lines) 列表
+    f.seek(pos)
+    frames = []
+    for line in f:
+        stripped = line.strip()
+        frame_match = frame_re.match(stripped) if stripped.startswith(b"Frame") else None
+        if frame_match:
+            frames.append([int(frame_match.group(1)), float(frame_match.group(2)), pos, 1])
+        elif frames:
+            frames[-1][3] += 1
+        pos += len(line)
+    return [tuple(frame) for frame in frames]
+
+
+def _frame_at(f, offset):
+    f.seek(offset)
+    return frame_re.match(f.readline().strip())
+
+
+def build_frame_index(input_file):
+    # 生成或更新 input_file 的 sidecar 索引并返回（INDEX_DTYPE 结构化数组）。
+    # 已有索引且文件只在末尾追加时，从最后一个 Frame（可能当时还没写完）处续扫，不从头重读
+    path = frame_index_path(input_file)
+    size = os.path.getsize(input_file)
+    frames = np.zeros(0, dtype=INDEX_DTYPE)
+    indexed_size = 0
+    if os.path.exists(path):
+        with np.load(path) as data:
+            frames = data["frames"]
+            indexed_size = int(data["file_size"])
+
+    with open(input_file, 'rb') as f:
+        if len(frames):
+            last = frames[-1]
+            frame_match = _frame_at(f, int(last["offset"])) if indexed_size <= size else None
+            if frame_match is None or int(frame_match.group(1)) != last["frame_id"]:
+                # 文件被截断或替换：重建索引
+                frames = np.zeros(0, dtype=INDEX_DTYPE)
+            elif indexed_size == size:
+                return frames
+        start = int(frames["offset"][-1]) if len(frames) else 0
+        new_frames = np.array(scan_frames(f, start), dtype=INDEX_DTYPE)
+
+    frames = np.concatenate([frames[:-1], new_frames]) if len(frames) else new_frames
+    np.savez(path, frames=frames, file_size=size)
+    return frames
+
+
+def load_frame_index(input_file):
+    # 只读取已有索引（不检查是否过期），不存在时返回 None
+    path = frame_index_path(input_file)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return data["frames"]
+
+
+def select_frames(frames, frame_range=None, time_range=None, file_size=None):
+    # 按 Frame 编号闭区间 frame_range=(first, last) 和/或时间区间 time_range=[t0, t1)
+    # 选出 Frame，返回覆盖它们的字节区间 (start, end)；None 表示端点不限。没有符合的 Frame 时返回 None
+    mask = np.ones(len(frames), dtype=bool)
+    if frame_range is not None:
+        first, last = frame_range
+        if first is not None:
+            mask &= frames["frame_id"] >= first
+        if last is not None:
+            mask &= frames["frame_id"] <= last
+    if time_range is not None:
+        t0, t1 = time_range
+        if t0 is not None:
+            mask &= frames["event_time"] >= t0
+        if t1 is not None:
+            mask &= frames["event_time"] < t1
+    selected = np.flatnonzero(mask)
+    if not len(selected):
+        return None
+    start = int(frames["offset"][selected[0]])
+    end = int(frames["offset"][selected[-1] + 1]) if selected[-1] + 1 < len(frames) else file_size
+    return start, end
+
+
+def _index_shard_offsets(frames, start, end, n_shards):
+    # 有索引时直接在 Frame 偏移上切分 [start, end)，无需再去文件中寻找边界
+    frame_offsets = frames["offset"][(frames["offset"] >= start) & (frames["offset"] < end)]
+    targets = start + (end - start) * np.arange(1, n_shards) // n_shards
+    cuts = frame_offsets[np.searchsorted(frame_offsets, targets).clip(0, len(frame_offsets) - 1)]
+    return [start] + [int(c) for c in np.unique(cuts) if start < c < end] + [end]
+
+
+def _parse_range(args):
+    # 进程池任务：解析 [start, end) 字节区间内的全部 Frame，并在子进程中完成 awkward 构建
+    input_file, start, end, dtypes = args
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        bufs = list(iter_chunks(f, end))
+    return build_branches(bufs[0], dtypes) if bufs else None
+
+
+def convert_clog_to_root(input_file, output_file, chunk_frames=None, chunk_mb=None,
+                         n_workers=1, shard_mb=64, use_index=False, frame_range=None, time_range=None,
+                         complete_only=False, compression=None, branch_dtypes=None, basket_entries=None):
+    # chunk_frames / chunk_mb：每累计多少个 Frame（或读入多少 MB 文本）就写出一个 basket，
+    # 两者都为 None 时与原来一样在最后一次性写出；设置后峰值内存只与块大小有关，与输入文件大小无关
+    # n_workers > 1：按 Frame 边界把文件切成约 shard_mb MB 的分片，用进程池并行解析，
+    # 再按 Frame 顺序依次写入同一个 Tree（内容与串行结果完全一致）
+    # use_index：生成/复用 sidecar 索引；指定 frame_range / time_range 时只转换选中的 Frame（自动使用索引）
+    # complete_only：文件仍在写入时使用，最后一个 Frame 可能不完整，留到下一次再转换
+    # compression / branch_dtypes / basket_entries：输出压缩算法与级别、各分支类型、每个 basket 的 Event 数，
+    # 见 tree_writer.make_compression / COMPACT_DTYPES
+    span = _frame_span(input_file, use_index, frame_range, time_range, complete_only)
+    if span is None:
+        print(f"没有符合条件的 Frame，未生成输出文件：{output_file}")
+        return
+
+    with open_output(output_file, compression) as file:
+        _write_span(file, input_file, *span, chunk_frames, chunk_mb, n_workers, shard_mb, branch_dtypes, basket_entries)
 
     print(f"转换成功！输出文件：{output_file}")
+    metrics.flush("convert_clog_to_root")
+
+
+def _frame_span(input_file, use_index=False, frame_range=None, time_range=None, complete_only=False):
+    # 要转换的字节区间：返回 (frames, start, end)，frames 为索引（不使用索引时为 None）；没有符合的 Frame 时返回 None
+    start, end = 0, os.path.getsize(input_file)
+    frames = None
+    if use_index or frame_range is not None or time_range is not None or complete_only:
+        frames = build_frame_index(input_file)
+        if complete_only and len(frames):
+            end = int(frames["offset"][-1])
+            frames = frames[:-1]
+        span = select_frames(frames, frame_range, time_range, file_size=end)
+        if span is None:
+            return None
+        start, end = span
+    return frames, start, end
+
+
+def _write_span(file, input_file, frames, start, end, chunk_frames=None, chunk_mb=None, n_workers=1, shard_mb=64,
+                branch_dtypes=None, basket_entries=None):
+    # 解析 [start, end) 内的 Frame 并按顺序追加到已打开的输出文件（串行分块或进程池并行）
+    chunk_bytes = chunk_mb * 1024 * 1024 if chunk_mb else None
+    if n_workers > 1:
+        n_shards = max(n_workers, (end - start) // (shard_mb * 1024 * 1024) + 1)
+        if frames is not None:
+            offsets = _index_shard_offsets(frames, start, end, n_shards)
+        else:
+            offsets = find_frame_offsets(input_file, n_shards)
+        ranges = [(input_file, a, b, branch_dtypes) for a, b in zip(offsets[:-1], offsets[1:])]
+        with multiprocessing.Pool(n_workers) as pool:
+            for branches in metrics.imap(pool, _parse_range, ranges):
+                if branches is not None:
+                    write_branches(file, branches, basket_entries=basket_entries)
+    else:
+        with open(input_file, 'rb') as f:
+            f.seek(start)
+            chunks = iter_chunks(f, end, chunk_frames=chunk_frames, chunk_bytes=chunk_bytes)
+            for buf in metrics.timed_iter("scan", chunks, events=lambda buf: len(buf["event_id"])):
+                write_branches(file, build_branches(buf, branch_dtypes), basket_entries=basket_entries)
+
+
+def convert_new_frames(input_file, output_file, previous_output=None, chunk_frames=None, chunk_mb=None,
+                       n_workers=1, shard_mb=64, complete_only=False, compression=None, branch_dtypes=None,
+                       basket_entries=None, step_size="200 MB"):
+    # 续转 / 增量转换：读取上一次的输出（包括中途崩溃留下的部分文件）中最后一个 event_id，
+    # 先把其中已有的 Event 按块复制过来，再借助索引只解析其后的 Frame 接在后面，
+    # 得到一个完整的 Tree（与一次性转换的结果相同）。previous_output 为 None 时在 output_file 上原地续转；
+    # 先写到临时文件，完成后再替换 output_file，中途出错不会破坏上一次的输出
+    previous_output = previous_output or output_file
+    tmp_file = output_file + ".tmp"
+    n_new = 0
+    with uproot.open(previous_output) as f, open_output(tmp_file, compression) as file:
+        tree = f["Tree"]
+        n_entries = tree.num_entries
+        last_id = int(tree["event_id"].array(entry_start=n_entries - 1, library="np")[0]) if n_entries else None
+        for data in tree.iterate([*EVENT_BRANCHES, *CLUSTER_BRANCHES, *CELL_BRANCHES], step_size=step_size):
+            write_branches(file, build_tree_branches(*flatten_tree_arrays(data), dtypes=branch_dtypes),
+                           basket_entries=basket_entries)
+        frame_range = (last_id + 1, None) if last_id is not None else None
+        span = _frame_span(input_file, True, frame_range, None, complete_only)
+        if span is not None:
+            frames, start, end = span
+            n_new = int(np.count_nonzero((frames["offset"] >= start) & (frames["offset"] < end)))
+            _write_span(file, input_file, frames, start, end, chunk_frames, chunk_mb, n_workers, shard_mb,
+                        branch_dtypes, basket_entries)
+    os.replace(tmp_file, output_file)
+
+    print(f"续转完成！已有 Event: {n_entries}，新增 Frame: {n_new}，输出文件：{output_file}")
+    metrics.flush("convert_new_frames")
+
 
 if __name__ == "__main__":
-    convert_clog_to_root("./Am_600s.clog", "./Am_600s.root")
\ No newline at end of file
+    convert_clog_to_root("./Am_600s.clog", "./Am_600s.root")
@@ -1,86 +1,117 @@
+import os
 import uproot
 import awkward as ak
 import matplotlib.pyplot as plt
 import numpy as np
 
-def analyze_and_save_plots(file_path):
-    # 1. 读取数据
-    with uproot.open(file_path) as f:
-        tree = f["Tree"]
-        data = tree.arrays(["cluster_energy", "cell_x", "cell_y", "cell_E", "cluster_n_cells"])
+import metrics
+import columnar_cache
+from histograms import Hist1D, PixelMap, SizeSpectra, cell_cluster_mask, save_histograms, load_merged
+
 
-    # --- 数据处理 ---
+def new_histograms():
+    # 画图所需的全部直方图：cluster 能谱（全范围 / 0-40 keV）、按 cluster 大小分开的能谱、
+    # Cluster_E < 40 的 cell 像素图（击中次数 / 能量和 / 能量平方和 / 最大值）
+    return {
+        "cluster_energy_full": Hist1D(100, 0, 100),
+        "cluster_energy_cut": Hist1D(100, 0, 40),
+        "size_spectra": SizeSpectra(10, 100, 0, 100),
+        "under40_map": PixelMap(256),
+    }
+
+
+def fill_histograms(hists, data):
+    # 用一块事件（awkward record array）填充直方图，可对多块、多个进程的结果用 histograms.merge_histograms 合并
     flat_cluster_E = ak.to_numpy(ak.flatten(data["cluster_energy"]))
     flat_cluster_n = ak.to_numpy(ak.flatten(data["cluster_n_cells"]))
     flat_cell_x = ak.to_numpy(ak.flatten(data["cell_x"]))
     flat_cell_y = ak.to_numpy(ak.flatten(data["cell_y"]))
     flat_cell_E = ak.to_numpy(ak.flatten(data["cell_E"]))
+    flat_cell_cluster_id = ak.to_numpy(ak.flatten(data["cell_cluster_id"]))
+
+    hists["cluster_energy_full"].fill(flat_cluster_E)
+    cluster_cut_mask = (flat_cluster_E > 0) & (flat_cluster_E < 40)
+    hists["cluster_energy_cut"].fill(flat_cluster_E[cluster_cut_mask])
+    hists["size_spectra"].fill(flat_cluster_E, flat_cluster_n)
 
-    # 建立映射
-    cluster_map = np.repeat(np.arange(len(flat_cluster_n)), flat_cluster_n)
+    # 建立映射（按 cell_cluster_id，去荧光合并后的文件也适用）
+    cell_cut_mask = cell_cluster_mask(cluster_cut_mask, ak.to_numpy(ak.num(data["cluster_energy"])),
+                                      ak.to_numpy(ak.num(data["cell_E"])), flat_cell_cluster_id)
+    hists["under40_map"].fill(flat_cell_x[cell_cut_mask], flat_cell_y[cell_cut_mask], flat_cell_E[cell_cut_mask])
+    return hists
 
-    # --- 图 1 & 2: Cluster Energy ---
-    # (省略部分样式代码以保持简洁，逻辑与之前一致)
+
+def draw_plots(hists, all_plots=False, out_dir="."):
+    # 只由直方图画图（不需要事件数据）；all_plots=False 时与原来一样只画全范围能谱
+    full = hists["cluster_energy_full"]
     plt.figure(figsize=(8, 6))
-    plt.hist(flat_cluster_E, bins=100, range=(0, 100), color='skyblue', edgecolor='black')
+    plt.stairs(full.counts, full.edges, fill=True, color='skyblue', edgecolor='black')
     plt.title("Cluster Energy (Full)")
-    plt.savefig("fit_cluster_energy_full.png", dpi=300)
+    plt.savefig(os.path.join(out_dir, "fit_cluster_energy_full.png"), dpi=300)
+    plt.close()
+    if not all_plots:
+        return
+
+    cut = hists["cluster_energy_cut"]
+    plt.figure(figsize=(8, 6))
+    plt.stairs(cut.counts, cut.edges, fill=True, color='salmon', edgecolor='black')
+    plt.title("Cluster Energy (0-40 keV)")
+    plt.savefig(os.path.join(out_dir, "2_cluster_energy_cut.png"), dpi=300)
+    plt.close()
+
+    pixel_map = hists["under40_map"]
+    if pixel_map.count.any():
+        print(f"单次击中 Cell 的最大能量: {np.max(pixel_map.maximum())}")
+
+    # --- 图 3: 2D 总能量分布 (Total Energy Map) ---
+    plt.figure(figsize=(9, 7))
+    plt.imshow(pixel_map.sum.T, origin='lower', extent=[0, 256, 0, 256], cmap='hot', aspect='auto')
+    plt.colorbar(label='Total Accumulated Energy (keV)')
+    plt.title("2D Total Energy Map (Cluster_E < 40)")
+    plt.xlabel("X-pixel")
+    plt.ylabel("Y-pixel")
+    plt.savefig(os.path.join(out_dir, "3_detector_total_energy_map.png"), dpi=300)
+    plt.close()
+
+    # --- 图 4: 2D 平均能量分布 (Average Energy Map)，没有击中的像素为 0 ---
+    plt.figure(figsize=(9, 7))
+    im = plt.imshow(pixel_map.mean().T, origin='lower', extent=[0, 256, 0, 256], cmap='viridis', aspect='auto')
+    plt.colorbar(im, label='Mean Energy per Hit (keV)')
+    plt.title("2D Average Energy Map (Cluster_E < 40)")
+    plt.xlabel("X-pixel")
+    plt.ylabel("Y-pixel")
+    plt.savefig(os.path.join(out_dir, "4_detector_avg_energy_map.png"), dpi=300)
     plt.close()
 
-    # cluster_cut_mask = (flat_cluster_E > 0) & (flat_cluster_E < 40)
-    # plt.figure(figsize=(8, 6))
-    # plt.hist(flat_cluster_E[cluster_cut_mask], bins=100, range=(0, 40), color='salmon', edgecolor='black')
-    # plt.title("Cluster Energy (0-40 keV)")
-    # plt.savefig("2_cluster_energy_cut.png", dpi=300)
-    # plt.close()
-
-    # # --- 准备 2D Map 数据 ---
-    # cell_cut_mask = cluster_cut_mask[cluster_map]
-    # final_x = flat_cell_x[cell_cut_mask]
-    # final_y = flat_cell_y[cell_cut_mask]
-    # final_E = flat_cell_E[cell_cut_mask]
-
-    # print(f"单次击中 Cell 的最大能量: {np.max(final_E)}")
-
-    # # --- 图 3: 2D 总能量分布 (Total Energy Map) ---
-    # plt.figure(figsize=(9, 7))
-    # plt.hist2d(final_x, final_y, bins=(256, 256), range=[[0, 256], [0, 256]], 
-    #            cmap='hot', weights=final_E)
-    # plt.colorbar(label='Total Accumulated Energy (keV)')
-    # plt.title("2D Total Energy Map (Cluster_E < 40)")
-    # plt.xlabel("X-pixel")
-    # plt.ylabel("Y-pixel")
-    # plt.savefig("3_detector_total_energy_map.png", dpi=300)
-    # plt.close()
-
-    # # --- 图 4: 2D 平均能量分布 (Average Energy Map) ---
-    # # 使用 numpy 计算矩阵
-    # # 1. 计算每个像素的能量总和
-    # sum_energy, x_edges, y_edges = np.histogram2d(
-    #     final_x, final_y, bins=256, range=[[0, 256], [0, 256]], weights=final_E
-    # )
-    # # 2. 计算每个像素被击中的次数
-    # hit_counts, _, _ = np.histogram2d(
-    #     final_x, final_y, bins=256, range=[[0, 256], [0, 256]]
-    # )
-
-    # # 3. 计算平均能量 (处理除以 0 的情况：没有点击的地方设为 0)
-    # with np.errstate(divide='ignore', invalid='ignore'):
-    #     avg_energy = np.divide(sum_energy, hit_counts)
-    #     avg_energy = np.nan_to_num(avg_energy) # 将 NaN 转为 0
-
-    # plt.figure(figsize=(9, 7))
-    # # 使用 imshow 绘制计算好的矩阵，注意 origin='lower' 保证坐标轴方向正确
-    # im = plt.imshow(avg_energy.T, origin='lower', extent=[0, 256, 0, 256], 
-    #                 cmap='viridis', aspect='auto')
-    # plt.colorbar(im, label='Mean Energy per Hit (keV)')
-    # plt.title("2D Average Energy Map (Cluster_E < 40)")
-    # plt.xlabel("X-pixel")
-    # plt.ylabel("Y-pixel")
-    # plt.savefig("4_detector_avg_energy_map.png", dpi=300)
-    # plt.close()
-
-    # print("所有 4 张图片已保存。")
+    print("所有 4 张图片已保存。")
+
+
+def analyze_and_save_plots(file_path, step_size="200 MB", hist_file=None, all_plots=False):
+    # 逐块读入并填充直方图（内存不随数据量增长）。给出 hist_file 时把直方图存为该文件（如 "./run_plots.npz"），
+    # 之后可用 draw_runs 直接重画或合并多个 run，不再读取事件数据；hist_file 为 None 时不写文件
+    hists = new_histograms()
+    with uproot.open(file_path) as f:
+        tree = f["Tree"]
+        chunks = columnar_cache.iterate(file_path, ["cluster_energy", "cell_x", "cell_y", "cell_E", "cluster_n_cells",
+                                                    "cell_cluster_id"], step_size, tree=tree)
+        for data in metrics.timed_iter("read", chunks, events=len):
+            with metrics.stage("fill", events=len(data)):
+                fill_histograms(hists, data)
+
+    if hist_file is not None:
+        save_histograms(hist_file, hists)
+        print(f"直方图已保存: {hist_file}")
+    with metrics.stage("plot"):
+        draw_plots(hists, all_plots)
+    metrics.flush("analyze_and_save_plots")
+    return hists
+
+
+def draw_runs(hist_files, all_plots=True, out_dir="."):
+    # 合并多个 run 保存的直方图并画图
+    hists = load_merged(hist_files)
+    draw_plots(hists, all_plots, out_dir)
+    return hists
 
 if __name__ == "__main__":
-    analyze_and_save_plots("./Am_600s.root")
\ No newline at end of file
+    analyze_and_save_plots("./Am_600s.root", hist_file="./Am_600s_plots.npz")
@@ -0,0 +1,340 @@
+import numpy as np
+
+import metrics
+
+try:
+    from numba import njit
+except ImportError:
+    # 没有安装 numba 时按纯 Python 执行同一个 kernel（结果相同，只是慢）
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True)
+def _grid_bucket(v, v_min, width, n_buckets):
+    # 坐标 -> 网格列/行号（单调不减，超出范围的夹到边缘格子；NaN 归入 0 号格子，距离判断时不会被选中）
+    r = (v - v_min) / width
+    if not r >= 0:
+        return 0
+    if r >= n_buckets:
+        return n_buckets - 1
+    return int(r)
+
+
+@njit(cache=True)
+def _grid_insert(j, b, heads, nxt, prv, bucket_of):
+    # 把目标cluster j 插入格子 b 的双向链表表头
+    bucket_of[j] = b
+    prv[j] = -1
+    nxt[j] = heads[b]
+    if heads[b] >= 0:
+        prv[heads[b]] = j
+    heads[b] = j
+
+
+@njit(cache=True)
+def _grid_remove(j, heads, nxt, prv, bucket_of):
+    # 把目标cluster j 从所在格子的链表中摘除
+    if prv[j] >= 0:
+        nxt[prv[j]] = nxt[j]
+    else:
+        heads[bucket_of[j]] = nxt[j]
+    if nxt[j] >= 0:
+        prv[nxt[j]] = prv[j]
+
+
+@njit(cache=True, error_model="numpy")
+def _merge_flu_kernel(cluster_offsets, cell_offsets,
+                      cluster_index, cluster_n_cells, cluster_energy, cluster_x, cluster_y, cluster_t,
+                      cell_x, cell_y, cell_E, cell_T, cell_cluster_id,
+                      energy_max, n_cells_max, window, grid_min_targets, use_cells):
+    # 逐 Event 处理扁平缓冲（cluster_offsets / cell_offsets 为每个 Event 的起止位置）。
+    # 规则与 new_remove_flu__and_save_root 原实现相同：
+    #   - 单cluster事件：energy<energy_max 且 n_cells<=n_cells_max 时抛弃整个事件
+    #   - 多cluster事件：所有低能量小cluster按顺序合并到 |dx|,|dy|<=window 内 |dt| 最小的目标cluster
+    #     （目标的位置/时间随合并实时更新），被合并的cluster删除，cluster id 重新编号
+    # 合并时目标cluster的能量、加权x/y、平均t、cell数由逐cell累加量增量更新，不再重新收集cells；
+    # use_cells=False 时累加量直接由cluster级分支还原（能量、能量x加权位置、平均t x cell数、cell数），
+    # 不需要任何cell分支，cell_cluster_id 之后按 out_cluster_id 改写
+    # 目标cluster数 >= grid_min_targets 的事件用二维网格索引查找候选，只检查 ±window 邻域内的格子，
+    # 而不是遍历所有目标；|dt| 相同时取索引最小的目标，与逐个遍历的选择完全相同
+    n_events = len(cluster_offsets) - 1
+    n_total_clusters = len(cluster_index)
+    out_index = cluster_index.copy()
+    out_n_cells = cluster_n_cells.copy()
+    out_energy = cluster_energy.copy()
+    out_x = cluster_x.copy()
+    out_y = cluster_y.copy()
+    out_t = cluster_t.copy()
+    out_cell_cluster_id = cell_cluster_id.copy()
+    # 每个原cluster的cells在输出中所属的cluster id（被合并的cluster指向其目标），未改动的事件保持原id
+    out_cluster_id = cluster_index.copy()
+    keep_cluster = np.ones(n_total_clusters, dtype=np.bool_)
+    keep_event = np.ones(n_events, dtype=np.bool_)
+    discarded_events = 0
+    merged_clusters = 0
+
+    for ev in range(n_events):
+        c0, c1 = cluster_offsets[ev], cluster_offsets[ev + 1]
+        k0, k1 = cell_offsets[ev], cell_offsets[ev + 1]
+        n_clusters = c1 - c0
+        if n_clusters == 0:
+            # 与原实现一致：没有cluster的事件不写出，也不计入抛弃数
+            keep_event[ev] = False
+            keep_cluster[c0:c1] = False
+            continue
+        if n_clusters == 1:
+            if cluster_n_cells[c0] <= n_cells_max and cluster_energy[c0] < energy_max:
+                keep_event[ev] = False
+                keep_cluster[c0] = False
+                discarded_events += 1
+            continue
+
+        low = np.empty(n_clusters, dtype=np.bool_)
+        n_low = 0
+        for j in range(n_clusters):
+            low[j] = (cluster_energy[c0 + j] < energy_max) and (cluster_n_cells[c0 + j] <= n_cells_max)
+            if low[j]:
+                n_low += 1
+        if n_low == 0 or n_low == n_clusters:
+            continue
+
+        # cell -> 所属cluster在事件内的位置（按cluster id查找），并按cell顺序累加各cluster的和
+        ids = cluster_index[c0:c1]
+        order = np.argsort(ids)
+        sorted_ids = ids[order]
+        n_cells_ev = k1 - k0
+        cell_pos = np.full(n_cells_ev, -1, dtype=np.int64)
+        sum_E = np.zeros(n_clusters)
+        sum_xE = np.zeros(n_clusters)
+        sum_yE = np.zeros(n_clusters)
+        sum_T = np.zeros(n_clusters)
+        count = np.zeros(n_clusters, dtype=np.int64)
+        parent = np.full(n_clusters, -1, dtype=np.int64)
+        if use_cells:
+            for k in range(n_cells_ev):
+                r = np.searchsorted(sorted_ids, cell_cluster_id[k0 + k])
+                if r < n_clusters and sorted_ids[r] == cell_cluster_id[k0 + k]:
+                    p = order[r]
+                    cell_pos[k] = p
+                    sum_E[p] += cell_E[k0 + k]
+                    sum_xE[p] += cell_x[k0 + k] * cell_E[k0 + k]
+                    sum_yE[p] += cell_y[k0 + k] * cell_E[k0 + k]
+                    sum_T[p] += cell_T[k0 + k]
+                    count[p] += 1
+
+            # 按所属cluster对cells做稳定的计数排序，合并时直接取低能量cluster的cells，不再扫描整个事件
+            cell_start = np.zeros(n_clusters + 1, dtype=np.int64)
+            for j in range(n_clusters):
+                cell_start[j + 1] = cell_start[j] + count[j]
+            fill = cell_start[:-1].copy()
+            cells_by_cluster = np.empty(cell_start[n_clusters], dtype=np.int64)
+            for k in range(n_cells_ev):
+                if cell_pos[k] >= 0:
+                    cells_by_cluster[fill[cell_pos[k]]] = k
+                    fill[cell_pos[k]] += 1
+        else:
+            for j in range(n_clusters):
+                sum_E[j] = cluster_energy[c0 + j]
+                sum_xE[j] = cluster_x[c0 + j] * cluster_energy[c0 + j]
+                sum_yE[j] = cluster_y[c0 + j] * cluster_energy[c0 + j]
+                sum_T[j] = cluster_t[c0 + j] * cluster_n_cells[c0 + j]
+                count[j] = cluster_n_cells[c0 + j]
+
+        # 目标cluster多时建立网格索引：按目标的初始位置分桶，每个格子一个双向链表；
+        # 格子边长不小于 window，格数约为 sqrt(目标数) x sqrt(目标数)，目标位置随合并改变时换到新格子
+        use_grid = n_clusters - n_low >= grid_min_targets
+        if use_grid:
+            x_min = np.inf
+            x_max = -np.inf
+            y_min = np.inf
+            y_max = -np.inf
+            for j in range(n_clusters):
+                if not low[j]:
+                    x_min = min(x_min, out_x[c0 + j])
+                    x_max = max(x_max, out_x[c0 + j])
+                    y_min = min(y_min, out_y[c0 + j])
+                    y_max = max(y_max, out_y[c0 + j])
+            if not (np.isfinite(x_min) and np.isfinite(x_max) and np.isfinite(y_min) and np.isfinite(y_max)):
+                x_min, x_max, y_min, y_max = 0.0, 0.0, 0.0, 0.0
+            n_side = int(np.sqrt(n_clusters - n_low)) + 1
+            width_x = max(window, (x_max - x_min) / n_side, 1e-9)
+            width_y = max(window, (y_max - y_min) / n_side, 1e-9)
+            n_bx = min(n_side, int((x_max - x_min) / width_x) + 1)
+            n_by = min(n_side, int((y_max - y_min) / width_y) + 1)
+            heads = np.full(n_bx * n_by, -1, dtype=np.int64)
+            nxt = np.full(n_clusters, -1, dtype=np.int64)
+            prv = np.full(n_clusters, -1, dtype=np.int64)
+            bucket_of = np.full(n_clusters, -1, dtype=np.int64)
+            for j in range(n_clusters - 1, -1, -1):
+                if not low[j]:
+                    b = (_grid_bucket(out_x[c0 + j], x_min, width_x, n_bx) * n_by
+                         + _grid_bucket(out_y[c0 + j], y_min, width_y, n_by))
+                    _grid_insert(j, b, heads, nxt, prv, bucket_of)
+
+        # 对每个低能量cluster，尝试合并到最近目标
+        n_deleted = 0
+        for lo in range(n_clusters):
+            if not low[lo]:
+                continue
+            low_x = cluster_x[c0 + lo]
+            low_y = cluster_y[c0 + lo]
+            low_t = cluster_t[c0 + lo]
+            best = -1
+            best_dt = np.inf
+            if use_grid:
+                bx0 = _grid_bucket(low_x - window, x_min, width_x, n_bx)
+                bx1 = _grid_bucket(low_x + window, x_min, width_x, n_bx)
+                by0 = _grid_bucket(low_y - window, y_min, width_y, n_by)
+                by1 = _grid_bucket(low_y + window, y_min, width_y, n_by)
+                for bx in range(bx0, bx1 + 1):
+                    for by in range(by0, by1 + 1):
+                        j = heads[bx * n_by + by]
+                        while j >= 0:
+                            if abs(out_x[c0 + j] - low_x) <= window and abs(out_y[c0 + j] - low_y) <= window:
+                                dt = abs(out_t[c0 + j] - low_t)
+                                if best < 0 or dt < best_dt or (dt == best_dt and j < best):
+                                    best = j
+                                    best_dt = dt
+                            j = nxt[j]
+            else:
+                for j in range(n_clusters):
+                    if low[j]:
+                        continue
+                    if abs(out_x[c0 + j] - low_x) <= window and abs(out_y[c0 + j] - low_y) <= window:
+                        dt = abs(out_t[c0 + j] - low_t)
+                        if best < 0 or dt < best_dt:
+                            best = j
+                            best_dt = dt
+            if best < 0:
+                continue
+
+            # 把低能量cluster的cells并入目标：累加量相加，cells改属目标
+            if use_cells:
+                for q in range(cell_start[lo], cell_start[lo + 1]):
+                    k = cells_by_cluster[q]
+                    sum_E[best] += cell_E[k0 + k]
+                    sum_xE[best] += cell_x[k0 + k] * cell_E[k0 + k]
+                    sum_yE[best] += cell_y[k0 + k] * cell_E[k0 + k]
+                    sum_T[best] += cell_T[k0 + k]
+                    count[best] += 1
+                    cell_pos[k] = best
+            else:
+                sum_E[best] += sum_E[lo]
+                sum_xE[best] += sum_xE[lo]
+                sum_yE[best] += sum_yE[lo]
+                sum_T[best] += sum_T[lo]
+                count[best] += count[lo]
+            parent[lo] = best
+            out_energy[c0 + best] = sum_E[best]
+            if count[best] > 0:
+                out_x[c0 + best] = sum_xE[best] / sum_E[best]
+                out_y[c0 + best] = sum_yE[best] / sum_E[best]
+                out_t[c0 + best] = sum_T[best] / count[best]
+                out_n_cells[c0 + best] = count[best]
+            else:
+                out_x[c0 + best] = low_x
+                out_y[c0 + best] = low_y
+                out_t[c0 + best] = low_t
+                out_n_cells[c0 + best] = cluster_n_cells[c0 + lo]
+            if use_grid:
+                b = (_grid_bucket(out_x[c0 + best], x_min, width_x, n_bx) * n_by
+                     + _grid_bucket(out_y[c0 + best], y_min, width_y, n_by))
+                if b != bucket_of[best]:
+                    _grid_remove(best, heads, nxt, prv, bucket_of)
+                    _grid_insert(best, b, heads, nxt, prv, bucket_of)
+            keep_cluster[c0 + lo] = False
+            n_deleted += 1
+            merged_clusters += 1
+
+        if n_deleted == 0:
+            continue
+
+        # Remap：保留的cluster按原id排序后重新编号为 0..n-1，cell_cluster_id 跟随
+        new_id = np.full(n_clusters, -1, dtype=np.int64)
+        next_id = 0
+        for r in range(n_clusters):
+            if keep_cluster[c0 + order[r]]:
+                new_id[order[r]] = next_id
+                next_id += 1
+        next_id = 0
+        for j in range(n_clusters):
+            if keep_cluster[c0 + j]:
+                out_index[c0 + j] = next_id
+                next_id += 1
+        for j in range(n_clusters):
+            out_cluster_id[c0 + j] = new_id[j] if parent[j] < 0 else new_id[parent[j]]
+        for k in range(n_cells_ev):
+            if cell_pos[k] >= 0:
+                out_cell_cluster_id[k0 + k] = new_id[cell_pos[k]]
+        if next_id == 0:
+            keep_event[ev] = False
+            discarded_events += 1
+
+    return (keep_event, keep_cluster, out_index, out_n_cells, out_energy, out_x, out_y, out_t,
+            out_cell_cluster_id, out_cluster_id, discarded_events, merged_clusters)
+
+
+def merge_flu(events, clusters, cells, n_clusters, n_cells, energy_max=30, n_cells_max=2, window=10,
+              grid_min_targets=32, cluster_sums=False):
+    # 多荧光合并：输入输出均为扁平 NumPy 缓冲 + 每个 Event 的 cluster 数 / cell 数（与 tree_writer 的约定相同）。
+    # grid_min_targets：目标cluster数达到该值的事件用网格索引查找候选（结果不变，只影响速度）
+    # cluster_sums=True：只由cluster级分支决定合并并计算合并后的cluster（不逐cell累加，结果只有舍入差异），
+    # cell_x/y/E/T 原样保留，cell_cluster_id 按 cluster 偏移改写（要求 cluster_index 为事件内 0..n-1 的顺序编号）
+    # cells / n_cells 为 None：只处理cluster级分支，不输出cell（返回的 cells / n_cells 也为 None）
+    # 返回 (events, clusters, cells, n_clusters, n_cells, 抛弃事件数, 合并cluster次数)
+    n_clusters = np.asarray(n_clusters, dtype=np.int64)
+    cluster_offsets = np.concatenate([[0], np.cumsum(n_clusters)])
+    cluster_index = np.ascontiguousarray(clusters["cluster_index"], dtype=np.int64)
+    use_cells = cells is not None and not cluster_sums
+    if use_cells:
+        n_cells = np.asarray(n_cells, dtype=np.int64)
+        cell_offsets = np.concatenate([[0], np.cumsum(n_cells)])
+        cell_arrays = [np.ascontiguousarray(cells[name], dtype=np.float64)
+                       for name in ("cell_x", "cell_y", "cell_E", "cell_T")]
+        cell_arrays.append(np.ascontiguousarray(cells["cell_cluster_id"], dtype=np.int64))
+    else:
+        if not np.array_equal(cluster_index, np.arange(len(cluster_index)) - np.repeat(cluster_offsets[:-1], n_clusters)):
+            raise ValueError("只用cluster级分支合并时，cluster_index 必须是每个事件内 0..n-1 的顺序编号")
+        cell_offsets = np.zeros(len(n_clusters) + 1, dtype=np.int64)
+        cell_arrays = [np.zeros(0) for _ in range(4)] + [np.zeros(0, dtype=np.int64)]
+    with metrics.stage("merge", events=len(n_clusters), clusters=len(cluster_index)):
+        (keep_event, keep_cluster, index, n_cells_out, energy, x, y, t, cell_cluster_id, cluster_id_map,
+         discarded_events, merged_clusters) = _merge_flu_kernel(
+            cluster_offsets, cell_offsets, cluster_index,
+            np.ascontiguousarray(clusters["cluster_n_cells"], dtype=np.int64),
+            np.ascontiguousarray(clusters["cluster_energy"], dtype=np.float64),
+            np.ascontiguousarray(clusters["cluster_weighted_x"], dtype=np.float64),
+            np.ascontiguousarray(clusters["cluster_weighted_y"], dtype=np.float64),
+            np.ascontiguousarray(clusters["cluster_avg_t"], dtype=np.float64),
+            *cell_arrays,
+            float(energy_max), int(n_cells_max), float(window), int(grid_min_targets), use_cells)
+
+    new_events = {name: np.asarray(array)[keep_event] for name, array in events.items()}
+    new_clusters = {
+        "cluster_index": index[keep_cluster],
+        "cluster_n_cells": n_cells_out[keep_cluster],
+        "cluster_energy": energy[keep_cluster],
+        "cluster_weighted_x": x[keep_cluster],
+        "cluster_weighted_y": y[keep_cluster],
+        "cluster_avg_t": t[keep_cluster],
+    }
+    event_of_cluster = np.repeat(np.arange(len(n_clusters)), n_clusters)
+    new_n_clusters = np.bincount(event_of_cluster[keep_cluster], minlength=len(n_clusters))[keep_event]
+    if cells is None:
+        return new_events, new_clusters, None, new_n_clusters, None, int(discarded_events), int(merged_clusters)
+
+    # 被抛弃事件的cells整体去掉；cluster按 keep_cluster 去掉（被抛弃事件的cluster已在kernel中标记）
+    n_cells = np.asarray(n_cells, dtype=np.int64)
+    if not use_cells:
+        # cell 所属的全局cluster = 所在事件的cluster偏移 + cell_cluster_id，查表得到新的id
+        cell_cluster = (np.repeat(cluster_offsets[:-1], n_cells)
+                        + np.asarray(cells["cell_cluster_id"], dtype=np.int64))
+        cell_cluster_id = cluster_id_map[cell_cluster]
+    keep_cell = np.repeat(keep_event, n_cells)
+    new_cells = {name: np.asarray(cells[name])[keep_cell] for name in ("cell_x", "cell_y", "cell_E", "cell_T")}
+    new_cells["cell_cluster_id"] = cell_cluster_id[keep_cell]
+    return (new_events, new_clusters, new_cells, new_n_clusters, n_cells[keep_event],
+            int(discarded_events), int(merged_clusters))
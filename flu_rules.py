@@ -0,0 +1,141 @@
+import os
+import itertools
+import uproot
+import awkward as ak
+import numpy as np
+import matplotlib.pyplot as plt
+
+import columnar_cache
+from tree_writer import (EVENT_BRANCHES, CLUSTER_BRANCHES, CELL_BRANCHES, build_tree_branches,
+                         flatten_tree_arrays, write_branches, open_output)
+from flu_merge import merge_flu
+from analyze_remove_flu import min_flu_geometry, remove_min_flu
+from histograms import Hist1D, save_histograms
+
+# 荧光去除规则用字典描述（阈值和策略都是数据，不写死在脚本里）：
+#   strategy   : "min" —— 只处理每个事件能量最小的cluster（analyze_remove_flu 的规则）
+#                "all" —— 合并所有低能量小cluster（new_remove_flu__and_save_root 的规则，可写出Tree）
+#   energy_max : 荧光cluster能量上限（cluster_energy < energy_max）
+#   n_cells_max: 荧光cluster cell数上限（cluster_n_cells <= n_cells_max）
+#   window     : 合并目标的空间窗口（|dx|,|dy| <= window 像素）
+DEFAULT_RULE = {"strategy": "all", "energy_max": 30, "n_cells_max": 2, "window": 10}
+STRATEGIES = ("min", "all")
+
+
+def make_rule(name=None, **params):
+    # 补全默认值并检查参数；name 缺省时由参数生成（如 "all_E30_n2_w10"）
+    unknown = set(params) - set(DEFAULT_RULE)
+    if unknown:
+        raise ValueError(f"未知的规则参数: {sorted(unknown)}")
+    rule = {**DEFAULT_RULE, **params}
+    if rule["strategy"] not in STRATEGIES:
+        raise ValueError(f"未知的合并策略: {rule['strategy']}（可选 {STRATEGIES}）")
+    rule["name"] = name or f"{rule['strategy']}_E{rule['energy_max']:g}_n{rule['n_cells_max']}_w{rule['window']:g}"
+    return rule
+
+
+def rule_grid(strategy=("all",), energy_max=(20, 25, 30), n_cells_max=(2,), window=(8, 10, 12)):
+    # 参数网格的所有组合，例如 3 个能量阈值 x 3 个窗口 = 9 个规则
+    return [make_rule(strategy=s, energy_max=e, n_cells_max=n, window=w)
+            for s, e, n, w in itertools.product(strategy, energy_max, n_cells_max, window)]
+
+
+def evaluate_rules_chunk(data, rules, write_trees=False, branch_dtypes=None):
+    # 对同一块数据依次应用所有规则：数据只读入/拆分一次，"min" 策略的几何量（最小cluster及 |dx|,|dy|,|dt|）
+    # 也只算一次，各规则只重新生成阈值掩码。
+    # 返回每个规则的 (输出分支或None, 能谱直方图 Hist1D, 抛弃事件数, 合并次数, 新cluster数, 新cluster能量和)
+    flat = None
+    geometry = None
+    results = []
+    for rule in rules:
+        if rule["strategy"] == "all":
+            if flat is None:
+                flat = flatten_tree_arrays(data)
+            (new_events, new_clusters, new_cells, new_n_clusters, new_n_cells,
+             discarded, merged) = merge_flu(*flat, energy_max=rule["energy_max"], n_cells_max=rule["n_cells_max"],
+                                            window=rule["window"])
+            branches = None
+            if write_trees:
+                branches = build_tree_branches(new_events, new_clusters, new_cells, new_n_clusters, new_n_cells,
+                                               dtypes=branch_dtypes)
+            new_energies = new_clusters["cluster_energy"]
+        else:
+            if geometry is None:
+                geometry = min_flu_geometry(data["cluster_energy"], data["cluster_n_cells"],
+                                            data["cluster_weighted_x"], data["cluster_weighted_y"],
+                                            data["cluster_avg_t"])
+            new_energy, keep, merge = remove_min_flu(data["cluster_energy"], data["cluster_n_cells"],
+                                                     data["cluster_weighted_x"], data["cluster_weighted_y"],
+                                                     data["cluster_avg_t"], energy_max=rule["energy_max"],
+                                                     n_cells_max=rule["n_cells_max"], window=rule["window"],
+                                                     geometry=geometry)
+            branches = None
+            discarded, merged = int(ak.sum(~keep)), int(ak.sum(merge))
+            new_energies = ak.to_numpy(ak.flatten(new_energy[keep]))
+        results.append((branches, Hist1D(100, 0, 500).fill(new_energies), discarded, merged,
+                        len(new_energies), float(np.sum(new_energies))))
+    return results
+
+
+def evaluate_rules(input_root_file, rules, out_dir="./flu_rules", step_size=None, write_trees=False,
+                   compression=None, branch_dtypes=None, basket_entries=None):
+    # 一次读入（可按 step_size 分块）评估所有规则，每个规则输出一个能谱 <name>.npz（save_histograms，键 "spectrum"），
+    # write_trees=True 时 "all" 策略的规则各写出一个清理后的 Tree <name>.root（"min" 策略只改能量，不写Tree）。
+    # 最后打印各规则的统计表，并把所有规则的能谱画在同一张图上
+    rules = [rule if "name" in rule else make_rule(**rule) for rule in rules]
+    if len({rule["name"] for rule in rules}) != len(rules):
+        raise ValueError("规则名重复")
+    if any(rule["strategy"] == "all" for rule in rules):
+        branches = [*EVENT_BRANCHES, *CLUSTER_BRANCHES, *CELL_BRANCHES]
+    else:
+        branches = ["cluster_energy", "cluster_n_cells", "cluster_weighted_x", "cluster_weighted_y", "cluster_avg_t"]
+    tree_rules = [rule for rule in rules if write_trees and rule["strategy"] == "all"]
+
+    os.makedirs(out_dir, exist_ok=True)
+    stats = {rule["name"]: {"hist": Hist1D(100, 0, 500), "discarded": 0, "merged": 0,
+                            "n_new": 0, "sum_energy": 0.0} for rule in rules}
+    outputs = {rule["name"]: open_output(os.path.join(out_dir, f"{rule['name']}.root"), compression)
+               for rule in tree_rules}
+    try:
+        with uproot.open(input_root_file) as file:
+            tree = file["Tree"]
+            print(f"总事件数: {tree.num_entries}，规则数: {len(rules)}")
+            for data in columnar_cache.iterate(input_root_file, branches, step_size or max(tree.num_entries, 1),
+                                               tree=tree):
+                results = evaluate_rules_chunk(data, rules, write_trees=bool(tree_rules), branch_dtypes=branch_dtypes)
+                for rule, (out_branches, spectrum, discarded, merged, n_new, sum_energy) in zip(rules, results):
+                    s = stats[rule["name"]]
+                    s["hist"] += spectrum
+                    s["discarded"] += discarded
+                    s["merged"] += merged
+                    s["n_new"] += n_new
+                    s["sum_energy"] += sum_energy
+                    if out_branches is not None:
+                        write_branches(outputs[rule["name"]], out_branches, basket_entries=basket_entries)
+    finally:
+        for out in outputs.values():
+            out.close()
+
+    print(f"{'规则':<24}{'抛弃事件':>10}{'合并次数':>10}{'新cluster数':>12}{'平均能量(keV)':>15}")
+    for rule in rules:
+        s = stats[rule["name"]]
+        save_histograms(os.path.join(out_dir, f"{rule['name']}.npz"), {"spectrum": s["hist"]})
+        s["mean_energy"] = s["sum_energy"] / s["n_new"] if s["n_new"] else float("nan")
+        print(f"{rule['name']:<24}{s['discarded']:>10}{s['merged']:>10}{s['n_new']:>12}{s['mean_energy']:>15.2f}")
+
+    plt.figure(figsize=(8, 6))
+    for rule in rules:
+        plt.stairs(stats[rule["name"]]["hist"].counts, stats[rule["name"]]["hist"].edges, label=rule["name"])
+    plt.xlabel('New Cluster Energy (keV)')
+    plt.ylabel('Counts')
+    plt.title('New Cluster Energies for Each Fluorescence Rule')
+    plt.grid(True, alpha=0.3)
+    plt.legend(fontsize=7)
+    plt.savefig(os.path.join(out_dir, 'rule_variants.png'), dpi=300, bbox_inches='tight')
+    plt.close()
+    return stats
+
+
+if __name__ == "__main__":
+    evaluate_rules("./TEST-14000-ENERGY.root",
+                   rule_grid(strategy=("min", "all"), energy_max=(20, 25, 30), window=(8, 10, 12)))
@@ -0,0 +1,99 @@
+import os
+import time
+import uproot
+import awkward as ak
+import numpy as np
+import matplotlib.pyplot as plt
+
+from convert_clog_to_root import iter_chunks, build_branches, scan_frames
+from tree_writer import write_branches
+
+
+def _save_live_plot(counts, edges, n_frames, plot_file):
+    plt.figure(figsize=(8, 6))
+    plt.stairs(counts, edges, fill=True, color='skyblue', edgecolor='black')
+    plt.xlabel('Cluster Energy (keV)')
+    plt.ylabel('Counts')
+    plt.title(f"Cluster Energy (Live, {n_frames} frames)")
+    plt.savefig(plot_file, dpi=100)
+    plt.close()
+
+
+def follow_clog(input_file, output_file, chunk_frames=1000, poll_interval=1.0, flush_interval=5.0,
+                idle_timeout=30.0, plot_file="live_cluster_energy.png", bins=100, energy_range=(0, 100)):
+    # 采集过程中跟踪不断增长的 .clog：只解析已经完整的 Frame（后面已出现下一个 Frame 头），
+    # 分块追加到 ROOT 输出，同时累积 cluster 能量直方图并定期刷新 plot_file。
+    # 文件超过 idle_timeout 秒不再增长时认为采集结束，把最后一个 Frame 也写入后退出（Ctrl+C 同样会收尾）。
+    # 等待 idle_timeout 秒后文件仍未出现时报错
+    wait_start = time.time()
+    while not os.path.exists(input_file):
+        if time.time() - wait_start > idle_timeout:
+            raise FileNotFoundError(f"等待 {idle_timeout:g} 秒后仍未找到输入文件: {input_file}")
+        time.sleep(poll_interval)
+
+    edges = np.linspace(energy_range[0], energy_range[1], bins + 1)
+    counts = np.zeros(bins)
+    n_frames = 0
+    pending = []           # 还未写出的块
+    n_pending_frames = 0
+    start = 0              # 下一个未解析 Frame 的字节偏移
+    last_size = -1
+    last_growth = time.time()
+    last_flush = time.time()
+
+    def parse_to(end):
+        # 解析 [start, end) 的 Frame，加入待写出的块（全部解析完才更新状态，中途 Ctrl+C 时可从 start 重新解析）
+        nonlocal start, n_pending_frames, n_frames
+        if end <= start:
+            return
+        f.seek(start)
+        bufs = list(iter_chunks(f, end, chunk_frames=chunk_frames))
+        n_new = sum(len(buf["event_id"]) for buf in bufs)
+        pending.extend(bufs)
+        n_pending_frames += n_new
+        n_frames += n_new
+        start = end
+
+    def flush():
+        # 每写出一块就立即从 pending 中移除：flush 中途 Ctrl+C 后再次 flush 时从未写出的块继续，不会重复写入
+        nonlocal n_pending_frames, last_flush
+        wrote = False
+        while pending:
+            branches = build_branches(pending[0])
+            chunk_counts = np.histogram(ak.to_numpy(ak.flatten(branches["cluster_energy"])), bins=edges)[0]
+            write_branches(file, branches)
+            n_pending_frames -= len(pending.pop(0)["event_id"])
+            counts[:] += chunk_counts
+            wrote = True
+        if wrote:
+            _save_live_plot(counts, edges, n_frames, plot_file)
+            print(f"已写入 {n_frames} 个 Frame，cluster 总数: {int(counts.sum())}（{energy_range[0]}-{energy_range[1]} keV 内）")
+        last_flush = time.time()
+
+    with uproot.recreate(output_file) as file, open(input_file, 'rb') as f:
+        try:
+            while True:
+                size = os.path.getsize(input_file)
+                finished = size == last_size and time.time() - last_growth > idle_timeout
+                if size != last_size:
+                    last_size, last_growth = size, time.time()
+
+                # 最后一个 Frame 可能还在写入，只解析到它的开头；采集结束时解析到文件末尾
+                frames = scan_frames(f, start)
+                parse_to(size if finished else (frames[-1][2] if frames else start))
+
+                if finished or n_pending_frames >= chunk_frames or time.time() - last_flush > flush_interval:
+                    flush()
+                if finished:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("手动停止跟踪。")
+            parse_to(os.path.getsize(input_file))  # 最后一个 Frame 也写入
+            flush()
+
+    print(f"跟踪结束！共 {n_frames} 个 Frame，输出文件：{output_file}，能谱图：{plot_file}")
+
+
+if __name__ == "__main__":
+    follow_clog("./Am_600s.clog", "./Am_600s_live.root")
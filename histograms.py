@@ -0,0 +1,271 @@
+import numpy as np
+
+# 可累加、可持久化的直方图：按块 fill，相同分箱的直方图可直接相加（跨块、跨进程、跨 run），
+# 用 save_histograms / load_histograms 存取 .npz，之后重新画图或合并多个 run 都不需要再读事件数据
+N_PIXELS = 256  # 256x256 Timepix
+
+
+def bin_index(values, n_bins, lo, hi):
+    # 等宽分箱的 bin 下标（与 np.histogram 相同：最后一个 bin 包含右边界，超出范围的值丢弃），
+    # 返回 (下标, 在范围内的掩码)
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.linspace(lo, hi, n_bins + 1)
+    inside = (values >= lo) & (values <= hi)
+    v = values[inside]
+    index = ((v - lo) * (n_bins / (hi - lo))).astype(np.int64)
+    index = np.clip(index, 0, n_bins - 1)
+    # 浮点舍入修正：保证 edges[i] <= v < edges[i+1]
+    index -= v < edges[index]
+    index += (v >= edges[index + 1]) & (index != n_bins - 1)
+    return index, inside
+
+
+class Hist1D:
+    # 等宽一维直方图（如 cluster 能谱）
+
+    kind = "Hist1D"
+
+    def __init__(self, n_bins=100, lo=0.0, hi=100.0):
+        self.n_bins, self.lo, self.hi = int(n_bins), float(lo), float(hi)
+        self.counts = np.zeros(self.n_bins)
+
+    @property
+    def edges(self):
+        return np.linspace(self.lo, self.hi, self.n_bins + 1)
+
+    def binning(self):
+        return self.n_bins, self.lo, self.hi
+
+    def fill(self, values, weights=None):
+        index, inside = bin_index(values, self.n_bins, self.lo, self.hi)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)[inside]
+        self.counts += np.bincount(index, weights=weights, minlength=self.n_bins)
+        return self
+
+    def __iadd__(self, other):
+        _check_same(self, other)
+        self.counts += other.counts
+        return self
+
+    def to_arrays(self):
+        return {"n_bins": self.n_bins, "lo": self.lo, "hi": self.hi, "counts": self.counts}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        hist = cls(int(arrays["n_bins"]), float(arrays["lo"]), float(arrays["hi"]))
+        hist.counts = np.array(arrays["counts"], dtype=np.float64)
+        return hist
+
+
+class PixelMap:
+    # n_pixels x n_pixels 像素图（下标为 [x, y]）：击中次数、能量和、能量平方和、最大单次能量，可得平均能量和方差。
+    # 像素坐标线性化为 x * n_pixels + y 后用 bincount 累加（代替 np.histogram2d 的浮点分箱，且一次线性化得到全部量）
+
+    kind = "PixelMap"
+
+    def __init__(self, n_pixels=N_PIXELS):
+        self.n_pixels = int(n_pixels)
+        self.count = np.zeros((self.n_pixels, self.n_pixels), dtype=np.int64)
+        self.sum = np.zeros((self.n_pixels, self.n_pixels))
+        self.sumsq = np.zeros((self.n_pixels, self.n_pixels))
+        self.max = np.full((self.n_pixels, self.n_pixels), -np.inf)
+
+    def binning(self):
+        return (self.n_pixels,)
+
+    def fill(self, x, y, values):
+        # x / y 为像素坐标（整数值），超出探测器范围的 cell 丢弃
+        x = np.asarray(x).astype(np.int64)
+        y = np.asarray(y).astype(np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        inside = (x >= 0) & (x < self.n_pixels) & (y >= 0) & (y < self.n_pixels)
+        pixel = x[inside] * self.n_pixels + y[inside]
+        values = values[inside]
+        size = self.n_pixels * self.n_pixels
+        shape = (self.n_pixels, self.n_pixels)
+        self.count += np.bincount(pixel, minlength=size).reshape(shape)
+        self.sum += np.bincount(pixel, weights=values, minlength=size).reshape(shape)
+        self.sumsq += np.bincount(pixel, weights=values * values, minlength=size).reshape(shape)
+        np.maximum.at(self.max.reshape(-1), pixel, values)
+        return self
+
+    def mean(self):
+        # 平均能量（没有击中的像素记为 0）
+        out = np.zeros_like(self.sum)
+        np.divide(self.sum, self.count, out=out, where=self.count > 0)
+        return out
+
+    def var(self):
+        # 能量的方差（总体方差，没有击中的像素记为 0）
+        out = np.zeros_like(self.sumsq)
+        np.divide(self.sumsq, self.count, out=out, where=self.count > 0)
+        return np.maximum(out - self.mean() ** 2, 0.0)
+
+    def maximum(self):
+        # 最大单次能量（没有击中的像素记为 0）
+        return np.where(self.count > 0, self.max, 0.0)
+
+    def __iadd__(self, other):
+        _check_same(self, other)
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def to_arrays(self):
+        return {"n_pixels": self.n_pixels, "count": self.count, "sum": self.sum, "sumsq": self.sumsq,
+                "max": self.max}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        pixel_map = cls(int(arrays["n_pixels"]))
+        pixel_map.count = np.array(arrays["count"], dtype=np.int64)
+        pixel_map.sum = np.array(arrays["sum"], dtype=np.float64)
+        pixel_map.sumsq = np.array(arrays["sumsq"], dtype=np.float64)
+        if "max" in arrays:
+            pixel_map.max = np.array(arrays["max"], dtype=np.float64)
+        return pixel_map
+
+
+class SizeSpectra:
+    # 按 cluster 大小（cell 数）分开的能谱：第 i 行为 n_cells == i+1 的 cluster，最后一行为 n_cells >= max_size
+
+    kind = "SizeSpectra"
+
+    def __init__(self, max_size=10, n_bins=100, lo=0.0, hi=100.0):
+        self.max_size = int(max_size)
+        self.n_bins, self.lo, self.hi = int(n_bins), float(lo), float(hi)
+        self.counts = np.zeros((self.max_size, self.n_bins))
+
+    @property
+    def edges(self):
+        return np.linspace(self.lo, self.hi, self.n_bins + 1)
+
+    def binning(self):
+        return self.max_size, self.n_bins, self.lo, self.hi
+
+    def fill(self, energies, n_cells):
+        index, inside = bin_index(energies, self.n_bins, self.lo, self.hi)
+        size = np.clip(np.asarray(n_cells, dtype=np.int64)[inside], 1, self.max_size) - 1
+        flat = np.bincount(size * self.n_bins + index, minlength=self.max_size * self.n_bins)
+        self.counts += flat.reshape(self.max_size, self.n_bins)
+        return self
+
+    def spectrum(self, n_cells):
+        # 指定 cell 数的能谱（n_cells >= max_size 时为溢出行）
+        return self.counts[min(n_cells, self.max_size) - 1]
+
+    def __iadd__(self, other):
+        _check_same(self, other)
+        self.counts += other.counts
+        return self
+
+    def to_arrays(self):
+        return {"max_size": self.max_size, "n_bins": self.n_bins, "lo": self.lo, "hi": self.hi,
+                "counts": self.counts}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        spectra = cls(int(arrays["max_size"]), int(arrays["n_bins"]), float(arrays["lo"]), float(arrays["hi"]))
+        spectra.counts = np.array(arrays["counts"], dtype=np.float64)
+        return spectra
+
+
+class RegionSpectra:
+    # 每个像素区域（region_size x region_size 像素的超像素，region_size=1 时为单个像素）一条能谱，
+    # counts 形状为 (n_side, n_side, n_bins)，下标为 [x 区域, y 区域, 能量 bin]；用于逐像素 / 逐区域拟合峰位
+
+    kind = "RegionSpectra"
+
+    def __init__(self, region_size=1, n_bins=30, lo=40.0, hi=70.0, n_pixels=N_PIXELS):
+        self.region_size, self.n_pixels = int(region_size), int(n_pixels)
+        self.n_side = -(-self.n_pixels // self.region_size)
+        self.n_bins, self.lo, self.hi = int(n_bins), float(lo), float(hi)
+        self.counts = np.zeros((self.n_side, self.n_side, self.n_bins))
+
+    @property
+    def edges(self):
+        return np.linspace(self.lo, self.hi, self.n_bins + 1)
+
+    def binning(self):
+        return self.region_size, self.n_bins, self.lo, self.hi, self.n_pixels
+
+    def fill(self, x, y, energies):
+        # x / y 为 cluster 位置（如 cluster_weighted_x/y，向下取整到像素），超出探测器或能量范围的丢弃
+        index, inside = bin_index(energies, self.n_bins, self.lo, self.hi)
+        x = np.floor(np.asarray(x, dtype=np.float64)[inside]).astype(np.int64)
+        y = np.floor(np.asarray(y, dtype=np.float64)[inside]).astype(np.int64)
+        on_sensor = (x >= 0) & (x < self.n_pixels) & (y >= 0) & (y < self.n_pixels)
+        region = (x[on_sensor] // self.region_size) * self.n_side + y[on_sensor] // self.region_size
+        flat = np.bincount(region * self.n_bins + index[on_sensor], minlength=self.counts.size)
+        self.counts += flat.reshape(self.counts.shape)
+        return self
+
+    def __iadd__(self, other):
+        _check_same(self, other)
+        self.counts += other.counts
+        return self
+
+    def to_arrays(self):
+        return {"region_size": self.region_size, "n_bins": self.n_bins, "lo": self.lo, "hi": self.hi,
+                "n_pixels": self.n_pixels, "counts": self.counts}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        spectra = cls(int(arrays["region_size"]), int(arrays["n_bins"]), float(arrays["lo"]), float(arrays["hi"]),
+                      int(arrays["n_pixels"]))
+        spectra.counts = np.array(arrays["counts"], dtype=np.float64)
+        return spectra
+
+
+def cell_cluster_mask(cluster_mask, n_clusters, n_cells, cell_cluster_id):
+    # 把 cluster 级的选择（如 cluster_energy < 40）映射到 cell：cell 所属的全局 cluster =
+    # 所在事件的 cluster 偏移 + cell_cluster_id（合并后 cell 不一定按 cluster 连续排列，不能用 np.repeat）
+    cluster_start = np.cumsum(n_clusters) - n_clusters
+    return np.asarray(cluster_mask)[np.repeat(cluster_start, n_cells) + np.asarray(cell_cluster_id, dtype=np.int64)]
+
+
+HISTOGRAM_TYPES = {cls.kind: cls for cls in (Hist1D, PixelMap, SizeSpectra, RegionSpectra)}
+
+
+def _check_same(a, b):
+    if type(a) is not type(b) or a.binning() != b.binning():
+        raise ValueError(f"无法合并分箱不同的直方图: {a.kind}{a.binning()} 和 {b.kind}{b.binning()}")
+
+
+def save_histograms(path, hists):
+    # hists：名字 -> 直方图；存为一个 .npz，键为 "<名字>/<字段>"，另存 "<名字>/kind" 用于读回
+    arrays = {}
+    for name, hist in hists.items():
+        arrays[f"{name}/kind"] = np.array(hist.kind)
+        for field, value in hist.to_arrays().items():
+            arrays[f"{name}/{field}"] = np.asarray(value)
+    np.savez(path, **arrays)
+
+
+def load_histograms(path):
+    with np.load(path) as data:
+        fields = {}
+        for key in data.files:
+            name, field = key.rsplit("/", 1)
+            fields.setdefault(name, {})[field] = data[key]
+    return {name: HISTOGRAM_TYPES[str(arrays["kind"])].from_arrays(arrays) for name, arrays in fields.items()}
+
+
+def merge_histograms(hist_sets):
+    # 把多组直方图（如多个进程或多个 run 的结果）按名字相加；只在部分组中出现的直方图原样保留
+    merged = {}
+    for hists in hist_sets:
+        for name, hist in hists.items():
+            if name in merged:
+                merged[name] += hist
+            else:
+                merged[name] = type(hist).from_arrays(hist.to_arrays())
+    return merged
+
+
+def load_merged(paths):
+    # 读入并合并多个 .npz（例如多个 run），用于跨 run 的合并画图
+    return merge_histograms(load_histograms(path) for path in paths)
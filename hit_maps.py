@@ -0,0 +1,78 @@
+import os
+import multiprocessing
+import awkward as ak
+import numpy as np
+
+import columnar_cache
+from histograms import PixelMap, N_PIXELS, cell_cluster_mask, save_histograms
+
+# 生成像素图只需要这些分支（cluster 级的 cut 通过 cell_cluster_id 映射到 cell）
+MAP_BRANCHES = ["cluster_energy", "cluster_n_cells", "cell_x", "cell_y", "cell_E", "cell_cluster_id"]
+
+
+def cluster_cut(cluster_energy, cluster_n_cells, energy_range=None, size_range=None):
+    # cluster 级的选择：energy_range / size_range 为 (下限, 上限)，下限含、上限不含，None 表示不限
+    mask = np.ones(len(cluster_energy), dtype=bool)
+    for values, value_range in ((cluster_energy, energy_range), (cluster_n_cells, size_range)):
+        if value_range is None:
+            continue
+        lo, hi = value_range
+        if lo is not None:
+            mask &= values >= lo
+        if hi is not None:
+            mask &= values < hi
+    return mask
+
+
+def fill_hit_maps(maps, data):
+    # 用一块事件填充一组像素图；maps：名字 -> (PixelMap, energy_range, size_range)
+    flat = {name: ak.to_numpy(ak.flatten(data[name])) for name in MAP_BRANCHES}
+    n_clusters = ak.to_numpy(ak.num(data["cluster_energy"]))
+    n_cells = ak.to_numpy(ak.num(data["cell_E"]))
+    for pixel_map, energy_range, size_range in maps.values():
+        if energy_range is None and size_range is None:
+            pixel_map.fill(flat["cell_x"], flat["cell_y"], flat["cell_E"])
+            continue
+        mask = cell_cluster_mask(cluster_cut(flat["cluster_energy"], flat["cluster_n_cells"], energy_range, size_range),
+                                 n_clusters, n_cells, flat["cell_cluster_id"])
+        pixel_map.fill(flat["cell_x"][mask], flat["cell_y"][mask], flat["cell_E"][mask])
+    return maps
+
+
+def make_hit_maps(root_file, cuts=None, out_file=None, step_size="200 MB", n_pixels=N_PIXELS):
+    # 对一个 run 生成像素图（击中次数 / 能量和 / 平均 / 方差 / 最大值，见 histograms.PixelMap），
+    # 每个 cut 一张图。cuts：名字 -> {"energy_range": (lo, hi), "size_range": (lo, hi)}，
+    # 默认为全部 cell 和 Cluster_E < 40 两张图。结果保存为 out_file（默认 <root_file 去扩展名>_maps.npz）
+    if cuts is None:
+        cuts = {"all": {}, "under40": {"energy_range": (None, 40)}}
+    maps = {name: (PixelMap(n_pixels), cut.get("energy_range"), cut.get("size_range")) for name, cut in cuts.items()}
+    for data in columnar_cache.iterate(root_file, MAP_BRANCHES, step_size):
+        fill_hit_maps(maps, data)
+    hists = {name: pixel_map for name, (pixel_map, _, _) in maps.items()}
+    out_file = out_file or os.path.splitext(root_file)[0] + "_maps.npz"
+    save_histograms(out_file, hists)
+    return hists
+
+
+def _make_hit_maps_task(args):
+    root_file, cuts, step_size = args
+    make_hit_maps(root_file, cuts, step_size=step_size)
+    return os.path.splitext(root_file)[0] + "_maps.npz"
+
+
+def make_campaign_maps(root_files, cuts=None, n_workers=1, step_size="200 MB"):
+    # 对一批 run 各自重新生成像素图（每个 run 一个 _maps.npz），n_workers > 1 时按 run 并行；
+    # 返回生成的 .npz 路径，可用 histograms.load_merged 合并成整个 campaign 的图
+    tasks = [(root_file, cuts, step_size) for root_file in root_files]
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            paths = pool.map(_make_hit_maps_task, tasks)
+    else:
+        paths = [_make_hit_maps_task(task) for task in tasks]
+    for path in paths:
+        print(f"像素图已保存: {path}")
+    return paths
+
+
+if __name__ == "__main__":
+    make_campaign_maps(["./TEST-14000-ENERGY.root"])
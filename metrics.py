@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+
+# 各脚本共用的计时 / 计数：按阶段（解析、awkward 构建、合并、写 ROOT、画图……）累计墙钟时间、CPU 时间、
+# 峰值内存和处理的事件数 / cluster 数，另有物理计数（抛弃事件数、合并次数……），输出为 JSON lines 或
+# Prometheus 文本格式（node_exporter textfile collector）。
+# 默认关闭：stage() 返回同一个空对象，只多一次全局变量判断；用 enable(path) 或环境变量 PIXET_METRICS=path 打开，
+# path 以 .prom 结尾时写 Prometheus 文本，否则追加 JSON lines
+#
+#   with metrics.stage("parse", events=n_events) as s:
+#       ...
+#       s.add(clusters=n_clusters)
+#   metrics.count("merged_clusters", merged)
+
+_recorder = None
+
+
+def peak_rss_mb():
+    # 本进程的峰值内存：Linux 上读 /proc/self/status 的 VmHWM（exec 后重新计数；ru_maxrss 会继承父进程的值），
+    # 其他系统用 ru_maxrss（Linux 以 KB 计，macOS 以字节计）
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024**2
+
+
+class _Recorder:
+
+    def __init__(self, path=None, labels=None):
+        self.path = path
+        self.labels = dict(labels or {})
+        self.stages = {}
+        self.counters = {}
+
+    def add_stage(self, name, wall, cpu, events, clusters, peak):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "events": 0, "clusters": 0,
+                                         "peak_rss_mb": 0.0}
+        entry["calls"] += 1
+        entry["wall_s"] += wall
+        entry["cpu_s"] += cpu
+        entry["events"] += events
+        entry["clusters"] += clusters
+        entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak)
+
+    def merge(self, snapshot):
+        for name, other in snapshot["stages"].items():
+            entry = self.stages.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "events": 0, "clusters": 0,
+                                                  "peak_rss_mb": 0.0})
+            for key in ("calls", "wall_s", "cpu_s", "events", "clusters"):
+                entry[key] += other[key]
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], other["peak_rss_mb"])
+        for name, value in snapshot["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        return {"stages": {name: dict(entry) for name, entry in self.stages.items()}, "counters": dict(self.counters)}
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+
+class _NullStage:
+    # 关闭时 stage() 返回的空对象
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, events=0, clusters=0):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+
+    def __init__(self, recorder, name, events, clusters):
+        self.recorder, self.name = recorder, name
+        self.events, self.clusters = events, clusters
+
+    def __enter__(self):
+        self.wall0, self.cpu0 = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add_stage(self.name, time.perf_counter() - self.wall0, time.process_time() - self.cpu0,
+                                self.events, self.clusters, peak_rss_mb())
+        return False
+
+    def add(self, events=0, clusters=0):
+        # 阶段内才知道的数量（如解析后的 cluster 数）
+        self.events += events
+        self.clusters += clusters
+
+
+def enable(path=None, labels=None):
+    # 打开记录；path 为 None 时只在内存中累计（用 snapshot() 取出），labels 附加到每条输出（如 run 名）
+    global _recorder
+    _recorder = _Recorder(path, labels)
+    if path is not None:
+        atexit.register(flush)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name, events=0, clusters=0):
+    if _recorder is None:
+        return _NULL_STAGE
+    return _Stage(_recorder, name, events, clusters)
+
+
+def count(name, value=1):
+    if _recorder is not None:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + value
+
+
+def timed_iter(name, iterable, events=None):
+    # 给迭代器的每次 next（如 tree.iterate 读一块）计时，记为阶段 name；events(item) 给出该块的事件数
+    if _recorder is None:
+        return iterable
+    return _timed_iter(name, iterable, events)
+
+
+def _timed_iter(name, iterable, events):
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as s:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if events is not None:
+                s.add(events=events(item))
+        yield item
+
+
+def snapshot():
+    return _recorder.snapshot() if _recorder is not None else {"stages": {}, "counters": {}}
+
+
+class _Task:
+    # 进程池任务的包装：在子进程中单独累计，任务结束时把累计值随结果一起返回，由主进程合并
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, args):
+        global _recorder
+        if _recorder is None or _recorder.path is not None:
+            _recorder = _Recorder()  # 子进程只在内存中累计（spawn 时模块状态是新的，fork 时不重复输出）
+        _recorder.reset()
+        result = self.func(args)
+        return result, _recorder.snapshot()
+
+
+def imap(pool, func, iterable):
+    # 代替 pool.imap(func, iterable)：打开记录时把子进程中各阶段的累计合并到本进程
+    # （此时各阶段的 wall_s 为所有子进程之和）
+    if _recorder is None:
+        yield from pool.imap(func, iterable)
+        return
+    for result, worker_snapshot in pool.imap(_Task(func), iterable):
+        if _recorder is not None:
+            _recorder.merge(worker_snapshot)
+        yield result
+
+
+def _stage_record(name, entry):
+    record = {"stage": name, **entry}
+    for key in ("events", "clusters"):
+        record[f"{key}_per_s"] = entry[key] / entry["wall_s"] if entry[key] and entry["wall_s"] > 0 else None
+    return record
+
+
+def _prometheus_text(recorder):
+    # 累计值（跨多次 flush），只带 enable 时给的 labels
+
+    def fmt(extra):
+        items = {**recorder.labels, **extra}
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items.items()) + "}" if items else ""
+
+    lines = []
+    series = (("wall_seconds", "counter", "wall_s"), ("cpu_seconds", "counter", "cpu_s"), ("calls", "counter", "calls"),
+              ("events", "counter", "events"), ("clusters", "counter", "clusters"),
+              ("peak_rss_bytes", "gauge", None), ("events_per_second", "gauge", "events_per_s"),
+              ("clusters_per_second", "gauge", "clusters_per_s"))
+    records = [_stage_record(name, entry) for name, entry in recorder.stages.items()]
+    for metric, kind, key in series:
+        lines.append(f"# TYPE pixet_stage_{metric} {kind}")
+        for r in records:
+            value = r["peak_rss_mb"] * 1024**2 if key is None else r[key]
+            if value is not None:
+                lines.append(f"pixet_stage_{metric}{fmt({'stage': r['stage']})} {value}")
+    for name, value in recorder.counters.items():
+        lines.append(f"# TYPE pixet_{name}_total counter")
+        lines.append(f"pixet_{name}_total{fmt({})} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def flush(job=None):
+    # 输出当前累计：JSON lines 时每个阶段一行 + 一行物理计数，追加后清零（下一次 flush 只含之后的部分）；
+    # Prometheus 时整个文件替换为累计值（不清零）。job 为 JSON lines 中的任务名（如 "run_pipeline"）
+    recorder = _recorder
+    if recorder is None or recorder.path is None or not (recorder.stages or recorder.counters):
+        return
+    if recorder.path.endswith(".prom"):
+        tmp = recorder.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(_prometheus_text(recorder))
+        os.replace(tmp, recorder.path)
+        return
+    common = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "pid": os.getpid(), **recorder.labels,
+              **({"job": job} if job else {})}
+    with open(recorder.path, "a") as f:
+        for name, entry in recorder.stages.items():
+            f.write(json.dumps({**common, "type": "stage", **_stage_record(name, entry)}) + "\n")
+        if recorder.counters:
+            f.write(json.dumps({**common, "type": "counters", **recorder.counters}) + "\n")
+    recorder.reset()
+
+
+if os.environ.get("PIXET_METRICS"):
+    enable(os.environ["PIXET_METRICS"])
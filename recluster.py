@@ -0,0 +1,198 @@
+import multiprocessing
+import uproot
+import awkward as ak
+import numpy as np
+
+import metrics
+import columnar_cache
+from tree_writer import EVENT_BRANCHES, build_tree_branches, write_branches, open_output
+from convert_clog_to_root import cluster_branches
+from flu_merge import njit  # numba 的 njit，未安装 numba 时为不编译的替代
+
+# 由 cell 级分支（cell_x / cell_y / cell_E / cell_T）重新聚类，不依赖 PIXET 写入 .clog 的 cluster 划分：
+# 同一 Event 内两个 cell 像素相邻且时间差 |dT| <= time_window 时属于同一 cluster（单链接，相邻关系传递），
+# 用并查集在扁平的 per-event 缓冲上求连通分量（编译kernel，与 flu_merge 相同的 numba 写法）。
+# 相邻的定义：connectivity=8 为 Chebyshev 距离 <= radius（含对角），connectivity=4 为 Manhattan 距离 <= radius；
+# radius > 1 时允许中间隔开 radius - 1 个像素。time_window 为 None 时不看时间
+# 输出的 cells 按新 cluster 依次排列（cluster 内保持原顺序），cluster 按其第一个 cell 的位置编号，
+# 全部 cluster_* 分支由 cells 重新计算（与 convert_clog_to_root 的计算相同）
+READ_BRANCHES = [*EVENT_BRANCHES, "cell_x", "cell_y", "cell_E", "cell_T", "cluster_n_cells"]
+CONNECTIVITIES = (4, 8)
+
+
+@njit(cache=True)
+def _find(parent, i):
+    # 并查集查找根，同时做路径压缩
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        nxt = parent[i]
+        parent[i] = root
+        i = nxt
+    return root
+
+
+@njit(cache=True)
+def _recluster_kernel(cell_offsets, cell_x, cell_y, cell_T, four_connected, radius, time_window):
+    # 逐 Event 处理：cells 按 x 排序后扫描，只比较 x 差 <= radius 的 cell 对（事件内 O(n log n + 邻域对数)），
+    # 相邻且时间差在窗口内的两个 cell 合并到同一集合（根取较小的下标）。
+    # 返回每个 cell 的事件内 cluster 号、输出的 cell 顺序（全局下标）和每个 Event 的 cluster 数
+    n_events = len(cell_offsets) - 1
+    n_total = len(cell_x)
+    label = np.empty(n_total, dtype=np.int64)
+    perm = np.empty(n_total, dtype=np.int64)
+    n_clusters = np.zeros(n_events, dtype=np.int64)
+    max_cells = 0
+    for ev in range(n_events):
+        max_cells = max(max_cells, cell_offsets[ev + 1] - cell_offsets[ev])
+    # 各事件共用的工作数组，不逐事件分配
+    parent = np.empty(max_cells, dtype=np.int64)
+    local = np.empty(max_cells, dtype=np.int64)
+    start = np.empty(max_cells + 1, dtype=np.int64)
+
+    for ev in range(n_events):
+        k0, k1 = cell_offsets[ev], cell_offsets[ev + 1]
+        n = k1 - k0
+        if n == 0:
+            continue
+        if n == 1:
+            label[k0] = 0
+            perm[k0] = k0
+            n_clusters[ev] = 1
+            continue
+        for k in range(n):
+            parent[k] = k
+        order = np.argsort(cell_x[k0:k1], kind="mergesort")
+        for a in range(n):
+            i = order[a]
+            for b in range(a + 1, n):
+                j = order[b]
+                dx = cell_x[k0 + j] - cell_x[k0 + i]
+                if dx > radius:
+                    break
+                dy = abs(cell_y[k0 + j] - cell_y[k0 + i])
+                near = dx + dy <= radius if four_connected else dy <= radius
+                if near and abs(cell_T[k0 + j] - cell_T[k0 + i]) <= time_window:
+                    ri = _find(parent, i)
+                    rj = _find(parent, j)
+                    if ri < rj:
+                        parent[rj] = ri
+                    elif rj < ri:
+                        parent[ri] = rj
+
+        # cluster 按第一个 cell 出现的顺序编号，再按 cluster 对 cells 做稳定的计数排序
+        for k in range(n):
+            local[k] = -1
+        m = 0
+        for k in range(n):
+            r = _find(parent, k)
+            if local[r] < 0:
+                local[r] = m
+                m += 1
+            label[k0 + k] = local[r]
+        for c in range(m + 1):
+            start[c] = 0
+        for k in range(n):
+            start[label[k0 + k] + 1] += 1
+        for c in range(m):
+            start[c + 1] += start[c]
+        for k in range(n):
+            c = label[k0 + k]
+            perm[k0 + start[c]] = k0 + k
+            start[c] += 1
+        n_clusters[ev] = m
+    return label, perm, n_clusters
+
+
+def recluster(events, cells, n_cells, connectivity=8, radius=1, time_window=None):
+    # 输入输出为扁平 NumPy 缓冲 + 每个 Event 的计数（tree_writer 的约定）；cells 只需 cell_x / cell_y / cell_E / cell_T
+    # （原 cell_cluster_id 不使用）。返回 (events, clusters, cells, n_clusters, n_cells)，Event 不增不减
+    if connectivity not in CONNECTIVITIES:
+        raise ValueError(f"未知的 connectivity: {connectivity}（可选 {CONNECTIVITIES}）")
+    n_cells = np.asarray(n_cells, dtype=np.int64)
+    cell_offsets = np.concatenate([[0], np.cumsum(n_cells)])
+    cell_x, cell_y, cell_E, cell_T = (np.ascontiguousarray(cells[name], dtype=np.float64)
+                                      for name in ("cell_x", "cell_y", "cell_E", "cell_T"))
+    with metrics.stage("recluster", events=len(n_cells)) as s:
+        label, perm, n_clusters = _recluster_kernel(
+            cell_offsets, cell_x, cell_y, cell_T, connectivity == 4, float(radius),
+            np.inf if time_window is None else float(time_window))
+        # 输出顺序下每个 cluster 的 cell 数：按 (Event, 事件内 cluster 号) 计数，cluster 在全局按顺序排列
+        cluster_offsets = np.concatenate([[0], np.cumsum(n_clusters)])
+        cell_cluster = np.repeat(cluster_offsets[:-1], n_cells) + label
+        cluster_n_cells = np.bincount(cell_cluster, minlength=cluster_offsets[-1])
+        new_cells = {"cell_x": cell_x[perm], "cell_y": cell_y[perm], "cell_E": cell_E[perm], "cell_T": cell_T[perm]}
+        clusters, new_cells["cell_cluster_id"] = cluster_branches(
+            new_cells["cell_x"], new_cells["cell_y"], new_cells["cell_E"], new_cells["cell_T"],
+            cluster_n_cells, n_clusters)
+        s.add(clusters=len(cluster_n_cells))
+    return events, clusters, new_cells, n_clusters, n_cells
+
+
+def _recluster_chunk(data, params, branch_dtypes=None):
+    # 处理一块事件，返回 (输出分支, 原cluster数, 新cluster数, 单 cell cluster 数)，各项可按块相加
+    events = {name: ak.to_numpy(data[name]) for name in EVENT_BRANCHES}
+    cells = {name: ak.to_numpy(ak.flatten(data[name])) for name in ("cell_x", "cell_y", "cell_E", "cell_T")}
+    n_cells = ak.to_numpy(ak.num(data["cell_E"]))
+    n_old = int(ak.sum(ak.num(data["cluster_n_cells"])))
+    events, clusters, cells, n_clusters, n_cells = recluster(events, cells, n_cells, **params)
+    branches = build_tree_branches(events, clusters, cells, n_clusters, n_cells, dtypes=branch_dtypes)
+    return branches, n_old, len(clusters["cluster_n_cells"]), int(np.sum(clusters["cluster_n_cells"] == 1))
+
+
+def _recluster_range(args):
+    # 进程池任务：读取并处理 [entry_start, entry_stop) 范围的事件
+    input_root_file, entry_start, entry_stop, params, branch_dtypes = args
+    with metrics.stage("read", events=entry_stop - entry_start):
+        data = columnar_cache.arrays(input_root_file, READ_BRANCHES, entry_start, entry_stop)
+    return _recluster_chunk(data, params, branch_dtypes)
+
+
+def _iter_reclustered(input_root_file, tree, step_size, n_workers, params, branch_dtypes):
+    # 按事件顺序逐块产出 _recluster_chunk 的结果（串行，或进程池并行；step_size 为 None 时并行每个进程约 4 块）
+    n_events = tree.num_entries
+    if n_workers > 1:
+        step = (columnar_cache.step_entries(input_root_file, READ_BRANCHES, step_size, tree=tree) if step_size
+                else max(-(-n_events // (n_workers * 4)), 1))
+        ranges = [(input_root_file, start, min(start + step, n_events), params, branch_dtypes)
+                  for start in range(0, n_events, step)]
+        with multiprocessing.Pool(n_workers) as pool:
+            yield from metrics.imap(pool, _recluster_range, ranges)
+    else:
+        chunks = columnar_cache.iterate(input_root_file, READ_BRANCHES, step_size, tree=tree)
+        for data in metrics.timed_iter("read", chunks, events=len):
+            yield _recluster_chunk(data, params, branch_dtypes)
+
+
+def recluster_root(input_root_file, output_root_file, connectivity=8, radius=1, time_window=None,
+                   step_size="200 MB", n_workers=1, compression=None, branch_dtypes=None, basket_entries=None):
+    # 对一个 Tree 重新聚类并写出新 Tree（分支与 convert_clog_to_root 的输出相同，可直接交给去荧光等脚本）。
+    # step_size：每块的事件数或数据量；n_workers > 1 时按事件范围切块并行，各块按事件顺序写出，结果与串行一致。
+    # compression / branch_dtypes / basket_entries 见 tree_writer
+    params = {"connectivity": connectivity, "radius": radius, "time_window": time_window}
+    n_old = n_new = n_single = 0
+    with uproot.open(input_root_file) as file, open_output(output_root_file, compression) as new_file:
+        tree = file["Tree"]
+        print(f"总事件数: {tree.num_entries}")
+        results = _iter_reclustered(input_root_file, tree, step_size, n_workers, params, branch_dtypes)
+        for branches, old, new, single in results:
+            write_branches(new_file, branches, basket_entries=basket_entries)
+            n_old += old
+            n_new += new
+            n_single += single
+
+    window = "不限" if time_window is None else f"{time_window:g} ns"
+    print(f"重新聚类: {connectivity} 邻接, 半径 {radius:g}, 时间窗口 {window}")
+    print(f"原cluster数: {n_old}, 新cluster数: {n_new}（单 cell cluster: {n_single}）")
+    print(f"新ROOT文件已保存: {output_root_file}")
+    metrics.count("old_clusters", n_old)
+    metrics.count("new_clusters", n_new)
+    metrics.flush("recluster_root")
+    return n_old, n_new
+
+
+if __name__ == "__main__":
+    input_root = "./TEST-14000-ENERGY.root"  # 输入ROOT文件路径
+    output_root = "./TEST-14000-ENERGY_reclustered.root"  # 输出ROOT文件路径
+    recluster_root(input_root, output_root)
@@ -0,0 +1,220 @@
+import os
+import math
+import multiprocessing
+import awkward as ak
+import numpy as np
+import matplotlib.pyplot as plt
+
+import columnar_cache
+from histograms import RegionSpectra, save_histograms
+from spectrum_fit import erfc
+
+# 逐像素 / 逐区域拟合 Am-241 59.5 keV 峰（刻度用的增益图和分辨率图）：
+# 先把 cluster_energy 按 cluster_weighted_x/y 所在区域累加成 RegionSpectra（每个区域一条 n_bins 的能谱），
+# 再对所有区域同时做分 bin 扩展 Poisson 似然拟合（NumPy 批量运算，不逐个区域循环）：
+#   mu_i = amp * [Phi(b_i) - Phi(a_i)] + n_bkg * 本底在 bin i 内的积分，本底与 spectrum_fit 相同（线性，区间内归一化）
+# 用 Fisher scoring（解析 Jacobian，期望信息矩阵代替 Hessian）+ Levenberg 阻尼迭代，误差取期望信息矩阵的逆
+
+PARAM_NAMES = ("amp", "n_bkg", "mean", "sigma", "slope")
+STATUS_OK = 0           # 收敛
+STATUS_NOT_CONVERGED = 1
+STATUS_LOW_COUNTS = 2   # 区域内计数少于 min_counts，未拟合
+STATUS_AT_LIMIT = 3     # 收敛，但 mean / sigma 在边界上或信号为 0
+
+
+def _expected_and_jacobian(params, edges):
+    # params: (R, 5)；返回各 bin 的期望计数 (R, n_bins) 及其对参数的 Jacobian (R, n_bins, 5)
+    amp, n_bkg, mean, sigma, slope = (params[:, i:i + 1] for i in range(5))
+    z = (edges[None, :] - mean) / sigma
+    cdf = 0.5 * erfc(-z / math.sqrt(2.0))
+    pdf = np.exp(-0.5 * z * z) / math.sqrt(2 * math.pi)
+    signal = np.diff(cdf, axis=1)
+    d_mean = -np.diff(pdf, axis=1) / sigma
+    d_sigma = -np.diff(pdf * z, axis=1) / sigma
+
+    center, width = 0.5 * (edges[0] + edges[-1]), edges[-1] - edges[0]
+    a, b = edges[:-1] - center, edges[1:] - center
+    d_slope = 0.5 * (b * b - a * a) / width
+    background = (b - a) / width + slope * d_slope
+
+    expected = amp * signal + n_bkg * background
+    jacobian = np.stack([signal, background, amp * d_mean, amp * d_sigma,
+                         np.broadcast_to(n_bkg * d_slope, signal.shape)], axis=-1)
+    return expected, jacobian
+
+
+def _nll(expected, counts):
+    expected = np.maximum(expected, 1e-300)
+    return np.sum(expected - counts * np.log(expected), axis=1)
+
+
+def _initial_params(counts, edges, bounds):
+    # 初值：峰位取 mean 范围内计数最多的 bin，本底由 ±3 sigma 以外的边带估计，其余计为信号
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    total = counts.sum(axis=1)
+    in_range = (centers >= bounds[2, 0]) & (centers <= bounds[2, 1])
+    mean = centers[in_range][np.argmax(counts[:, in_range], axis=1)]
+    sigma = np.full(len(counts), 1.5)
+    sideband = np.abs(centers[None, :] - mean[:, None]) > 3 * sigma[:, None]
+    n_sideband = np.maximum(sideband.sum(axis=1), 1)
+    n_bkg = np.maximum((counts * sideband).sum(axis=1) / n_sideband * len(centers), 0.1)
+    amp = np.maximum(total - n_bkg, 1.0)
+    params = np.stack([amp, n_bkg, mean, sigma, np.zeros(len(counts))], axis=1)
+    return np.clip(params, bounds[:, 0], bounds[:, 1])
+
+
+def fit_batch(counts, edges, max_iter=100, edm_tol=1e-5, mean_range=(55.0, 65.0), sigma_range=(0.5, 5.0)):
+    # 同时拟合一批能谱 counts (R, n_bins)，返回 (参数 (R, 5), 误差 (R, 5), 是否收敛 (R,), 信息矩阵的逆 (R, 5, 5))
+    counts = np.asarray(counts, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    width = edges[-1] - edges[0]
+    bounds = np.array([(0.0, np.inf), (0.0, np.inf), mean_range, sigma_range, (-2.0 / width, 2.0 / width)])
+    params = _initial_params(counts, edges, bounds)
+    n_regions = len(counts)
+    damping = np.full(n_regions, 1e-3)
+    converged = np.zeros(n_regions, dtype=bool)
+    expected, jacobian = _expected_and_jacobian(params, edges)
+    nll = _nll(expected, counts)
+    eye = np.eye(5)
+
+    for _ in range(max_iter):
+        active = ~converged
+        if not active.any():
+            break
+        p, c, mu, jac = params[active], counts[active], np.maximum(expected[active], 1e-300), jacobian[active]
+        grad = np.einsum('rb,rbp->rp', 1.0 - c / mu, jac)
+        fisher = np.einsum('rbp,rbq,rb->rpq', jac, jac, 1.0 / mu)
+        # 在边界上且梯度指向边界外的参数本步固定（对应行列置为单位阵、梯度置 0），收敛判据只看其余参数
+        fixed = ((p <= bounds[:, 0]) & (grad > 0)) | ((p >= bounds[:, 1]) & (grad < 0))
+        grad = np.where(fixed, 0.0, grad)
+        pair = fixed[:, :, None] | fixed[:, None, :]
+        fisher = np.where(pair, 0.0, fisher) + fixed[:, :, None] * eye
+        diag = np.einsum('rpp->rp', fisher)
+        regular = fisher + 1e-12 * (diag.sum(axis=1) + 1.0)[:, None, None] * eye
+        edm = 0.5 * np.einsum('rp,rp->r', grad, np.linalg.solve(regular, grad[..., None])[..., 0])
+        done = edm < edm_tol
+        idx = np.flatnonzero(active)
+        converged[idx[done]] = True
+
+        # 阻尼 Fisher 步，投影到参数范围内；NLL 下降则接受并减小阻尼，否则加大阻尼
+        step = -np.linalg.solve(regular + damping[active, None, None] * diag[:, :, None] * eye, grad[..., None])[..., 0]
+        trial = np.clip(p + step, bounds[:, 0], bounds[:, 1])
+        trial_expected, trial_jacobian = _expected_and_jacobian(trial, edges)
+        trial_nll = _nll(trial_expected, c)
+        better = (trial_nll < nll[active]) & ~done
+        accept = idx[better]
+        params[accept] = trial[better]
+        expected[accept] = trial_expected[better]
+        jacobian[accept] = trial_jacobian[better]
+        nll[accept] = trial_nll[better]
+        damping[accept] = np.maximum(damping[accept] / 10, 1e-9)
+        reject = idx[~better & ~done]
+        damping[reject] *= 10
+        # 阻尼已很大仍不能下降：已在数值精度内到达最小值
+        stuck = reject[damping[reject] > 1e8]
+        converged[stuck] = True
+
+    fisher = np.einsum('rbp,rbq,rb->rpq', jacobian, jacobian, 1.0 / np.maximum(expected, 1e-300))
+    covariance = np.linalg.pinv(fisher)
+    errors = np.sqrt(np.maximum(np.einsum('rpp->rp', covariance), 0.0))
+    return params, errors, converged, covariance
+
+
+def _fit_batch_task(args):
+    counts, edges, options = args
+    return fit_batch(counts, edges, **options)
+
+
+def fit_region_spectra(spectra, min_counts=50, n_workers=1, batch_size=4096, **options):
+    # 拟合 RegionSpectra 中的所有区域（计数 >= min_counts 的区域分批批量拟合，n_workers > 1 时各批并行）。
+    # 返回字典，每项为 (n_side, n_side) 数组：mean / sigma / n_sig（区间内信号产量）/ n_bkg 及各自的误差（*_err）、
+    # counts（区间内总计数）、status（STATUS_*）
+    counts = spectra.counts.reshape(-1, spectra.n_bins)
+    edges = spectra.edges
+    total = counts.sum(axis=1)
+    selected = np.flatnonzero(total >= min_counts)
+    batches = [(counts[selected[i:i + batch_size]], edges, options) for i in range(0, len(selected), batch_size)]
+    if n_workers > 1 and len(batches) > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            results = pool.map(_fit_batch_task, batches)
+    else:
+        results = [_fit_batch_task(batch) for batch in batches]
+
+    n_regions = len(counts)
+    params = np.full((n_regions, 5), np.nan)
+    errors = np.full((n_regions, 5), np.nan)
+    status = np.full(n_regions, STATUS_LOW_COUNTS, dtype=np.int8)
+    if results:
+        params[selected] = np.concatenate([r[0] for r in results])
+        errors[selected] = np.concatenate([r[1] for r in results])
+        converged = np.concatenate([r[2] for r in results])
+        mean_range = options.get("mean_range", (55.0, 65.0))
+        sigma_range = options.get("sigma_range", (0.5, 5.0))
+        p = params[selected]
+        at_limit = ((p[:, 2] <= mean_range[0]) | (p[:, 2] >= mean_range[1]) | (p[:, 3] <= sigma_range[0])
+                    | (p[:, 3] >= sigma_range[1]) | (p[:, 0] <= 0))
+        status[selected] = np.where(converged, np.where(at_limit, STATUS_AT_LIMIT, STATUS_OK), STATUS_NOT_CONVERGED)
+
+    # 区间内的信号产量 = amp * 峰在拟合区间内的比例
+    lo, hi = edges[0], edges[-1]
+    fraction = 0.5 * (erfc(-(hi - params[:, 2]) / (params[:, 3] * math.sqrt(2.0)))
+                      - erfc(-(lo - params[:, 2]) / (params[:, 3] * math.sqrt(2.0))))
+    shape = (spectra.n_side, spectra.n_side)
+    return {
+        "mean": params[:, 2].reshape(shape), "mean_err": errors[:, 2].reshape(shape),
+        "sigma": params[:, 3].reshape(shape), "sigma_err": errors[:, 3].reshape(shape),
+        "n_sig": (params[:, 0] * fraction).reshape(shape), "n_sig_err": (errors[:, 0] * fraction).reshape(shape),
+        "n_bkg": params[:, 1].reshape(shape), "n_bkg_err": errors[:, 1].reshape(shape),
+        "counts": total.reshape(shape), "status": status.reshape(shape),
+    }
+
+
+def to_pixels(region_map, region_size, n_pixels=256):
+    # 区域图展开为 n_pixels x n_pixels 的像素图（每个像素取所在区域的值）
+    return np.repeat(np.repeat(region_map, region_size, axis=0), region_size, axis=1)[:n_pixels, :n_pixels]
+
+
+def fill_region_spectra(root_file, region_size=1, fit_range=(40.0, 70.0), n_bins=30, step_size="200 MB"):
+    spectra = RegionSpectra(region_size, n_bins, *fit_range)
+    for data in columnar_cache.iterate(root_file, ["cluster_energy", "cluster_weighted_x", "cluster_weighted_y"],
+                                       step_size):
+        spectra.fill(ak.to_numpy(ak.flatten(data["cluster_weighted_x"])),
+                     ak.to_numpy(ak.flatten(data["cluster_weighted_y"])),
+                     ak.to_numpy(ak.flatten(data["cluster_energy"])))
+    return spectra
+
+
+def fit_regions(root_file, region_size=1, fit_range=(40.0, 70.0), n_bins=30, min_counts=50, n_workers=1,
+                out_file=None, plot_file=None, step_size="200 MB"):
+    # 逐区域峰位拟合：能谱保存为 <root_file 去扩展名>_regions.npz（RegionSpectra，可跨 run 合并后用
+    # fit_region_spectra 重新拟合），拟合结果保存为 out_file（默认 <...>_region_fit.npz），并画峰位 / 分辨率图
+    base = os.path.splitext(root_file)[0]
+    out_file = out_file or base + "_region_fit.npz"
+    plot_file = plot_file or base + "_region_fit.png"
+    spectra = fill_region_spectra(root_file, region_size, fit_range, n_bins, step_size)
+    save_histograms(base + "_regions.npz", {"regions": spectra})
+    result = fit_region_spectra(spectra, min_counts=min_counts, n_workers=n_workers)
+    np.savez(out_file, region_size=region_size, **result)
+
+    status = result["status"]
+    print(f"区域数: {status.size}，拟合成功: {np.sum(status == STATUS_OK)}，参数在边界: {np.sum(status == STATUS_AT_LIMIT)}，"
+          f"未收敛: {np.sum(status == STATUS_NOT_CONVERGED)}，计数不足: {np.sum(status == STATUS_LOW_COUNTS)}")
+    print(f"拟合结果已保存: {out_file}")
+
+    fig, axes = plt.subplots(1, 2, figsize=(16, 6))
+    n_pixels = spectra.n_pixels
+    for ax, name, label in ((axes[0], "mean", "Peak Position (keV)"), (axes[1], "sigma", "Resolution sigma (keV)")):
+        image = np.where(status == STATUS_OK, result[name], np.nan)
+        im = ax.imshow(image.T, origin='lower', extent=[0, n_pixels, 0, n_pixels], cmap='viridis', aspect='auto')
+        fig.colorbar(im, ax=ax, label=label)
+        ax.set_title(f"{label} per {region_size}x{region_size} Region")
+        ax.set_xlabel("X-pixel")
+        ax.set_ylabel("Y-pixel")
+    fig.savefig(plot_file, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    print(f"分布图已保存为: {plot_file}")
+    return result
+
+
+if __name__ == "__main__":
+    fit_regions("./Am_600s.root", region_size=8)
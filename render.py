@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import metrics
+from histograms import load_histograms
+
+# 由保存的直方图（.npz，见 histograms.save_histograms）批量出图，不再读取事件数据：
+# 每个直方图按类型画一张图，图名为 <npz 名>_<直方图名>.png。每张图的输入（直方图内容 + 画图参数）取内容哈希，
+# 记录在 out_dir 下的 <npz 名>.render.json 中，哈希未变且图片存在时跳过，不重画；多个 run 可用进程池并行出图。
+# 直接用 Agg 画布出图（不经过 pyplot），不弹窗、不阻塞，也不改变调用进程的 matplotlib 后端
+RENDER_VERSION = 1  # 改动画图代码后加一，使旧的缓存失效
+
+
+def _draw_hist1d(fig, hist, name):
+    ax = fig.add_subplot()
+    ax.stairs(hist.counts, hist.edges, fill=True, color='skyblue', edgecolor='black')
+    ax.set_xlabel('Cluster Energy (keV)')
+    ax.set_ylabel('Counts')
+    ax.set_title(name)
+    ax.grid(True, alpha=0.3)
+
+
+def _draw_pixel_map(fig, pixel_map, name):
+    n = pixel_map.n_pixels
+    for i, (image, cmap, label) in enumerate(((pixel_map.sum, 'hot', 'Total Accumulated Energy (keV)'),
+                                              (pixel_map.mean(), 'viridis', 'Mean Energy per Hit (keV)'))):
+        ax = fig.add_subplot(1, 2, i + 1)
+        im = ax.imshow(image.T, origin='lower', extent=[0, n, 0, n], cmap=cmap, aspect='auto')
+        fig.colorbar(im, ax=ax, label=label)
+        ax.set_title(f"{name}: {label.split(' (')[0]}")
+        ax.set_xlabel("X-pixel")
+        ax.set_ylabel("Y-pixel")
+
+
+def _draw_size_spectra(fig, spectra, name):
+    ax = fig.add_subplot()
+    for size in range(1, spectra.max_size + 1):
+        label = f"n_cells = {size}" if size < spectra.max_size else f"n_cells >= {size}"
+        ax.stairs(spectra.spectrum(size), spectra.edges, label=label)
+    ax.set_xlabel('Cluster Energy (keV)')
+    ax.set_ylabel('Counts')
+    ax.set_title(name)
+    ax.legend(fontsize=8)
+    ax.grid(True, alpha=0.3)
+
+
+def _draw_region_spectra(fig, spectra, name):
+    ax = fig.add_subplot()
+    n = spectra.n_pixels
+    im = ax.imshow(spectra.counts.sum(axis=2).T, origin='lower', extent=[0, n, 0, n], cmap='viridis', aspect='auto')
+    fig.colorbar(im, ax=ax, label=f'Counts ({spectra.lo:g}-{spectra.hi:g} keV)')
+    ax.set_title(f"{name} ({spectra.region_size}x{spectra.region_size} Regions)")
+    ax.set_xlabel("X-pixel")
+    ax.set_ylabel("Y-pixel")
+
+
+# 直方图类型 -> (画图函数, 图片尺寸)
+FIGURES = {
+    "Hist1D": (_draw_hist1d, (8, 6)),
+    "PixelMap": (_draw_pixel_map, (16, 6)),
+    "SizeSpectra": (_draw_size_spectra, (8, 6)),
+    "RegionSpectra": (_draw_region_spectra, (8, 7)),
+}
+
+
+def content_hash(hist, dpi):
+    # 直方图内容（各字段的 dtype / 形状 / 数据）和画图参数的哈希
+    h = hashlib.sha256(f"{RENDER_VERSION}/{hist.kind}/{dpi}".encode())
+    for field, value in sorted(hist.to_arrays().items()):
+        value = np.ascontiguousarray(value)
+        h.update(f"/{field}/{value.dtype.str}/{value.shape}/".encode())
+        h.update(value.tobytes())
+    return h.hexdigest()
+
+
+def render_histograms(hists, out_dir=".", prefix="", dpi=150, force=False, cache_file=None):
+    # 画出一组直方图（名字 -> 直方图），返回 (重画的图片, 跳过的图片)；force=True 时忽略缓存全部重画
+    os.makedirs(out_dir, exist_ok=True)
+    cache_file = cache_file or os.path.join(out_dir, (prefix or "plots") + ".render.json")
+    cache = {}
+    if not force and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    rendered, skipped = [], []
+    for name, hist in hists.items():
+        if hist.kind not in FIGURES:
+            continue
+        png = f"{prefix}_{name}.png" if prefix else f"{name}.png"
+        path = os.path.join(out_dir, png)
+        key = content_hash(hist, dpi)
+        if cache.get(png) == key and os.path.exists(path):
+            skipped.append(path)
+            continue
+        with metrics.stage("render"):
+            draw, figsize = FIGURES[hist.kind]
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+            draw(fig, hist, name)
+            fig.savefig(path, dpi=dpi, bbox_inches='tight')
+        cache[png] = key
+        rendered.append(path)
+
+    with open(cache_file, "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    return rendered, skipped
+
+
+def render_run(hist_file, out_dir=None, dpi=150, force=False):
+    # 画出一个 run 保存的全部直方图，图片默认放在 .npz 旁边
+    out_dir = out_dir or os.path.dirname(hist_file) or "."
+    prefix = os.path.splitext(os.path.basename(hist_file))[0]
+    return render_histograms(load_histograms(hist_file), out_dir, prefix, dpi, force)
+
+
+def _render_run_task(args):
+    return render_run(*args)
+
+
+def render_campaign(hist_files, out_dir=None, dpi=150, force=False, n_workers=1):
+    # 对一批 run 的 .npz 出图，n_workers > 1 时按 run 并行；只重画内容有变化的图
+    tasks = [(hist_file, out_dir, dpi, force) for hist_file in hist_files]
+    if n_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            results = list(metrics.imap(pool, _render_run_task, tasks))
+    else:
+        results = [_render_run_task(task) for task in tasks]
+    n_rendered = sum(len(rendered) for rendered, _ in results)
+    n_skipped = sum(len(skipped) for _, skipped in results)
+    print(f"出图完成: {len(tasks)} 个 run，重画 {n_rendered} 张，未变化跳过 {n_skipped} 张")
+    metrics.count("figures_rendered", n_rendered)
+    metrics.count("figures_skipped", n_skipped)
+    metrics.flush("render_campaign")
+    return results
+
+
+if __name__ == "__main__":
+    render_campaign(["./Am_600s_plots.npz"])
@@ -0,0 +1,269 @@
+import math
+import awkward as ak
+import numpy as np
+import matplotlib.pyplot as plt
+
+import columnar_cache
+from histograms import Hist1D
+
+# 不依赖 ROOT 的能谱拟合（代替 fit_energy.py 的 RooFit 事件循环，可在 uproot/NumPy 环境中与其它步骤同进程运行）：
+# 扩展似然，模型为 高斯信号 + 线性本底，拟合区间默认 40-70 keV（Am-241 59.5 keV 峰）
+#   signal(x)     = Gauss(x; mean, sigma)，在拟合区间内归一化
+#   background(x) = (1 + slope * (x - 区间中点)) / 区间宽度，slope 的范围保证本底在区间内非负
+# 参数名、初值和范围与 fit_energy.py 相同（产量范围 0..区间内数据点数）
+
+PARAM_NAMES = ("n_sig", "n_bkg", "mean", "sigma", "slope")
+
+
+def erfc(x):
+    # 向量化 erfc（NumPy 没有 erf，这里不依赖 scipy）：Chebyshev 拟合，相对误差 < 1.2e-7，光滑；
+    # region_fit 的批量拟合也用它，两种拟合的模型完全相同
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.5 * z)
+    poly = -z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277))))))))
+    ans = t * np.exp(poly)
+    return np.where(x >= 0, ans, 2.0 - ans)
+
+
+def gauss_cdf(x, mean, sigma):
+    z = (np.asarray(x, dtype=np.float64) - mean) / (sigma * math.sqrt(2.0))
+    return 0.5 * erfc(-z)
+
+
+def _model_parts(params, lo, hi):
+    n_sig, n_bkg, mean, sigma, slope = params
+    norm = gauss_cdf(hi, mean, sigma) - gauss_cdf(lo, mean, sigma)
+    return n_sig, n_bkg, mean, sigma, slope, norm, 0.5 * (lo + hi), hi - lo
+
+
+def model_density(x, params, lo, hi):
+    # 模型的事件密度（counts / keV），返回 (总密度, 本底密度)
+    n_sig, n_bkg, mean, sigma, slope, norm, center, width = _model_parts(params, lo, hi)
+    x = np.asarray(x, dtype=np.float64)
+    signal = np.exp(-0.5 * ((x - mean) / sigma) ** 2) / (sigma * math.sqrt(2 * math.pi) * norm)
+    background = (1.0 + slope * (x - center)) / width
+    return n_sig * signal + n_bkg * background, n_bkg * background
+
+
+def model_bin_counts(edges, params, lo, hi):
+    # 各 bin 内的期望事件数（信号用 CDF 差精确积分，本底为线性函数的积分）
+    n_sig, n_bkg, mean, sigma, slope, norm, center, width = _model_parts(params, lo, hi)
+    edges = np.asarray(edges, dtype=np.float64)
+    signal = np.diff(gauss_cdf(edges, mean, sigma)) / norm
+    a, b = edges[:-1] - center, edges[1:] - center
+    background = ((b - a) + 0.5 * slope * (b * b - a * a)) / width
+    return n_sig * signal + n_bkg * background
+
+
+def _unbinned_nll(values, lo, hi):
+    def nll(params):
+        density, _ = model_density(values, params, lo, hi)
+        if np.any(density <= 0):
+            return np.inf
+        return params[0] + params[1] - np.sum(np.log(density))
+    return nll
+
+
+def _binned_nll(edges, counts):
+    lo, hi = edges[0], edges[-1]
+    nonzero = counts > 0
+
+    def nll(params):
+        expected = model_bin_counts(edges, params, lo, hi)
+        if np.any(expected[nonzero] <= 0):
+            return np.inf
+        # 扩展 Poisson 似然（去掉与参数无关的 log(n!)）
+        return np.sum(expected) - np.sum(counts[nonzero] * np.log(expected[nonzero]))
+    return nll
+
+
+def _to_internal(p, bounds):
+    # 有界参数的 MINUIT 式变换：p = lo + (hi - lo) * (sin(u) + 1) / 2
+    lo, hi = bounds[:, 0], bounds[:, 1]
+    return np.arcsin(np.clip(2 * (p - lo) / (hi - lo) - 1, -1, 1))
+
+
+def _to_external(u, bounds):
+    lo, hi = bounds[:, 0], bounds[:, 1]
+    return lo + (hi - lo) * (np.sin(u) + 1) / 2
+
+
+def _grad_hess(f, x, fx, steps):
+    # 中心差分的梯度和 Hessian
+    n = len(x)
+    grad = np.zeros(n)
+    hess = np.zeros((n, n))
+    f_plus = np.zeros(n)
+    f_minus = np.zeros(n)
+    for i in range(n):
+        e = np.zeros(n)
+        e[i] = steps[i]
+        f_plus[i], f_minus[i] = f(x + e), f(x - e)
+        grad[i] = (f_plus[i] - f_minus[i]) / (2 * steps[i])
+        hess[i, i] = (f_plus[i] - 2 * fx + f_minus[i]) / steps[i] ** 2
+    for i in range(n):
+        for j in range(i + 1, n):
+            ei = np.zeros(n)
+            ej = np.zeros(n)
+            ei[i] = steps[i]
+            ej[j] = steps[j]
+            hess[i, j] = hess[j, i] = (f(x + ei + ej) - f(x + ei - ej) - f(x - ei + ej) + f(x - ei - ej)) / (
+                4 * steps[i] * steps[j])
+    return grad, hess
+
+
+def _minimize(f, x0, steps, max_iter=200, edm_tol=1e-6):
+    # 带阻尼的 Newton 法（Levenberg 式）：Hessian 不正定或步长使 f 变大时加大阻尼；
+    # 收敛判据与 MINUIT 相同，估计的距最小值距离 EDM = g^T H^-1 g / 2 < edm_tol
+    x = np.array(x0, dtype=np.float64)
+    fx = f(x)
+    damping = 1e-3
+    for _ in range(max_iter):
+        grad, hess = _grad_hess(f, x, fx, steps)
+        try:
+            edm = 0.5 * grad @ np.linalg.solve(hess, grad)
+        except np.linalg.LinAlgError:
+            edm = -1.0
+        if 0 <= edm < edm_tol:
+            return x, fx, True
+        scale = np.abs(np.diag(hess)) + 1e-12
+        while damping < 1e12:
+            try:
+                step = np.linalg.solve(hess + damping * np.diag(scale), -grad)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            f_new = f(x + step)
+            if f_new < fx:
+                break
+            damping *= 10
+        else:
+            # 任何方向都无法再减小 f（已在数值精度内），以 EDM 判断是否收敛
+            return x, fx, 0 <= edm < edm_tol * 100
+        x, fx = x + step, f_new
+        damping = max(damping / 10, 1e-9)
+    return x, fx, False
+
+
+def fit_spectrum(values=None, hist=None, fit_range=(40.0, 70.0), n_bins=30, binned=False,
+                 init=None, bounds=None):
+    # values：cluster_energy（一维数组，区间外的值被忽略）；hist：Hist1D（如 histograms 保存的能谱，只能做分 bin 拟合）
+    # binned=True：对 n_bins 个等宽 bin 做扩展 Poisson 似然拟合（大数据量时更快），否则逐事件（unbinned）拟合
+    # init / bounds：参数名 -> 初值 / (下限, 上限)，覆盖默认值
+    # 返回字典：各参数的 (值, 误差)，以及 covariance、nll、converged、n_data、fit_range、binned
+    lo, hi = map(float, fit_range)
+    if hist is not None:
+        edges, counts = hist.edges, hist.counts
+        inside = (edges[:-1] >= lo) & (edges[1:] <= hi)
+        edges = np.append(edges[:-1][inside], edges[1:][inside][-1:])
+        counts = np.asarray(counts[inside], dtype=np.float64)
+        lo, hi = edges[0], edges[-1]
+        binned = True
+        n_data = counts.sum()
+    else:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[(values >= lo) & (values <= hi)]
+        n_data = len(values)
+        if binned:
+            edges = np.linspace(lo, hi, n_bins + 1)
+            counts = Hist1D(n_bins, lo, hi).fill(values).counts
+    if n_data == 0:
+        raise ValueError(f"拟合区间 {lo}-{hi} keV 内没有数据")
+
+    start = {"n_sig": 0.4 * n_data, "n_bkg": 0.6 * n_data, "mean": 59.5, "sigma": 1.5, "slope": 0.0}
+    limits = {"n_sig": (0.0, n_data), "n_bkg": (0.0, n_data), "mean": (55.0, 65.0), "sigma": (0.5, 5.0),
+              "slope": (-2.0 / (hi - lo), 2.0 / (hi - lo))}
+    start.update(init or {})
+    limits.update(bounds or {})
+    bounds = np.array([limits[name] for name in PARAM_NAMES], dtype=np.float64)
+    p0 = np.array([start[name] for name in PARAM_NAMES], dtype=np.float64)
+
+    nll = _binned_nll(edges, counts) if binned else _unbinned_nll(values, lo, hi)
+    u, _, converged = _minimize(lambda u: nll(_to_external(u, bounds)), _to_internal(p0, bounds),
+                                steps=np.full(len(p0), 1e-4))
+    best = _to_external(u, bounds)
+    best_nll = nll(best)
+
+    # 误差：外部参数下 NLL 的 Hessian 求逆（与 HESSE 相同，对应 ΔNLL = 0.5）
+    _, hess = _grad_hess(nll, best, best_nll, steps=1e-4 * (bounds[:, 1] - bounds[:, 0]))
+    try:
+        covariance = np.linalg.inv(hess)
+    except np.linalg.LinAlgError:
+        covariance = np.full_like(hess, np.nan)
+    errors = np.sqrt(np.where(np.diag(covariance) > 0, np.diag(covariance), np.nan))
+
+    result = {name: (float(best[i]), float(errors[i])) for i, name in enumerate(PARAM_NAMES)}
+    result.update({"covariance": covariance, "nll": float(best_nll), "converged": bool(converged),
+                   "n_data": float(n_data), "fit_range": (lo, hi), "binned": binned})
+    return result
+
+
+def print_fit_result(result):
+    lo, hi = result["fit_range"]
+    print(f"拟合 ({'binned' if result['binned'] else 'unbinned'}, {lo:g}-{hi:g} keV, "
+          f"数据点数 {result['n_data']:.0f}, 收敛: {result['converged']}, NLL = {result['nll']:.3f})")
+    for name in PARAM_NAMES:
+        value, error = result[name]
+        print(f"  {name:<6} = {value:.5g} ± {error:.3g}")
+    print(f"\n信号产量: {result['n_sig'][0]:.0f} ± {result['n_sig'][1]:.0f}")
+    print(f"峰位置: {result['mean'][0]:.2f} ± {result['mean'][1]:.2f} keV")
+    print(f"分辨率 (sigma): {result['sigma'][0]:.2f} ± {result['sigma'][1]:.2f} keV")
+
+
+def plot_fit(result, values=None, hist=None, n_bins=30, plot_file="fit_result.png"):
+    # 数据（带 Poisson 误差）+ 模型（蓝）+ 本底（红虚线），与 fit_energy.py 的图相同
+    lo, hi = result["fit_range"]
+    if hist is not None:
+        edges, counts = hist.edges, hist.counts
+        inside = (edges[:-1] >= lo) & (edges[1:] <= hi)
+        edges = np.append(edges[:-1][inside], edges[1:][inside][-1:])
+        counts = counts[inside]
+    else:
+        edges = np.linspace(lo, hi, n_bins + 1)
+        counts = Hist1D(n_bins, lo, hi).fill(values).counts
+    params = [result[name][0] for name in PARAM_NAMES]
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    x = np.linspace(lo, hi, 500)
+    total, background = model_density(x, params, lo, hi)
+    bin_width = edges[1] - edges[0]
+
+    plt.figure(figsize=(8, 6))
+    plt.errorbar(centers, counts, yerr=np.sqrt(counts), fmt='ko', markersize=3, label='data')
+    plt.plot(x, total * bin_width, color='blue', label='model')
+    plt.plot(x, background * bin_width, color='red', linestyle='--', label='background')
+    plt.xlabel('Energy (keV)')
+    plt.ylabel(f'Events / ({bin_width:g} keV)')
+    plt.title('Energy Spectrum Fit')
+    plt.legend(loc='lower right')
+    plt.text(0.03, 0.97, "\n".join(f"{name} = {result[name][0]:.4g} ± {result[name][1]:.2g}" for name in PARAM_NAMES),
+             transform=plt.gca().transAxes, fontsize=9, va='top', bbox=dict(facecolor='white', alpha=0.8))
+    plt.savefig(plot_file, dpi=300, bbox_inches='tight')
+    plt.close()
+    print(f"保存图像: {plot_file}")
+
+
+def fit_root_file(file_path, fit_range=(40.0, 70.0), binned=False, n_bins=30, plot_file="fit_result.png",
+                  step_size="200 MB"):
+    # 向量化读取 cluster_energy（逐块展平、只保留拟合区间内的值），拟合并画图
+    lo, hi = fit_range
+    parts = []
+    n_events = n_clusters = 0
+    for data in columnar_cache.iterate(file_path, ["cluster_energy"], step_size):
+        energies = ak.to_numpy(ak.flatten(data["cluster_energy"]))
+        n_events += len(data)
+        n_clusters += len(energies)
+        parts.append(energies[(energies >= lo) & (energies <= hi)])
+    values = np.concatenate(parts) if parts else np.zeros(0)
+    print(f"总事件数: {n_events}")
+    print(f"总簇数: {n_clusters} (平均/事件: {n_clusters / max(n_events, 1):.1f})")
+    print(f"过滤后数据点数 ({lo:g}-{hi:g} keV): {len(values)}")
+
+    result = fit_spectrum(values, fit_range=fit_range, n_bins=n_bins, binned=binned)
+    print_fit_result(result)
+    plot_fit(result, values, n_bins=n_bins, plot_file=plot_file)
+    return result
+
+
+if __name__ == "__main__":
+    fit_root_file("./Am_600s.root")
@@ -0,0 +1,106 @@
+import os
+import numpy as np
+
+# 合成 PIXET .clog（格式与 convert_clog_to_root 读入的相同），用于基准测试和可复现的规模测试：
+# 每个 Frame 有 1 + Poisson(clusters_per_frame - 1) 个主 cluster；主 cluster 的能量 60% 为 59.5 keV 峰，
+# 其余为 5-120 keV 的连续谱，cell 数为 1 + Poisson(cells_per_cluster - 1)，cell 沿相邻像素随机游走。
+# 每个主 cluster 以 flu_fraction 的概率带一个荧光 cluster（Cd/Te K 线约 23 / 27 keV，1-2 个 cell，
+# 距主 cluster 不超过 flu_distance 像素），此时主 cluster 的峰能量相应减去荧光能量（逃逸峰）
+PEAK_ENERGY = 59.5
+FLU_ENERGIES = (23.2, 27.5)
+CHUNK_FRAMES = 100000  # 每块生成的 Frame 数（输出与 seed 和块大小有关，块大小固定以保证可复现）
+
+
+def _random_walk(rng, n_cells):
+    # 每个 cluster 的 cell 偏移：第一个 cell 在中心，之后每步移到相邻像素
+    steps = rng.integers(-1, 2, size=(n_cells.sum(), 2))
+    first = np.cumsum(n_cells) - n_cells
+    steps[first] = 0
+    offsets = np.cumsum(steps, axis=0)
+    return offsets - np.repeat(offsets[first], n_cells, axis=0)
+
+
+def _cluster_cells(rng, x, y, energy, n_cells):
+    # 把 cluster 能量按 Dirichlet 比例分给各 cell（第一个 cell 能量最大、T=0，其余 T 为 1.5625 ns 的整数倍）
+    offsets = _random_walk(rng, n_cells)
+    cell_x = np.clip(np.repeat(x, n_cells) + offsets[:, 0], 0, 255)
+    cell_y = np.clip(np.repeat(y, n_cells) + offsets[:, 1], 0, 255)
+    share = rng.gamma(2.0, size=len(cell_x))
+    cluster_of_cell = np.repeat(np.arange(len(n_cells)), n_cells)
+    share /= np.bincount(cluster_of_cell, weights=share)[cluster_of_cell]
+    first = np.cumsum(n_cells) - n_cells
+    order = np.lexsort((-share, cluster_of_cell))  # 每个 cluster 内按能量从大到小
+    cell_E = share[order] * np.repeat(energy, n_cells)
+    cell_T = rng.integers(0, 80, size=len(cell_x)) * 1.5625
+    cell_T[first] = 0.0
+    return cell_x, cell_y, cell_E, cell_T
+
+
+def _generate_chunk(rng, first_frame, n_frames, t0, clusters_per_frame, cells_per_cluster, flu_fraction,
+                    flu_distance):
+    n_main = 1 + rng.poisson(max(clusters_per_frame - 1, 0), size=n_frames)
+    n = n_main.sum()
+    x = rng.integers(0, 256, size=n)
+    y = rng.integers(0, 256, size=n)
+    has_flu = rng.random(n) < flu_fraction
+    flu_E = rng.normal(np.array(FLU_ENERGIES)[rng.integers(0, 2, size=n)], 0.8)
+    in_peak = rng.random(n) < 0.6
+    energy = np.where(in_peak, rng.normal(PEAK_ENERGY, 1.5, size=n) - np.where(has_flu, flu_E, 0.0),
+                      rng.uniform(5, 120, size=n))
+    n_cells = 1 + rng.poisson(max(cells_per_cluster - 1, 0), size=n)
+
+    # 荧光 cluster 紧跟在所属主 cluster 之后
+    n_flu = has_flu.sum()
+    flu_x = np.clip(x[has_flu] + rng.integers(-flu_distance, flu_distance + 1, size=n_flu), 0, 255)
+    flu_y = np.clip(y[has_flu] + rng.integers(-flu_distance, flu_distance + 1, size=n_flu), 0, 255)
+    flu_cells = rng.integers(1, 3, size=n_flu)
+    slot = np.arange(n) + np.cumsum(has_flu) - has_flu
+    flu_slot = slot[has_flu] + 1
+    total = n + n_flu
+    all_x, all_y = np.empty(total, np.int64), np.empty(total, np.int64)
+    all_E, all_n = np.empty(total), np.empty(total, np.int64)
+    all_x[slot], all_y[slot], all_E[slot], all_n[slot] = x, y, energy, n_cells
+    all_x[flu_slot], all_y[flu_slot], all_E[flu_slot], all_n[flu_slot] = flu_x, flu_y, flu_E[has_flu], flu_cells
+    frame_of_main = np.repeat(np.arange(n_frames), n_main)
+    clusters_per_frame_out = n_main + np.bincount(frame_of_main[has_flu], minlength=n_frames)
+
+    cell_x, cell_y, cell_E, cell_T = _cluster_cells(rng, all_x, all_y, np.maximum(all_E, 1.0), all_n)
+    cells = [f"[{cx}, {cy}, {ce:.6g}, {ct:g}]" for cx, cy, ce, ct in
+             zip(cell_x.tolist(), cell_y.tolist(), cell_E.tolist(), cell_T.tolist())]
+    times = t0 + np.cumsum(rng.exponential(3e8, size=n_frames))
+
+    out = []
+    cell_pos = 0
+    cluster_pos = 0
+    n_list = all_n.tolist()
+    for i, (t, n_clusters) in enumerate(zip(times.tolist(), clusters_per_frame_out.tolist())):
+        out.append(f"Frame {first_frame + i} ({t:.4f}, 0.000000 s)")
+        for k in n_list[cluster_pos:cluster_pos + n_clusters]:
+            out.append(" ".join(cells[cell_pos:cell_pos + k]))
+            cell_pos += k
+        cluster_pos += n_clusters
+    out.append("")
+    return "\n".join(out), times[-1], total, len(cell_x), n_flu
+
+
+def generate_clog(path, n_frames, clusters_per_frame=1.5, cells_per_cluster=3.0, flu_fraction=0.3, flu_distance=8,
+                  seed=0):
+    # 写出 n_frames 个 Frame 的合成 .clog，返回 Frame / cluster / cell / 荧光 cluster 数和文件大小
+    summary = {"n_frames": n_frames, "n_clusters": 0, "n_cells": 0, "n_flu": 0}
+    t = 0.0
+    with open(path, "w") as f:
+        for i, start in enumerate(range(0, n_frames, CHUNK_FRAMES)):
+            rng = np.random.default_rng([seed, i])
+            text, t, n_clusters, n_cells, n_flu = _generate_chunk(
+                rng, start + 1, min(CHUNK_FRAMES, n_frames - start), t, clusters_per_frame, cells_per_cluster,
+                flu_fraction, flu_distance)
+            f.write(text)
+            summary["n_clusters"] += int(n_clusters)
+            summary["n_cells"] += int(n_cells)
+            summary["n_flu"] += int(n_flu)
+    summary["bytes"] = os.path.getsize(path)
+    return summary
+
+
+if __name__ == "__main__":
+    print(generate_clog("./synthetic.clog", 10000))
@@ -0,0 +1,183 @@
+import numpy as np
+import awkward as ak
+import uproot
+
+import metrics
+
+# 输出 Tree 的分支及类型（与 convert_clog_to_root 写出的 Tree 一致）
+EVENT_BRANCHES = {
+    "event_id": np.int32,
+    "event_time": np.float64,
+}
+# Cluster 级：每个 Event 的长度为 cluster 数
+CLUSTER_BRANCHES = {
+    "cluster_index": np.int64,
+    "cluster_n_cells": np.int64,
+    "cluster_energy": np.float64,
+    "cluster_weighted_x": np.float64,
+    "cluster_weighted_y": np.float64,
+    "cluster_avg_t": np.float64,
+}
+# Cell 级：每个 Event 的长度为 cell 数
+CELL_BRANCHES = {
+    "cell_x": np.float64,
+    "cell_y": np.float64,
+    "cell_E": np.float64,
+    "cell_T": np.float64,
+    "cell_cluster_id": np.int64,
+}
+
+
+# 紧凑类型：256x256 Timepix 的像素坐标可用 uint8，能量/时间用 float32 足够
+COMPACT_DTYPES = {
+    "cluster_index": np.uint16,
+    "cluster_n_cells": np.uint16,
+    "cell_x": np.uint8,
+    "cell_y": np.uint8,
+    "cell_E": np.float32,
+    "cell_T": np.float32,
+    "cell_cluster_id": np.uint16,
+}
+
+COMPRESSION_ALGORITHMS = {
+    "zlib": uproot.ZLIB,
+    "lzma": uproot.LZMA,
+    "lz4": uproot.LZ4,
+    "zstd": uproot.ZSTD,
+}
+
+
+def make_compression(compression):
+    # compression 可以是 uproot 压缩对象、(算法, 级别) 元组（如 ("zstd", 5)）或 "none"（不压缩）
+    if compression is None or isinstance(compression, uproot.compression.Compression):
+        return compression
+    if compression == "none":
+        return None
+    algorithm, level = compression
+    return COMPRESSION_ALGORITHMS[algorithm.lower()](level)
+
+
+def open_output(output_file, compression=None):
+    # 打开输出 ROOT 文件；compression 为 None 时使用 uproot 默认压缩
+    if compression is None:
+        return uproot.recreate(output_file)
+    return uproot.recreate(output_file, compression=make_compression(compression))
+
+
+def _cast(data, dtype, name):
+    # 转为整数类型时检查是否无损（坐标不是整数或超出范围时报错，而不是静默截断）
+    data = np.asarray(data)
+    out = np.ascontiguousarray(data, dtype=dtype)
+    if out.dtype != data.dtype and np.issubdtype(out.dtype, np.integer) and not np.array_equal(out, data):
+        raise ValueError(f"分支 {name} 的数据无法无损转换为 {out.dtype.name}")
+    return out
+
+
+def build_tree_branches(events, clusters, cells, n_clusters, n_cells, dtypes=None):
+    # 由扁平的 NumPy 缓冲 + 每个 Event 的 cluster 数 / cell 数构建要写入 Tree 的分支，
+    # jagged 分支用 ak.unflatten 直接生成，不经过 Python 列表的逐个对象类型推断。
+    # dtypes：分支名 -> 输出类型，覆盖默认类型（如 COMPACT_DTYPES）
+    # cells 为 None 时只写 Event 和 Cluster 级分支
+    dtypes = dtypes or {}
+    n_clusters = np.asarray(n_clusters, dtype=np.int64)
+    branches = {}
+    with metrics.stage("build", events=len(n_clusters), clusters=len(clusters["cluster_energy"])):
+        for name, dtype in EVENT_BRANCHES.items():
+            branches[name] = _cast(events[name], dtypes.get(name, dtype), name)
+        for name, dtype in CLUSTER_BRANCHES.items():
+            branches[name] = ak.unflatten(_cast(clusters[name], dtypes.get(name, dtype), name), n_clusters)
+        if cells is None:
+            return branches
+        n_cells = np.asarray(n_cells, dtype=np.int64)
+        for name, dtype in CELL_BRANCHES.items():
+            branches[name] = ak.unflatten(_cast(cells[name], dtypes.get(name, dtype), name), n_cells)
+    return branches
+
+
+def flatten_tree_arrays(data):
+    # build_tree_branches 的逆操作：把读入的 Tree（awkward record array）拆成扁平 NumPy 缓冲 + 每个 Event 的计数
+    # 没有读入 cell 分支时 cells / n_cells 为 None
+    with metrics.stage("flatten", events=len(data)) as s:
+        events = {name: ak.to_numpy(data[name]) for name in EVENT_BRANCHES}
+        clusters = {name: ak.to_numpy(ak.flatten(data[name])) for name in CLUSTER_BRANCHES}
+        n_clusters = ak.to_numpy(ak.num(data["cluster_index"])).astype(np.int64)
+        s.add(clusters=len(clusters["cluster_index"]))
+        if "cell_cluster_id" not in data.fields:
+            return events, clusters, None, n_clusters, None
+        cells = {name: ak.to_numpy(ak.flatten(data[name])) for name in CELL_BRANCHES}
+        n_cells = ak.to_numpy(ak.num(data["cell_cluster_id"])).astype(np.int64)
+    return events, clusters, cells, n_clusters, n_cells
+
+
+def write_branches(file, branches, tree_name="Tree", basket_entries=None):
+    # 第一块建树，之后每块作为新的 basket 追加；basket_entries 指定每个 basket 的 Event 数
+    n_entries = len(branches["event_id"])
+    step = basket_entries or n_entries
+    with metrics.stage("write", events=n_entries):
+        for start in range(0, n_entries, step):
+            part = branches if step >= n_entries else {name: array[start:start + step]
+                                                       for name, array in branches.items()}
+            if tree_name in file:
+                file[tree_name].extend(part)
+            else:
+                file.mktree(tree_name, part)
+
+
+class ColumnarTreeBuffer:
+    # 按块累积输出 Tree 的数据：每个分支一个 NumPy 数组列表，外加每个 Event 的 cluster 数 / cell 数，
+    # to_branches() 时再一次性拼接。既可以逐 Event 添加，也可以整块添加
+
+    def __init__(self, dtypes=None, basket_entries=None):
+        self.dtypes = dtypes
+        self.basket_entries = basket_entries
+        self.reset()
+
+    def reset(self):
+        self._parts = {name: [] for name in (*EVENT_BRANCHES, *CLUSTER_BRANCHES, *CELL_BRANCHES)}
+        self._n_clusters = []
+        self._n_cells = []
+        self.n_events = 0
+
+    def __len__(self):
+        return self.n_events
+
+    def add_event(self, event_id, event_time, clusters, cells):
+        # clusters / cells：分支名 -> 当前 Event 的一维数组
+        self._parts["event_id"].append(np.array([event_id]))
+        self._parts["event_time"].append(np.array([event_time]))
+        for name in CLUSTER_BRANCHES:
+            self._parts[name].append(clusters[name])
+        for name in CELL_BRANCHES:
+            self._parts[name].append(cells[name])
+        self._n_clusters.append(np.array([len(clusters["cluster_index"])]))
+        self._n_cells.append(np.array([len(cells["cell_cluster_id"])]))
+        self.n_events += 1
+
+    def add_events(self, events, clusters, cells, n_clusters, n_cells):
+        # 整块添加：events / clusters / cells 为扁平数组，n_clusters / n_cells 为每个 Event 的计数
+        for name in EVENT_BRANCHES:
+            self._parts[name].append(np.asarray(events[name]))
+        for name in CLUSTER_BRANCHES:
+            self._parts[name].append(np.asarray(clusters[name]))
+        for name in CELL_BRANCHES:
+            self._parts[name].append(np.asarray(cells[name]))
+        self._n_clusters.append(np.asarray(n_clusters))
+        self._n_cells.append(np.asarray(n_cells))
+        self.n_events += len(events["event_id"])
+
+    def to_branches(self):
+        def concat(parts, dtype):
+            return np.concatenate(parts).astype(dtype, copy=False) if parts else np.zeros(0, dtype=dtype)
+
+        events = {name: concat(self._parts[name], dtype) for name, dtype in EVENT_BRANCHES.items()}
+        clusters = {name: concat(self._parts[name], dtype) for name, dtype in CLUSTER_BRANCHES.items()}
+        cells = {name: concat(self._parts[name], dtype) for name, dtype in CELL_BRANCHES.items()}
+        return build_tree_branches(events, clusters, cells,
+                                   concat(self._n_clusters, np.int64), concat(self._n_cells, np.int64),
+                                   dtypes=self.dtypes)
+
+    def flush(self, file, tree_name="Tree"):
+        # 写出当前缓存（作为一个新的 basket）并清空
+        if self.n_events:
+            write_branches(file, self.to_branches(), tree_name, self.basket_entries)
+        self.reset()